@@ -0,0 +1,48 @@
+import argparse
+import time
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Run from a checkout without installing
+import peerbase
+from peerbase import crypto
+
+# Compare Fernet with the AEAD ciphers: ciphertext bytes and CPU to seal one binary message and open it on the receiver
+
+parser = argparse.ArgumentParser(
+    description='Benchmark PeerBase ciphers.')
+parser.add_argument(
+    '--iterations', help='Messages to seal/open per case.', default=5000, type=int)
+args = parser.parse_args()
+
+key = peerbase.key_generate().decode('utf-8')
+CIPHERS = ['fernet', *crypto.CIPHERS.keys()]
+nodes = {}
+for cipher in CIPHERS:
+    sender = peerbase.Node('sender', 'bench', key, servers='127.0.0.1:0', use_local=False, compression=None, cipher=cipher)
+    receiver = peerbase.Node('receiver', 'bench', key, servers='127.0.0.1:0', use_local=False, compression=None, cipher=cipher)
+    sender.peer_capabilities['receiver'] = set(receiver.capabilities)
+    nodes[cipher] = (sender, receiver)
+
+CASES = {
+    'small': {'timestamp': time.time(), 'command': 'path.to.command', 'args': [1, 'two', 3.0], 'kwargs': {'flag': True}, 'initiator': 'bench.sender'},
+    'medium': {'timestamp': time.time(), 'command': 'telemetry.push', 'args': [[{'sensor': f's{i}', 'value': i * 0.5, 'ok': True} for i in range(100)]], 'kwargs': {}, 'initiator': 'bench.sender'},
+    'large': {'timestamp': time.time(), 'command': 'config.put', 'args': ['x' * 65536], 'kwargs': {}, 'initiator': 'bench.sender'}
+}
+
+
+def measure(cipher, message):
+    sender, receiver = nodes[cipher]
+    size = len(sender.pack_message(message, binary=True, peer='receiver'))
+    start = time.process_time()
+    for _ in range(args.iterations):
+        receiver.unpack_message(sender.pack_message(message, binary=True, peer='receiver'))
+    return size, (time.process_time() - start) / args.iterations * 1e6
+
+
+print(f'{"case":<8}' + ''.join(f'{c + " B":>14}{c + " us":>14}' for c in CIPHERS))
+for name, message in CASES.items():
+    row = f'{name:<8}'
+    for cipher in CIPHERS:
+        size, cpu = measure(cipher, message)
+        row += f'{size:>14}{cpu:>14.1f}'
+    print(row)
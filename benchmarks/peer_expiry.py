@@ -0,0 +1,47 @@
+import argparse
+import time
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Run from a checkout without installing
+from peerbase.relay_state import MemoryState, SQLiteState
+import tempfile
+import os
+
+# Cost of the relay's per-ping bookkeeping (refresh the peer, then expire stale peers) as the peer count grows
+
+parser = argparse.ArgumentParser(
+    description='Benchmark relay peer expiry.')
+parser.add_argument(
+    '--pings', help='Pings to time per case.', default=20000, type=int)
+parser.add_argument(
+    '--sizes', help='Comma-separated peer counts.', default='100,1000,10000,50000')
+args = parser.parse_args()
+
+
+class LinearState(MemoryState):  # Expiry by scanning every peer, as the relay did before the expiry heap
+    def expire_peers(self, clear_time):
+        with self.lock:
+            cutoff = time.time() - clear_time
+            expired = [i for i, p in self.peers.items() if p['timeout'] < cutoff]
+            for i in expired:
+                del self.peers[i]
+            return len(expired) > 0
+
+
+def measure(state, count, pings):
+    for i in range(count):
+        state.touch(f'peer{i}', [])
+    pings = min(pings, 2000) if isinstance(state, LinearState) and count >= 10000 else pings
+    start = time.perf_counter()
+    for i in range(pings):
+        state.touch(f'peer{i % count}', [])
+        state.expire_peers(1.5)
+    return (time.perf_counter() - start) / pings * 1e6
+
+
+tmp = tempfile.mkdtemp()
+print(f'{"peers":>8}{"linear us":>12}{"heap us":>10}{"sqlite us":>12}')
+for count in [int(i) for i in args.sizes.split(',')]:
+    sqlite = SQLiteState(os.path.join(tmp, f'{count}.db'))
+    print(f'{count:>8}{measure(LinearState(), count, args.pings):>12.1f}{measure(MemoryState(), count, args.pings):>10.1f}{measure(sqlite, count, args.pings // 10):>12.1f}')
+    sqlite.close()
@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Run from a checkout without installing
+import peerbase
+from peerbase import relay as relay_server
+
+# End-to-end benchmarks on one machine: nodes on loopback ports talking directly and through an in-process relay,
+# plus micro-benchmarks of the per-message hot paths. Prints a table and writes machine-readable JSON (--output)
+# so runs can be compared to catch regressions.
+
+parser = argparse.ArgumentParser(
+    description='Benchmark PeerBase end to end.')
+parser.add_argument(
+    '--nodes', help='Nodes started for each of the direct and relay paths (fan-out targets all but one).', default=8, type=int)
+parser.add_argument(
+    '--requests', help='Commands timed per case.', default=300, type=int)
+parser.add_argument(
+    '--concurrency', help='Commands in flight at once in the throughput cases.', default=8, type=int)
+parser.add_argument(
+    '--sizes', help='Comma-separated payload sizes in bytes for the size sweep.', default='64,1024,16384,262144')
+parser.add_argument(
+    '--iterations', help='Calls timed per micro-benchmark.', default=5000, type=int)
+parser.add_argument(
+    '--base-port', help='First of the ports used by the relay and the nodes.', default=24000, type=int, dest='base_port')
+parser.add_argument(
+    '--groups', help='Comma-separated groups to run: direct, relay, fanout, payload, micro, discovery.', default='direct,relay,fanout,payload,micro,discovery')
+parser.add_argument(
+    '--output', help='File to write JSON results to. Defaults to stdout only.', default=None)
+args = parser.parse_args()
+logging.getLogger().setLevel(logging.WARNING)  # The relay logs every packet at INFO
+
+KEY = peerbase.key_generate().decode('utf-8')
+NETWORK = 'bench'
+groups = args.groups.split(',')
+results = []
+
+
+def payload(size):  # Incompressible string of <size> characters
+    return os.urandom(size // 2 + 1).hex()[:size]
+
+
+COMMANDS = {
+    'bench': {
+        'noop': lambda node, a, k: None,
+        'echo': lambda node, a, k: a[0]
+    }
+}
+
+
+def record(group, name, **metrics):
+    results.append(dict(group=group, name=name, **metrics))
+    shown = ' '.join(f'{k}={v:.3f}' if type(v) == float else f'{k}={v}' for k, v in metrics.items())
+    print(f'{group:<10}{name:<28}{shown}', file=sys.stderr)
+
+
+# Call <fn> <count> times, <concurrency> at a time. Returns latency percentiles in milliseconds and calls per second.
+def load(fn, count, concurrency):
+    latencies = []
+    failures = []
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            ok = fn()
+        except Exception:
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        if not ok:
+            failures.append(1)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(count)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    return {
+        'requests': count,
+        'concurrency': concurrency,
+        'errors': len(failures),
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'per_second': count / elapsed
+    }
+
+
+# Time <fn> over <iterations> calls. Returns microseconds per call.
+def micro(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return {'iterations': iterations, 'us': (time.perf_counter() - start) / iterations * 1e6}
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError(f'Timed out waiting for {what}.')
+        time.sleep(0.05)
+
+
+def start_nodes():
+    port = args.base_port + 1
+    advertiser = port
+    local, remote = [], []
+    for i in range(args.nodes):
+        port += 2
+        node = peerbase.Node(f'local{i}', NETWORK, KEY, ports=[port, advertiser], registered_commands=COMMANDS, pool_size=args.concurrency)
+        node.start_multithreaded(discovery_timeout=0)
+        local.append(node)
+    for i in range(args.nodes):
+        port += 2
+        node = peerbase.Node(f'remote{i}', NETWORK, KEY, ports=[port, port + 1], servers=relay_address, registered_commands=COMMANDS,
+                             use_local=False, pool_size=args.concurrency)
+        node.start_multithreaded()
+        remote.append(node)
+    wait_for(lambda: all(len(n.peers) == args.nodes - 1 for n in local), 15, 'local peers to discover each other')
+    wait_for(lambda: all(len([p for p in n.remote_peers if p.startswith('remote')]) == args.nodes - 1 for n in remote), 15, 'remote peers to appear on the relay')
+    for nodes in [local, remote]:  # Learn each peer's capabilities (binary format, compression, cipher) before timing
+        nodes[0].command('bench.noop', target=[n.name for n in nodes[1:]])
+        nodes[1].command('bench.noop', target=nodes[0].name)
+    return local, remote
+
+
+def command(node, target, *command_args):
+    return lambda: node.command('bench.echo' if command_args else 'bench.noop', list(command_args), target=target, raise_errors=True, timeout=10) == (command_args[0] if command_args else None)
+
+
+relay_address = f'{peerbase.ip()}:{args.base_port}'
+relay_server.serve_in_thread(relay_server.Relay(args.base_port, clear_time=1.5))
+local, remote = start_nodes()
+
+for group, nodes in [('direct', local), ('relay', remote)]:
+    if group in groups:
+        for concurrency in [1, args.concurrency]:
+            record(group, f'noop c={concurrency}', **load(command(nodes[0], nodes[1].name), args.requests, concurrency))
+
+if 'fanout' in groups:
+    for path, nodes in [('direct', local), ('relay', remote)]:
+        targets = [n.name for n in nodes[1:]]
+
+        def broadcast(node=nodes[0], targets=targets):
+            return len([r for r in node.command('bench.noop', target=targets, timeout=10).values() if r == None]) == len(targets)
+
+        record('fanout', f'{path} to {len(targets)}', **load(broadcast, max(args.requests // 10, 10), 1))
+
+if 'payload' in groups:
+    for size in [int(s) for s in args.sizes.split(',')]:
+        data = payload(size)
+        for path, nodes in [('direct', local), ('relay', remote)]:
+            record('payload', f'{path} {size} B', bytes=size, **load(command(nodes[0], nodes[1].name, data), max(args.requests // 5, 20), 1))
+
+if 'micro' in groups:
+    node, peer = local[0], local[1].name
+    message = node.command_message('bench.noop', [1, 'two', 3.0], {'flag': True})
+    legacy = node.encode(json.dumps(message))
+    record('micro', 'encode (legacy)', **micro(lambda: node.encode(json.dumps(message)), args.iterations))
+    record('micro', 'decode (legacy)', **micro(lambda: json.loads(node.decode(legacy)), args.iterations))
+    receiver = local[1]  # AEAD frames open once, on the peer they were sealed for, so unpacking is timed together with packing
+    record('micro', 'pack_message (fernet)', **micro(lambda: node.pack_message(message, binary=True), args.iterations))
+    record('micro', 'pack + unpack (fernet)', **micro(lambda: receiver.unpack_message(node.pack_message(message, binary=True)), args.iterations))
+    record('micro', f'pack_message ({node.cipher})', **micro(lambda: node.pack_message(message, binary=True, peer=peer), args.iterations))
+    record('micro', f'pack + unpack ({node.cipher})', **micro(lambda: receiver.unpack_message(node.pack_message(message, binary=True, peer=peer)), args.iterations))
+    fernet = node.pack_message(message, binary=True)
+    record('micro', 'process_request', **micro(lambda: peerbase.process_request(fernet, node), args.iterations))
+    advertisement = local[1].advertisement()
+    record('micro', 'parse_advertisement', **micro(lambda: node.parse_advertisement(advertisement), args.iterations))
+
+if 'discovery' in groups:
+    newcomer = peerbase.Node('newcomer', NETWORK, KEY, ports=[args.base_port + 1 + 4 * args.nodes + 2, args.base_port + 1])
+    start = time.perf_counter()
+    newcomer.start_multithreaded(discovery_timeout=0)
+    wait_for(lambda: len(newcomer.peers) >= args.nodes, 15, 'the new node to see every local peer')
+    record('discovery', f'all {args.nodes} peers', ms=(time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    found = newcomer.discover(timeout=1.5)
+    record('discovery', 'discover(1.5)', peers=len(found), ms=(time.perf_counter() - start) * 1000)
+
+report = {
+    'meta': {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'arguments': vars(args)
+    },
+    'results': results
+}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+print(json.dumps(report))
+os._exit(0)  # Node threads are daemons, but skip waiting on their sockets
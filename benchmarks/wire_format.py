@@ -0,0 +1,65 @@
+import argparse
+import json
+import time
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Run from a checkout without installing
+import peerbase
+from peerbase import wire
+
+# Compare the legacy (JSON + double base64) and binary wire formats: bytes on the wire and CPU per message
+
+parser = argparse.ArgumentParser(
+    description='Benchmark PeerBase wire formats.')
+parser.add_argument(
+    '--iterations', help='Messages to encode/decode per case.', default=2000, type=int)
+args = parser.parse_args()
+
+node = peerbase.Node('bench', 'bench', peerbase.key_generate().decode(
+    'utf-8'), servers='127.0.0.1:0', use_local=False)
+
+CASES = {
+    'small': {'timestamp': time.time(), 'command': 'path.to.command', 'args': [1, 'two', 3.0], 'kwargs': {'flag': True}, 'initiator': 'bench.bench'},
+    'medium': {'timestamp': time.time(), 'command': 'telemetry.push', 'args': [[{'sensor': f's{i}', 'value': i * 0.5, 'ok': True} for i in range(100)]], 'kwargs': {}, 'initiator': 'bench.bench'},
+    'large': {'timestamp': time.time(), 'command': 'config.put', 'args': ['x' * 65536], 'kwargs': {}, 'initiator': 'bench.bench'}
+}
+
+
+def legacy_local(message):
+    return node.encode(json.dumps(message))
+
+
+def binary_local(message):
+    return node.pack_message(message, binary=True)
+
+
+def legacy_relay(message):
+    return json.dumps({'target': 'peer', 'data': wire.to_legacy(node.pack_message(message)), 'packet_id': 'a' * 64, 'originator': 'bench', 'r_type': 'request', 'remote_addr': '127.0.0.1:2000'}).encode('utf-8')
+
+
+def binary_relay(message):
+    return wire.dumps({'target': 'peer', 'data': node.pack_message(message, binary=True), 'packet_id': 'a' * 64, 'originator': 'bench', 'r_type': 'request', 'remote_addr': '127.0.0.1:2000'})
+
+
+def read_relay(body):
+    packet = wire.loads(body)
+    return node.unpack_message(packet['data'])
+
+
+def measure(encoder, decoder, message):
+    body = encoder(message)
+    start = time.process_time()
+    for _ in range(args.iterations):
+        decoder(encoder(message))
+    return len(body), (time.process_time() - start) / args.iterations * 1e6
+
+
+print(f'{"case":<8}{"path":<7}{"legacy B":>10}{"binary B":>10}{"size":>8}{"legacy us":>11}{"binary us":>11}{"cpu":>8}')
+for name, message in CASES.items():
+    for path, legacy, binary, decoder in [
+        ('local', legacy_local, binary_local, node.unpack_message),
+        ('relay', legacy_relay, binary_relay, read_relay)
+    ]:
+        legacy_size, legacy_cpu = measure(legacy, decoder, message)
+        binary_size, binary_cpu = measure(binary, decoder, message)
+        print(f'{name:<8}{path:<7}{legacy_size:>10}{binary_size:>10}{binary_size / legacy_size:>8.2f}{legacy_cpu:>11.1f}{binary_cpu:>11.1f}{binary_cpu / legacy_cpu:>8.2f}')
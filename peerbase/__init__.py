@@ -4,79 +4,420 @@ import requests
 from socket import *
 import threading
 import time
+import sys
 import base64
 import json
 import typing
 import copy
 import traceback
+import warnings
 from peerbase.peer_utils import *
+from peerbase.pool import SessionPool
+from peerbase.routes import RouteStats
+from peerbase import wire
+from peerbase.compress import Compressor
+from peerbase import compress
+from peerbase import crypto
+from peerbase.crypto import SessionCrypto
+from peerbase.metrics import Metrics, SPAN
+from peerbase.cache import TTLCache, arguments_key
+from peerbase import stream
 import random
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import selectors
+import queue
+import pickle
+import inspect
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
+BATCH_CAPABILITY = 'batch'
+FEDERATION_CAPABILITY = 'federation'  # Relay capability: peers attached to federated relays are reached through it
+MULTICAST_CAPABILITY = 'multicast'  # Relay capability: one packet is fanned out to many peers' mailboxes
+BATCH_WORKERS = 32  # Default worker count for parallel batches
+RESPONSE_RETRY_WINDOW = 5  # Seconds a relayed response keeps retrying a relay that applies backpressure
+DEDUP_WINDOW = 60  # Seconds a relayed request's packet id is remembered, so hedged duplicates run once
+ADVERTISE_FAST = 0.1  # Advertisement interval after starting or seeing a new peer, doubling up to advertise_interval
+EXECUTIONS = ['inline', 'thread', 'process']  # Where a command runs: the request's own thread, the command thread pool, or a worker process
+PROCESS_START = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'  # Never fork a threaded node
+BUSY_RETRY = 0.1  # Seconds a node that refuses a request for overload (503) asks the sender to wait before retrying
 
-def process_request(data, node):
-    data = json.loads(node.decode(data))
-    command = data['command']
-    args = data['args']
-    kwargs = data['kwargs']
 
+class CommandRun:
+    # The bookkeeping around one run of a registered command: the memo, the command's concurrency limit, streamed
+    # arguments and handler stats. run_command() and run_command_async() only differ in how they call the function.
+    def __init__(self, node, command, args, kwargs):
+        self.node = node
+        self.command = command
+        self.args = args
+        self.kwargs = kwargs
+        self.ttl = node.command_caching.get(command)
+        self.limit = None
+
+    # (status, result) to answer with without running the command: a fresh cached result, or a refusal while the command
+    # is at its limit. None if it should run, once its streamed arguments are accepted; end it with finished() or failed().
+    def begin(self):
+        if self.ttl != None:  # Cacheable: answer from the memo while the result is fresh
+            self.key = (self.command, arguments_key(self.args, self.kwargs))
+            found, resp = self.node.memo.get(self.key)
+            if found:
+                return 200, resp
+        limit = self.node.command_limits.get(self.command)
+        if limit != None and not limit.acquire(blocking=False):
+            self.node.metrics.count('rejected', reason='command', command=self.command)
+            return 503, f'CMD "{self.command}" BUSY'
+        self.limit = limit
+        self.args, self.kwargs = self.node.accept_arguments(self.args, self.kwargs)
+        self.start = time.perf_counter()
+        return None
+
+    # End a run that returned <resp>. Returns (status, result).
+    def finished(self, resp):
+        return self.end(200, resp)
+
+    # End a run that raised; call from the except block. Returns (status, result).
+    def failed(self):
+        if isinstance(sys.exc_info()[1], InternalKeyError):
+            return self.end(404, f'CMD "{self.command}" NOT FOUND')
+        return self.end(500, traceback.format_exc())
+
+    def end(self, stat, resp):
+        if self.limit != None:
+            self.limit.release()
+        self.node.close_arguments(self.args, self.kwargs, resp)
+        self.node.record_handler(self.command, stat, time.perf_counter() - self.start)
+        if self.ttl != None and stat == 200 and not stream.is_placeholder(resp):
+            self.node.memo.put(self.key, resp, self.ttl)
+        return stat, resp
+
+
+def run_command(node, command, args, kwargs):
+    run = CommandRun(node, command, args, kwargs)
+    answer = run.begin()
+    if answer != None:
+        return answer
     try:
-        resp = get_multikey(command, node.registered_commands)(
-            node, args, kwargs)
-        stat = 200
-    except InternalKeyError:
-        stat = 404
-        resp = f'CMD "{command}" NOT FOUND'
+        resp = node.offer_stream(node.execute(command, run.args, run.kwargs))
     except:
-        stat = 500
-        resp = traceback.format_exc()
-    return stat, resp
+        return run.failed()
+    return run.finished(resp)
+
+
+# Run every call of a batch envelope, returning [status, result] pairs in call order
+def run_batch(node, calls, parallel):
+    if parallel and len(calls) > 1:
+        workers = BATCH_WORKERS if parallel == True else int(parallel)
+        with ThreadPoolExecutor(max_workers=min(len(calls), workers)) as executor:
+            return list(executor.map(lambda call: list(run_command(node, call['command'], call['args'], call['kwargs'])), calls))
+    return [list(run_command(node, call['command'], call['args'], call['kwargs'])) for call in calls]
+
+
+# Run a request, which waited <waited> seconds in a relay mailbox if it came through one. <capabilities> is the
+# X-PeerBase-Capabilities header of a direct request, recorded before the command runs so calls it makes back to the
+# requesting node (such as reading a streamed argument) use the formats that node supports. Returns (status, result, name of the requesting node, seconds the caller may cache the result for or None).
+def process_request(data, node, waited=None, capabilities=None):
+    data, initiator, span = open_request(data, node, waited, capabilities)
+    try:
+        if 'batch' in data.keys():
+            return 200, run_batch(node, data['batch'], data.get('parallel', False)), initiator, None
+        stat, resp = run_command(node, data['command'], data['args'], data['kwargs'])
+        return stat, resp, initiator, result_ttl(node, data['command'], stat, resp)
+    finally:
+        node.end_span(span)
+
+
+# Unpack request <data>, record the requesting node's capabilities and start the server span.
+# Returns (message, name of the requesting node, span).
+def open_request(data, node, waited, capabilities):
+    start = time.perf_counter()
+    data = node.unpack_message(data)
+    initiator = data.get('initiator', '').partition('.')[2]
+    node.record_capabilities(initiator, capabilities)
+    span = node.begin_span(data.get('trace'), start, side='server', peer=initiator, command=data.get('command', 'batch'),
+                           unpack=time.perf_counter() - start, relay_queue=waited)
+    return data, initiator, span
+
+
+# Seconds the caller may cache <command>'s result <resp> for, or None
+def result_ttl(node, command, stat, resp):
+    return node.command_caching.get(command) if stat == 200 and not stream.is_placeholder(resp) else None
 
 
 class LocalServerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive between requests
+    disable_nagle_algorithm = True  # Headers and body are written separately; don't wait on delayed ACKs
+
+    # One handler serves a connection for its lifetime, a request at a time, so it is set up here and run by the server
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.rejecting = False  # Answer the next request with 503 instead of running it
+        self.idle_since = time.time()
+        self.setup()
+
+    def setup(self):
+        self.timeout = self.server.node.pool_idle_timeout  # Drop idle keep-alive connections
+        super().setup()
+
     def do_POST(self):
         node = self.server.node
         content_len = int(self.headers.get('content-length'))
+        binary = self.headers.get('content-type') == wire.CONTENT_TYPE  # Answer in the format we were asked in
 
-        stat, resp = process_request(self.rfile.read(content_len), node)
-
-        self.send_response(stat)
-        self.end_headers()
-        self.wfile.write(node.encode(json.dumps({
-            'timestamp': time.time(),
-            'response': resp
-        })))
-        self.wfile.write(b'\n')
+        if self.rejecting:
+            self.rfile.read(content_len)
+            node.metrics.count('rejected', reason='server')
+            stat, initiator = 503, None
+            body, headers = node.local_response(f'NODE {node.name} BUSY', binary, None, stat)
+        else:
+            stat, resp, initiator, ttl = process_request(self.rfile.read(content_len), node, capabilities=self.headers.get(wire.CAPABILITIES_HEADER))
+            body, headers = node.local_response(resp, binary, initiator, stat, ttl)
+        try:
+            self.send_response(stat)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # The caller stopped waiting (e.g. a straggler in a first=k fan-out)
+            self.close_connection = True
 
     def log_message(self, format, *args):
         pass
 
 
-class LoadedThreadingHTTPServer(http.server.ThreadingHTTPServer):
-    def __init__(self, server_address: typing.Tuple[str, int], RequestHandlerClass: typing.Callable[..., LocalServerHandler], node):
+# HTTP server that runs requests on <workers> threads. Idle keep-alive connections wait in a selector instead of holding a
+# thread. A connection with a request ready joins a queue of at most <queue_size>; when that is full, one more thread
+# answers its request with 503 and a Retry-After hint.
+class WorkerPoolHTTPServer(http.server.HTTPServer):
+    request_queue_size = 128  # Listen backlog, so bursts of new connections are not dropped before they are accepted
+
+    def __init__(self, server_address: typing.Tuple[str, int], RequestHandlerClass: typing.Callable[..., LocalServerHandler], node, workers=32, queue_size=64):
         super().__init__(server_address, RequestHandlerClass)
         self.node = node
+        self.ready = queue.Queue(maxsize=queue_size)  # Handlers with a request to run
+        self.rejects = queue.Queue()  # Handlers with a request to refuse, at most one per open connection
+        self.idle = selectors.DefaultSelector()  # Handlers waiting for their connection's next request
+        self.returned = []  # Handlers to add to <idle>, which only the watcher thread changes
+        self.returned_lock = threading.Lock()
+        self.wakeup = socketpair()
+        self.idle.register(self.wakeup[0], selectors.EVENT_READ)
+        self.closed = False
+        prefix = f'{node.network}.{node.name}.server'
+        self.threads = [threading.Thread(target=self.work, args=[self.ready], name=f'{prefix}.worker[{i}]', daemon=True) for i in range(workers)]
+        self.threads.append(threading.Thread(target=self.work, args=[self.rejects], name=f'{prefix}.rejecter', daemon=True))
+        self.threads.append(threading.Thread(target=self.watch, name=f'{prefix}.watcher', daemon=True))
+        for thread in self.threads:
+            thread.start()
 
+    def process_request(self, request, client_address):  # Called for each accepted connection
+        try:
+            self.keep(self.RequestHandlerClass(request, client_address, self))
+        except OSError:
+            self.shutdown_request(request)
 
-def format_dict(dct, sep='.', start=''):
-    dct = dct.copy()
-    to_ret = []
+    # Wait for the next request on <handler>'s connection
+    def keep(self, handler):
+        handler.idle_since = time.time()
+        with self.returned_lock:
+            self.returned.append(handler)
+        self.wakeup[1].send(b'\x00')
+
+    def close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    # Queue a handler whose connection has a request waiting, or have it refused if the workers are saturated
+    def dispatch(self, handler):
+        try:
+            self.ready.put_nowait(handler)
+            return
+        except queue.Full:
+            pass
+        handler.rejecting = True
+        self.rejects.put(handler)
+
+    def watch(self):
+        while not self.closed:
+            for key, _ in self.idle.select(timeout=1):
+                if key.fileobj is self.wakeup[0]:
+                    self.wakeup[0].recv(4096)
+                    with self.returned_lock:
+                        returned, self.returned = self.returned, []
+                    for handler in returned:
+                        self.idle.register(handler.request, selectors.EVENT_READ, handler)
+                else:
+                    self.idle.unregister(key.fileobj)
+                    self.dispatch(key.data)
+            if self.node.pool_idle_timeout != None:
+                cutoff = time.time() - self.node.pool_idle_timeout
+                for key in list(self.idle.get_map().values()):
+                    if key.data != None and key.data.idle_since < cutoff:
+                        self.idle.unregister(key.fileobj)
+                        self.close(key.data)
+        for key in list(self.idle.get_map().values()):
+            if key.data != None:
+                self.close(key.data)
+        self.idle.close()
+
+    def work(self, handlers):
+        while True:
+            handler = handlers.get()
+            if handler == None:
+                return
+            try:
+                handler.handle_one_request()
+            except OSError:
+                handler.close_connection = True
+            except:
+                traceback.print_exc()
+                handler.close_connection = True
+            handler.rejecting = False
+            if handler.close_connection or self.closed:
+                self.close(handler)
+            else:
+                self.keep(handler)
+
+    def server_close(self):
+        super().server_close()
+        self.closed = True
+        for _ in self.threads:
+            self.rejects.put(None)
+            try:
+                self.ready.put_nowait(None)
+            except queue.Full:  # Workers stop once they have run the queued requests
+                pass
+        self.wakeup[1].send(b'\x00')
+
+
+LoadedThreadingHTTPServer = WorkerPoolHTTPServer  # Former name of the local server, which took (server_address, RequestHandlerClass, node)
+
+
+# Seconds to wait before retrying a request refused with 429, from its Retry-After header
+def retry_after(headers, default=1):
+    try:
+        return max(0.0, float(headers.get('Retry-After', default)))
+    except ValueError:  # HTTP-date form
+        return default
+
+
+# The time <timeout> seconds from now, or None if <timeout> is None (no deadline)
+def deadline_after(timeout):
+    return None if timeout == None else time.time() + timeout
+
+
+# Seconds left before <deadline>, at least <floor>, or None without a deadline
+def time_left(deadline, floor=0):
+    return None if deadline == None else max(floor, deadline - time.time())
+
+
+# Whether waiting <delay> more seconds would pass <deadline>
+def past_deadline(deadline, delay=0):
+    return deadline != None and time.time() + delay > deadline
+
+
+# A fresh id for a relayed packet
+def new_packet_id():
+    return hashlib.sha256(
+        str(time.time() + random.random()).encode('utf-8')).hexdigest()
+
+
+# Flatten a nested command dict into {"path.to.command": function}
+def flatten_dict(dct, sep='.', start=''):
+    to_ret = {}
     for i in dct.keys():
         if type(dct[i]) == dict:
-            to_ret.extend(format_dict(dct[i], sep=sep, start=f'{start}{i}.'))
+            to_ret.update(flatten_dict(dct[i], sep=sep, start=f'{start}{i}{sep}'))
         else:
-            to_ret.append(start+i)
+            to_ret[start+i] = dct[i]
     return to_ret
 
 
+# Deprecated: list the dotted paths of a nested command dict. Use flatten_dict(dct).keys() instead.
+def format_dict(dct, sep='.', start=''):
+    warnings.warn('format_dict is deprecated; use flatten_dict(dct).keys() instead.', DeprecationWarning, stacklevel=2)
+    return list(flatten_dict(dct, start=start).keys())  # Nested levels were always joined with "."
+
+
+# Raise ValueError if <function> cannot run with <execution>
+def check_execution(function, execution):
+    if not execution in EXECUTIONS:
+        raise ValueError(f'Unknown execution {execution}. Use one of {", ".join(EXECUTIONS)}.')
+    if execution != 'inline' and inspect.iscoroutinefunction(function):
+        raise ValueError(f'Coroutine command {function.__name__} runs on the event loop. Register it with execution="inline".')
+    if execution == 'process':
+        try:
+            pickle.dumps(function)
+        except Exception:
+            raise ValueError(f'Command {getattr(function, "__name__", function)} cannot run in a process. Use a function defined at module level.')
+
+
+NO_ANSWER = object()  # Marks a fan-out target that failed to answer
+
+
+# Collects fan-out responses until <first> peers have answered or <quorum> peers have returned the same result
+class FanIn:
+    def __init__(self, first=None, quorum=None, targets=None):
+        self.first = first
+        self.quorum = quorum
+        self.remaining = targets  # Targets yet to respond, if known
+        self.answered = {}
+        self.groups = []  # [[result, {peer: result}], ...] for quorum agreement
+
+    # Record one response. Returns True once enough peers have answered.
+    def add(self, peer, result):
+        if self.remaining != None:
+            self.remaining -= 1
+        if result is NO_ANSWER:
+            return False
+        self.answered[peer] = result
+        if self.quorum != None:
+            for group in self.groups:
+                if group[0] == result:
+                    group[1][peer] = result
+                    break
+            else:
+                group = [result, {peer: result}]
+                self.groups.append(group)
+            return len(group[1]) >= self.quorum
+        return len(self.answered) >= self.first
+
+    def reached(self):
+        if self.quorum != None:
+            return any(len(group[1]) >= self.quorum for group in self.groups)
+        return len(self.answered) >= self.first
+
+    # Whether the targets yet to respond could still make enough answers
+    def reachable(self):
+        if self.remaining == None:
+            return True
+        if self.quorum != None:
+            return max([len(group[1]) for group in self.groups] + [0]) + self.remaining >= self.quorum
+        return len(self.answered) + self.remaining >= self.first
+
+    # The agreeing peers (quorum) or the peers that answered (first). None if no quorum was reached.
+    def result(self):
+        if self.quorum != None:
+            for group in self.groups:
+                if len(group[1]) >= self.quorum:
+                    return group[1]
+            return None
+        return self.answered
+
+
 class Node:
     # Default commands
     def _echo(self, node, args, kwargs):
         return f'Echoed args {str(args)} and kwargs {str(kwargs)} at time [{time.ctime()}]'
 
     def list_methods(self, node, args, kwargs):
-        return format_dict(self.registered_commands)
+        if self.command_list == None:
+            self.command_list = list(self.command_index.keys())
+        return self.command_list
 
     def get_peers(self, node, args, kwargs):
         return self.peers
@@ -84,109 +425,344 @@ class Node:
     # Threaded Loops
     def launch_advertising_loop(self):
         while self.running:
-            data = f'{self.network}.{self.name}|{ip()}:{self.ports["local_server"]}'.encode(
-                'utf-8')
+            self.advertise_wakeup.clear()
             self.advertising_socket.sendto(
-                data, ('<broadcast>', self.ports['local_advertiser']))
-            time.sleep(1)
+                self.advertisement(), ('<broadcast>', self.ports['local_advertiser']))
+            self.advertise_wakeup.wait(self.next_advertise_delay())
         self.advertising_socket.close()
 
-    # Get dict of {peer name: (peer IP, peer port)} for all peers in local network
-    def discover(self, timeout=1.5):
-        s = socket(AF_INET, SOCK_DGRAM)  # create UDP socket
+    def advertisement(self):
+        return f'{self.network}.{self.name}|{ip()}:{self.ports["local_server"]}'.encode('utf-8')
+
+    # Advertise quickly after starting or after a peer joins, backing off to advertise_interval
+    def next_advertise_delay(self):
+        delay = self.advertise_delay
+        self.advertise_delay = min(delay * 2, self.advertise_interval)
+        return delay
+
+    def advertise_soon(self):
+        self.advertise_delay = min(ADVERTISE_FAST, self.advertise_interval)
+        self.advertise_wakeup.set()
+
+    # Parse an advertisement datagram into (peer name, (peer IP, peer port)), or None if it is not from a peer in this network
+    def parse_advertisement(self, data):
+        try:
+            data = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        if data.startswith(self.network+'.'):
+            try:
+                identifier, ip_addr = data.split('|')
+                node_network, node_name = identifier.split('.')
+                node_ip, node_port = ip_addr.split(':')
+                node_port = int(node_port)
+            except ValueError:
+                return None
+            if node_name != self.name:
+                return node_name, (node_ip, node_port)
+        return None
+
+    # Non-blocking UDP socket bound to the advertiser port
+    def bind_discovery_socket(self):
+        s = socket(AF_INET, SOCK_DGRAM)
         s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         s.bind(('', self.ports['local_advertiser']))
-        ct = time.time()
+        s.setblocking(False)
+        return s
+
+    # Drain the advertisements queued on <sock>. Returns a list of (peer name, (peer IP, peer port)).
+    def read_advertisements(self, sock):
+        found = []
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return found
+            parsed = self.parse_advertisement(data)
+            if parsed != None:
+                found.append(parsed)
+
+    # Get dict of {peer name: (peer IP, peer port)} for all peers advertising within <timeout> seconds
+    def discover(self, timeout=1.5):
+        s = self.bind_discovery_socket()
+        selector = selectors.DefaultSelector()
+        selector.register(s, selectors.EVENT_READ)
+        end = time.time() + timeout
         discovered = {}
-        while time.time() < ct+timeout:
-            data, addr = s.recvfrom(1024)
-            data = data.decode('utf-8')
-            if data.startswith(self.network+'.'):
-                try:
-                    identifier, ip_addr = data.split('|')
-                except ValueError:
-                    continue
-                try:
-                    node_network, node_name = identifier.split('.')
-                except ValueError:
-                    continue
-                try:
-                    node_ip, node_port = ip_addr.split(':')
-                except ValueError:
-                    continue
-                if node_name != self.name:
-                    discovered[node_name] = (node_ip, int(node_port))
+        try:
+            while time.time() < end:
+                if len(selector.select(end - time.time())) > 0:
+                    discovered.update(self.read_advertisements(s))
+        finally:
+            selector.close()
+            s.close()
         return discovered
 
     def launch_discovery_loop(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.discovery_socket, selectors.EVENT_READ)
         while self.running:
-            self.peers = self.discover()
+            if len(selector.select(timeout=self.peer_ttl / 4)) > 0:
+                for name, address in self.read_advertisements(self.discovery_socket):
+                    self.saw_peer(name, address)
+            if self.expire_peers():
+                self.prune_pools()
+            self.expire_streams()
+        selector.close()
+        self.discovery_socket.close()
+
+    # Update the peer table from an advertisement by <name>
+    def saw_peer(self, name, address):
+        previous = self.peers.get(name)
+        self.peers[name] = address
+        self.peer_seen[name] = time.time()
+        self.discovered.set()
+        if previous == None:
+            self.advertise_soon()  # Let the newcomer find us without waiting out our interval
+            self.peer_changed('join', name, address)
+        elif previous != address:
+            self.peer_changed('move', name, address)
+
+    # Drop local peers that have not advertised within peer_ttl. Returns True if any were dropped.
+    def expire_peers(self):
+        removed = False
+        cutoff = time.time() - self.peer_ttl
+        for name in list(self.peers.keys()):
+            if self.peer_seen.get(name, 0) < cutoff:
+                address = self.peers.pop(name, None)
+                self.peer_seen.pop(name, None)
+                removed = True
+                self.peer_changed('leave', name, address)
+        return removed
+
+    # Register callback(event, peer name, (peer IP, peer port)), called on "join", "move" and "leave" of local peers
+    def on_peer_change(self, callback):
+        self.peer_callbacks.append(callback)
+        return callback
+
+    def peer_changed(self, event, name, address):
+        self.metrics.count('peer_events', event=event, scope='local')
+        for callback in list(self.peer_callbacks):
+            try:
+                callback(event, name, address)
+            except:
+                traceback.print_exc()
+
+    # Addresses of every peer and relay that is currently known
+    def live_addresses(self):
+        live = {f'{p[0]}:{p[1]}' for p in list(self.peers.values())}
+        if self.features['remote']:
+            live.update(list(self.server_info.keys()))
+            for routes in list(self.remote_peers.values()):
+                live.update(routes)
+        return live
 
+    # Close pooled sessions for peers and relays that are no longer known
+    def prune_pools(self):
+        self.pool.prune(self.live_addresses())
+
+    # Run a request delivered through a relay and send the result back to its originator
     def process_single_buffer(self, pid, buffer_data):
-        stat, resp = process_request(buffer_data['data'], self)
+        stat, resp, initiator, ttl = process_request(buffer_data['data'], self, buffer_data.get('waited'))
         try:
-            resp = requests.post(
-                url=f'http://{buffer_data["remote"]}/send/',
-                json={
-                    'target': buffer_data['originator'],
-                    'data': self.encode(json.dumps({
-                        'status': stat,
-                        'result': resp
-                    })).decode('utf-8'),
-                    'packet_id': pid,
-                    'originator': self.name,
-                    'r_type': 'response',
-                    'remote_addr': buffer_data['remote']
-                }
-            )
-        except ConnectionError:
+            self.relay_deliver(buffer_data['remote'],
+                               self.response_packet(pid, buffer_data, stat, resp, ttl), RESPONSE_RETRY_WINDOW)
+        except (requests.ConnectionError, requests.Timeout):
             pass
 
+    def response_packet(self, pid, buffer_data, stat, resp, ttl=None):
+        message = {
+            'status': stat,
+            'result': resp
+        }
+        if ttl != None:
+            message['ttl'] = ttl
+        return {
+            'target': buffer_data['originator'],
+            'data': self.pack_message(message, binary=self.supports(buffer_data['originator'], wire.CAPABILITY), peer=buffer_data['originator']),
+            'packet_id': pid,
+            'originator': self.name,
+            'r_type': 'response',
+            'remote_addr': buffer_data['remote']
+        }
+
+    # Build the (path, body, headers) of a /send (or /multicast) request, as raw bytes if the relay speaks the binary format
+    def relay_request(self, relay, packet, path='send'):
+        if self.features['remote'] and self.server_info.get(relay, {}).get('binary', False):
+            return f'{path}/bin', wire.dumps(packet), {'Content-Type': wire.CONTENT_TYPE}
+        packet = packet.copy()
+        packet['data'] = wire.to_legacy(packet['data'])
+        return path, json.dumps(packet).encode('utf-8'), {'Content-Type': 'application/json'}
+
+    def relay_send(self, relay, packet, timeout=None):
+        path, body, headers = self.relay_request(relay, packet)
+        start = time.time()
+        try:
+            resp = self.pool.post(relay, path, data=body, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            self.route_stats.observe(relay, error=True)
+            raise
+        self.route_stats.observe(relay, rtt=time.time() - start)
+        return resp
+
+    # Send a packet through a relay, waiting out backpressure (429) for up to <timeout> seconds. Returns the last response.
+    def relay_deliver(self, relay, packet, timeout):
+        deadline = deadline_after(timeout)
+        while True:
+            resp = self.relay_send(relay, packet, timeout=time_left(deadline, 0.01))
+            if resp.status_code != 429:
+                return resp
+            delay = retry_after(resp.headers)
+            if past_deadline(deadline, delay):
+                return resp
+            time.sleep(delay)
+
+    # Build the (path, body, headers) of a keepalive request to <target>
+    def ping_request(self, target, long_poll):
+        session = self.server_info[target]
+        known_servers = list(self.server_info.keys())
+        if session['membership'] != None:  # Only tell a versioned relay about relays it has not listed yet
+            known_servers = [s for s in known_servers if not s in session['servers']]
+        body = {
+            'node_name': self.name,
+            'node_network': self.network,
+            'known_servers': known_servers,
+            'wait': self.long_poll if long_poll else 0,
+            'capabilities': list(self.capabilities)
+        }
+        if session['membership'] != None:
+            body['membership'] = session['membership']
+        if self.server_info[target]['binary']:
+            return 'ping/bin', wire.dumps(body), {'Content-Type': wire.CONTENT_TYPE}
+        return 'ping', json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'}
+
+    # Apply a keepalive response from <target>: update remote peers and relays, and complete waiting remote requests.
+    # Returns (whether the relay long-polls, {packet id: buffered request to run}).
+    def handle_ping(self, target, content):
+        if self.server_info[target]['binary']:
+            dat = wire.loads(content)
+        else:
+            dat = json.loads(content)
+        self.server_info[target]['active'] = True
+        self.server_info[target]['binary'] = wire.CAPABILITY in dat.get(
+            'relay_capabilities', [])
+        self.server_info[target]['capabilities'] = set(dat.get('relay_capabilities', []))
+        self.apply_membership(target, dat)
+        if not FEDERATION_CAPABILITY in dat.get('relay_capabilities', []):  # A federated relay already routes to peers on other relays
+            for s in list(self.server_info[target]['servers']):
+                if not s in self.server_info.keys() and len(self.server_info.keys()) < self.max_remotes:
+                    self.open_session(s)
+
+        incoming = {}
+        for b in dat['buffer'].keys():
+            if dat['buffer'][b].get('waited') != None:
+                self.metrics.observe('relay_queue_seconds', dat['buffer'][b]['waited'])
+            if dat['buffer'][b]['type'] == 'response':
+                # Responses to requests that already timed out (or were answered over another route) have no waiter and are dropped.
+                # Copies of a multicast carry the packet id <pid>:<target>.
+                waiter = self.remote_buffer.get((b.partition(':')[0], dat['buffer'][b]['originator']), None)
+                if waiter != None and not waiter.done():
+                    waiter.set_result(dat['buffer'][b])
+            elif self.first_delivery(b):
+                incoming[b] = dict(dat['buffer'][b], remote=target)  # Answer through the relay that delivered it, which this node has a session with
+        return self.long_poll > 0 and dat.get('long_poll', False), incoming
+
+    # Update routes through <target> from a keepalive response: full peer and relay lists, or the joins and leaves
+    # since the membership version this node last saw (relays that track versions send deltas once a node has one)
+    def apply_membership(self, target, dat):
+        session = self.server_info[target]
+        if 'peers' in dat:
+            joined = {i: dat.get('peer_capabilities', {}).get(i) for i in dat['peers']}
+            left = [i for i in list(self.remote_peers.keys()) if not i in joined.keys()]
+            session['servers'] = set(dat['servers'])
+        else:
+            joined, left = dat['joined'], dat['left']
+            session['servers'].update(dat['servers_added'])
+            session['servers'].difference_update(dat['servers_removed'])
+        for i in left:
+            self.remove_route(i, target)
+        for i, caps in joined.items():
+            if caps:
+                self.peer_capabilities[i] = set(caps)
+            if not i == self.name:
+                if not i in self.remote_peers.keys():
+                    self.metrics.count('peer_events', event='join', scope='remote')
+                self.remote_peers.setdefault(i, set()).add(target)
+        session['membership'] = dat.get('membership')
+
+    # True the first time request <pid> arrives; hedged copies of it that come in through other relays are skipped
+    def first_delivery(self, pid):
+        now = time.time()
+        if len(self.handled_packets) > 1024:
+            for k, (t, _) in list(self.handled_packets.items()):
+                if t < now - DEDUP_WINDOW:
+                    self.handled_packets.pop(k, None)
+        marker = (now, object())  # New on every call, so only the call that stored it finds it there
+        return self.handled_packets.setdefault(pid, marker) is marker
+
+    def remove_route(self, peer, relay):
+        routes = self.remote_peers.get(peer)
+        if routes != None:
+            routes.discard(relay)
+            if len(routes) == 0:
+                self.remote_peers.pop(peer, None)
+                self.metrics.count('peer_events', event='leave', scope='remote')
+
+    def new_session(self, server, maintain):
+        return {
+            'maintain': maintain,
+            'active': True,
+            'servers': set(),  # Relays this relay has listed
+            'membership': None,  # [epoch, version] of the last membership this relay sent
+            'binary': False,
+            'capabilities': set(),  # Capabilities the relay reported
+            'thread': threading.Thread(target=self.remote_keepalive_loop, args=[server], name=f'{self.network}.{self.name}.remote_keepalive[{server}]', daemon=True)
+        }
+
+    # Start keeping a relay discovered through another relay alive
+    def open_session(self, server):
+        self.server_info[server] = self.new_session(server, False)
+        self.server_info[server]['thread'].start()
+
+    # Forget an unreachable relay and every route through it
+    def drop_session(self, target):
+        del self.server_info[target]
+        for k in list(self.remote_peers.keys()):
+            self.remove_route(k, target)
+        self.route_stats.forget(target)
+        self.pool.discard(target)
+
     def remote_keepalive_loop(self, target):
+        long_poll = False  # Set once the relay confirms it can hold /ping open
         while self.running:
+            self.expire_streams()  # Nodes without local discovery have no other periodic loop
             try:
-                resp = requests.post(f'http://{target}/ping/', json={
-                    'node_name': self.name,
-                    'node_network': self.network,
-                    'known_servers': list(self.server_info.keys())
-                })
-                dat = resp.json()
-                for i in dat['peers']:
-                    if not i == self.name:
-                        if not i in self.remote_peers.keys():
-                            self.remote_peers[i] = {target}
-                        else:
-                            self.remote_peers[i].add(target)
-
-                for s in dat['servers']:
-                    if not s in self.server_info.keys() and len(self.server_info.keys()) < self.max_remotes:
-                        self.server_info[s] = {
-                            'maintain': False,
-                            'active': True,
-                            'peers': set(),
-                            'thread': threading.Thread(target=self.remote_keepalive_loop, args=[s], name=f'{self.network}.{self.name}.remote_keepalive[{s}]', daemon=True)
-                        }
-                        self.server_info[s]['thread'].start()
-
-                for b in dat['buffer'].keys():
-                    if dat['buffer'][b]['type'] == 'response':
-                        self.remote_buffer[b] = dat['buffer'][b]
-                    else:
-                        threading.Thread(target=self.process_single_buffer, args=[
-                                         b, dat['buffer'][b]], name=f'{self.network}.{self.name}.process_request[{b}]', daemon=True).start()
-            except requests.ConnectionError:
+                path, body, headers = self.ping_request(target, long_poll)
+                start = time.time()
+                resp = self.pool.post(target, path, data=body,
+                                      headers=headers, timeout=self.long_poll + 10)
+                if resp.status_code != 200:
+                    raise requests.ConnectionError
+                if not long_poll:  # A held long-poll says nothing about latency
+                    self.route_stats.observe(target, rtt=time.time() - start)
+                self.metrics.count('keepalives', relay=target)
+                long_poll, incoming = self.handle_ping(target, resp.content)
+                for b in incoming.keys():
+                    threading.Thread(target=self.process_single_buffer, args=[
+                                     b, incoming[b]], name=f'{self.network}.{self.name}.process_request[{b}]', daemon=True).start()
+            except (requests.ConnectionError, requests.Timeout):
+                long_poll = False
+                self.route_stats.observe(target, error=True)
+                self.metrics.count('keepalive_errors', relay=target)
                 self.server_info[target]['active'] = False
                 if not self.server_info[target]['maintain']:
-                    del self.server_info[target]
-                    for k in list(self.remote_peers.keys()):
-                        if target in self.remote_peers[k]:
-                            self.remote_peers[k].remove(target)
+                    self.drop_session(target)
                     return
 
-            if self.server_info[target]['active']:
-                time.sleep(self.keepalive_tick)
-            else:
+            if not self.server_info[target]['active']:
                 time.sleep(30)
+            elif not long_poll:
+                time.sleep(self.keepalive_tick)
 
     def __init__(
         self,
@@ -198,7 +774,28 @@ class Node:
         registered_commands={},
         use_local=True,
         keepalive_tick=0.25,
-        max_remotes=None
+        max_remotes=None,
+        pool_size=4,
+        pool_idle_timeout=30,
+        long_poll=10,
+        peer_ttl=3,
+        advertise_interval=1,
+        hedge=False,
+        hedge_percentile=95,
+        compression=['zstd', 'zlib'],
+        compression_threshold=compress.DEFAULT_THRESHOLD,
+        cipher='aes-gcm',
+        trace=None,
+        server_workers=32,
+        server_queue=64,
+        command_limits={},
+        command_threads=8,
+        command_processes=None,
+        cache_size=1024,
+        memo_size=1024,
+        stream_chunk=stream.CHUNK_SIZE,
+        stream_window=stream.WINDOW,
+        stream_timeout=stream.TIMEOUT
     ):
         '''
         name: Name of node in network (cannot contain ".", "|", or ":")
@@ -207,10 +804,32 @@ class Node:
         ports: [local server port, local UDP advertiser port]
         servers: address or list of addresses of remote middleman servers
         registered_commands: dict (may be nested to have sub/sub-sub/etc commands) of command names related to functions.
-            Reserved names in top-level tree: __echo__, __list_commands__, __peers__
+            Reserved names in top-level tree: __echo__, __list_commands__, __peers__, __metrics__, __stream__
         use_local: boolean, make local connections/do not make local connections
         keepalive_tick: time between keepalive requests
         max_remotes: max number of remotes to connect to at one time. Must be >= len(servers), or None to remove the limit.
+        pool_size: max number of keep-alive connections kept open to each peer/relay
+        pool_idle_timeout: seconds a pooled connection may stay idle before it is closed, or None to keep them open
+        long_poll: seconds a relay may hold a keepalive request open waiting for packets, or 0 to poll every keepalive_tick
+        peer_ttl: seconds without an advertisement before a local peer is dropped. Must be > advertise_interval.
+        advertise_interval: steady-state seconds between local advertisements
+        hedge: send a duplicate of a relayed request over the next-best relay if the best one has not answered in time
+        hedge_percentile: percentile of a route's recent round trips to wait for before hedging
+        compression: codecs to compress messages with, best first ("zstd", "zlib", "lzma"), or None to send them uncompressed
+        compression_threshold: smallest message in bytes that is compressed
+        cipher: "aes-gcm" or "chacha20" to seal messages to peers that support it with per-session keys, or "fernet" to always use Fernet
+        trace: function called with a dict of stage timings (pack, unpack, handler, relay_queue, seconds) for each request this node
+            sends or serves, or None. Trace ids travel with messages so both sides of a request can be joined.
+        server_workers: number of requests the local server runs at once
+        server_queue: max number of requests waiting for a worker. Requests beyond it are refused with 503 and retried by the sender.
+        command_limits: dict of command paths to the max number of calls of that command run at once. Calls beyond it get 503.
+        command_threads: size of the thread pool that runs commands registered with execution="thread"
+        command_processes: size of the process pool that runs commands registered with execution="process", or None for one per CPU
+        cache_size: max number of results of cacheable commands this node keeps from peers, or 0 to always ask them
+        memo_size: max number of results of this node's cacheable commands it keeps, or 0 to always run them
+        stream_chunk: bytes per chunk of the file-like objects and iterators this node streams as arguments or results
+        stream_window: max number of chunks of a stream in flight, which bounds the memory a transfer takes to window * chunk
+        stream_timeout: seconds a chunk may take to arrive, and a stream this node sends is kept without being read
         '''
 
         if '.' in name or '|' in name or ':' in name:
@@ -221,14 +840,25 @@ class Node:
                 f'Network name {network} contains reserved characters (".","|", or ":").')
         if len(ports) != 2:
             raise ValueError('The list of ports to use must contain 2 values.')
+        if peer_ttl <= advertise_interval:
+            raise ValueError('peer_ttl must be greater than advertise_interval.')
+        if cipher != 'fernet' and not cipher in crypto.CIPHERS.keys():
+            raise ValueError(f'Unknown cipher {cipher}. Use "fernet", "aes-gcm" or "chacha20".')
         self.network = network
         self.name = name
         self.crypt = Fernet(network_key.encode('utf-8'))
+        self.cipher = cipher
+        self.session_crypto = SessionCrypto(network, name, network_key, 'aes-gcm' if cipher == 'fernet' else cipher)  # Opens AEAD frames in any mode
         self.ports = {
             'local_server': ports[0],
             'local_advertiser': ports[1]
         }
         self.features = {}
+        self.capabilities = {wire.CAPABILITY, BATCH_CAPABILITY} | compress.CAPABILITIES  # Optional protocol features this node understands
+        if cipher != 'fernet':  # Only the node's own cipher: a peer that seals with another one falls back to Fernet
+            self.capabilities.add(crypto.capability(cipher))
+        self.compressor = Compressor(compression, compression_threshold)
+        self.peer_capabilities = {}  # {peer name: set of capabilities}, learned from peers and relays
         if servers == None:
             self.features['remote'] = False
             print(
@@ -241,13 +871,9 @@ class Node:
             if max_remotes != None and max_remotes < len(servers):
                 raise ValueError(
                     'max_remotes cannot be less than the number of servers provided.')
-            self.server_info = {s: {
-                'maintain': True,
-                'active': True,
-                'peers': set(),
-                'thread': threading.Thread(target=self.remote_keepalive_loop, args=[s], name=f'{self.network}.{self.name}.remote_keepalive[{s}]', daemon=True)
-            } for s in servers}
-            self.remote_buffer = {}
+            self.server_info = {s: self.new_session(
+                s, True) for s in servers}
+            self.remote_buffer = {}  # {(packet id, target): Future} of remote requests awaiting a response
         self.features['local'] = bool(use_local)
 
         if not self.features['remote'] and not self.features['local']:
@@ -265,16 +891,237 @@ class Node:
         self.advertising_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
         self.advertising_thread = threading.Thread(
             target=self.launch_advertising_loop, name=f'{self.network}.{self.name}.advertiser', daemon=True)
-        self.peers = {}
-        self.remote_peers = {}
+        self.advertise_interval = advertise_interval
+        self.advertise_delay = min(ADVERTISE_FAST, advertise_interval)
+        self.advertise_wakeup = threading.Event()  # Set to advertise immediately
+        self.peers = {}  # {peer name: (peer IP, peer port)}, updated in place by the discovery loop
+        self.peer_seen = {}  # {peer name: time of last advertisement}
+        self.peer_ttl = peer_ttl
+        self.peer_callbacks = []
+        self.discovered = threading.Event()  # Set once the first local peer has been seen
+        self.discovery_socket = None
+        self.remote_peers = {}  # {peer name: set of relays it can be reached through}
+        self.route_stats = RouteStats()  # RTT and error estimates per relay and per (peer, relay) route
+        self.metrics = Metrics()  # Counters and latency histograms, read with the __metrics__ command
+        self.metrics.register('peers', lambda: len(self.peers))
+        self.metrics.register('remote_peers', lambda: len(self.remote_peers))
+        self.metrics.register('remote_buffer', lambda: len(self.remote_buffer or {}))  # Remote requests awaiting a response
+        self.metrics.add('outstanding_requests', 0)
+        self.trace = trace
+        self.server_workers = server_workers
+        self.server_queue = server_queue
+        self.command_limits = {k: threading.BoundedSemaphore(v) for k, v in command_limits.items()}
+        self.command_threads = command_threads
+        self.command_processes = command_processes
+        self.command_executions = {}  # {dotted path: "thread" or "process"} of commands that do not run inline
+        self.executors = {}  # {"thread" or "process": executor}, created on first use
+        self.executors_lock = threading.Lock()
+        self.command_caching = {'__list_commands__': 5, '__peers__': 1}  # {dotted path: seconds its results may be cached for}
+        self.memo = TTLCache(memo_size)  # {(command path, arguments key): result} of commands this node ran
+        self.result_cache = TTLCache(cache_size)  # {(peer, command path, arguments key): result} of commands peers ran
+        self.metrics.register('cache_hits', lambda: {'client': self.result_cache.counts['hits'], 'server': self.memo.counts['hits']}, label='cache', kind='counter')
+        self.metrics.register('cache_misses', lambda: {'client': self.result_cache.counts['misses'], 'server': self.memo.counts['misses']}, label='cache', kind='counter')
+        self.metrics.register('cache_entries', lambda: {'client': len(self.result_cache.entries), 'server': len(self.memo.entries)}, label='cache')
+        self.streams = {}  # {stream id: stream.Outgoing} of file-like objects and iterators sent to peers
+        self.stream_chunk = stream_chunk
+        self.stream_window = stream_window
+        self.stream_timeout = stream_timeout
+        self.metrics.register('streams', lambda: len(self.streams))
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.handled_packets = {}  # {packet id: (time, marker)} of relayed requests already run
         self.keepalive_tick = keepalive_tick
+        self.long_poll = long_poll or 0
         self.discovery_thread = threading.Thread(
             target=self.launch_discovery_loop, name=f'{self.network}.{self.name}.discoverer', daemon=True)
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pool = SessionPool(pool_size=pool_size,
+                                idle_timeout=pool_idle_timeout)
 
         self.registered_commands = registered_commands.copy()
         self.registered_commands['__echo__'] = self._echo
         self.registered_commands['__list_commands__'] = self.list_methods
         self.registered_commands['__peers__'] = self.get_peers
+        self.registered_commands['__metrics__'] = self.get_metrics
+        self.registered_commands['__stream__'] = self.serve_stream
+        self.command_index = flatten_dict(self.registered_commands)  # {dotted path: function}, kept in step with registered_commands
+        self.command_list = None  # Cached __list_commands__ result
+
+    def seal(self, data, peer=None, multicast=False):  # Recieves raw bytes, returns raw encrypted bytes (AEAD if <peer> supports our cipher)
+        if peer != None and self.uses_aead(peer):
+            return self.session_crypto.seal(data, peer, multicast)
+        return base64.urlsafe_b64decode(self.crypt.encrypt(data))
+
+    def unseal(self, data):  # Recieves raw encrypted bytes, returns raw bytes
+        if crypto.is_aead(data):
+            return self.session_crypto.unseal(data)
+        return self.crypt.decrypt(base64.urlsafe_b64encode(data))
+
+    def uses_aead(self, peer):
+        return self.cipher != 'fernet' and self.supports(peer, crypto.capability(self.cipher))
+
+    # Encrypt a message dict, serialized in the binary wire format or as legacy JSON and compressed if <peer> can decompress it.
+    # A <multicast> message is sealed once for every peer that shares <peer>'s capabilities. Returns raw encrypted bytes.
+    def pack_message(self, message, binary=False, peer=None, multicast=False):
+        start = time.perf_counter()
+        data = None
+        if not binary:
+            try:
+                data = json.dumps(message).encode('utf-8')
+            except TypeError:  # Bytes (such as a stream chunk) only travel in the binary format, which every reader understands
+                pass
+        if data == None:
+            data = wire.dumps(message)
+        if peer != None:
+            data = self.compressor.compress(data, self.peer_capabilities.get(peer, ()))
+        data = self.seal(data, peer, multicast)
+        self.record_codec('pack', start, len(data))
+        return data
+
+    # Decrypt a message in either transport form (raw bytes or legacy base64 text), compressed or not, and either serialization
+    def unpack_message(self, data):
+        start = time.perf_counter()
+        message = wire.loads(self.compressor.decompress(self.unseal(wire.to_raw(data))))
+        self.record_codec('unpack', start, len(data))
+        return message
+
+    def supports(self, peer, capability):
+        return capability in self.peer_capabilities.get(peer, ())
+
+    # Record the capabilities a peer reported in its X-PeerBase-Capabilities header
+    def record_capabilities(self, peer, header):
+        if header != None:
+            self.peer_capabilities[peer] = set(
+                c for c in header.split(',') if c)
+
+    # Metrics and tracing
+    def get_metrics(self, node, args, kwargs):
+        return dict(self.metrics.snapshot(), compression=self.compressor.stats(), routes=self.route_stats.snapshot(),
+                    cache={'client': self.result_cache.stats(), 'server': self.memo.stats()})
+
+    def record_handler(self, command, stat, elapsed):
+        self.metrics.observe('handler_seconds', elapsed, command=command if stat != 404 else '<unknown>')
+        self.metrics.count('commands', command=command if stat != 404 else '<unknown>', status=stat)
+        self.span_add('handler', elapsed)
+
+    # Record the time and size of packing ("pack") or unpacking ("unpack") one message that started at <start>
+    def record_codec(self, stage, start, size):
+        elapsed = time.perf_counter() - start
+        self.metrics.observe(f'{stage}_seconds', elapsed)
+        self.metrics.count('message_bytes', size, direction='out' if stage == 'pack' else 'in')
+        self.span_add(stage, elapsed)
+
+    # Start timing the request with trace id <trace_id> in this thread or task, if a trace hook is set. Returns a token for end_span.
+    def begin_span(self, trace_id, start=None, **fields):
+        if self.trace == None or trace_id == None:
+            return None
+        span = {k: v for k, v in fields.items() if v != None}
+        return SPAN.set(dict(span, trace=trace_id, node=self.name, start=start or time.perf_counter()))
+
+    def span_add(self, stage, seconds):
+        span = SPAN.get()
+        if span != None:
+            span[stage] = span.get(stage, 0) + seconds
+
+    # Finish the span begun with <token> and pass it to the trace hook
+    def end_span(self, token, **fields):
+        if token == None:
+            return
+        span = SPAN.get()
+        SPAN.reset(token)
+        span.update(fields)
+        span['seconds'] = time.perf_counter() - span.pop('start')
+        try:
+            self.trace(span)
+        except:
+            traceback.print_exc()
+
+    def command_message(self, command_path, args, kwargs):
+        args, kwargs = self.offer_arguments(args, kwargs)
+        message = {
+            'timestamp': time.time(),
+            'command': command_path,
+            'args': args,
+            'kwargs': kwargs,
+            'initiator': f'{self.network}.{self.name}'
+        }
+        if self.trace != None:
+            message['trace'] = random.getrandbits(64).to_bytes(8, 'big').hex()
+        return message
+
+    # Normalize a (command_path[, args[, kwargs]]) tuple into a batch call
+    def batch_call(self, call):
+        args, kwargs = self.offer_arguments(call[1] if len(call) > 1 else [], call[2] if len(call) > 2 else {})
+        return {
+            'command': call[0],
+            'args': args,
+            'kwargs': kwargs
+        }
+
+    def batch_message(self, calls, parallel):
+        message = {
+            'timestamp': time.time(),
+            'batch': calls,
+            'parallel': parallel,
+            'initiator': f'{self.network}.{self.name}'
+        }
+        if self.trace != None:
+            message['trace'] = random.getrandbits(64).to_bytes(8, 'big').hex()
+        return message
+
+    # Unpack the [status, result] pairs of a batch response into results, None for failed calls
+    def batch_results(self, resp, count):
+        if resp == None:
+            return [None] * count
+        results = []
+        for stat, result in resp:
+            if stat == 200:
+                results.append(self.accept_stream(result))
+            else:
+                results.append(None)
+                print(
+                    f'Encountered error with status {str(stat)}:\n{result}')
+        return results
+
+    # Build the (body, headers) of a direct request to local peer <target>
+    def local_request(self, target, message):
+        if self.supports(target, wire.CAPABILITY):
+            return self.pack_message(message, binary=True, peer=target), {'Content-Type': wire.CONTENT_TYPE, wire.CAPABILITIES_HEADER: ','.join(self.capabilities)}
+        return self.encode(json.dumps(message)), {wire.CAPABILITIES_HEADER: ','.join(self.capabilities)}
+
+    # Build the (body, headers) answering a direct request with status <stat>, in the format the request used, or in the
+    # binary format if the result holds bytes (such as a stream chunk) that JSON cannot carry. A result the caller may cache
+    # carries its <ttl>.
+    def local_response(self, resp, binary, peer=None, stat=200, ttl=None):
+        message = {
+            'timestamp': time.time(),
+            'response': resp
+        }
+        if ttl != None:
+            message['ttl'] = ttl
+        headers = {wire.CAPABILITIES_HEADER: ','.join(self.capabilities)}
+        if stat == 503:
+            headers['Retry-After'] = str(BUSY_RETRY)
+        if not binary:
+            try:
+                body = self.encode(json.dumps(message)) + b'\n'
+            except TypeError:
+                binary = True
+        if binary:
+            body = self.pack_message(message, binary=True, peer=peer)
+            headers['Content-Type'] = wire.CONTENT_TYPE
+        headers['Content-Length'] = str(len(body))
+        return body, headers
+
+    def request_packet(self, target, remote_target, pid, message):
+        return {
+            'target': target,
+            'data': self.pack_message(message, binary=self.supports(target, wire.CAPABILITY), peer=target),
+            'packet_id': pid,
+            'originator': self.name,
+            'r_type': 'request',
+            'remote_addr': remote_target
+        }
 
     def decode(self, data):  # Recieves encrypted data in base64, returns string of data
         if type(data) == bytes:
@@ -283,14 +1130,17 @@ class Node:
         return self.crypt.decrypt(decoded_b64).decode('utf-8')
 
     def encode(self, data):  # Recieves raw string data, returns base64-encoded encrypted data
-        encrypted = self.crypt.encrypt(data.encode('utf-8'))
-        return base64.urlsafe_b64encode(encrypted)
+        start = time.perf_counter()
+        encrypted = base64.urlsafe_b64encode(self.crypt.encrypt(data.encode('utf-8')))
+        self.record_codec('pack', start, len(encrypted))
+        return encrypted
 
     def start(self):  # Start the node. This method is blocking.
         self.running = True
         if self.features['local']:
-            self.local_server = LoadedThreadingHTTPServer(
-                (ip(), self.ports['local_server']), LocalServerHandler, self)
+            self.local_server = WorkerPoolHTTPServer(
+                (ip(), self.ports['local_server']), LocalServerHandler, self, self.server_workers, self.server_queue)
+            self.discovery_socket = self.bind_discovery_socket()
             self.advertising_thread.start()
             self.discovery_thread.start()
         if self.features['remote']:
@@ -299,162 +1149,591 @@ class Node:
         if self.features['local']:
             self.local_server.serve_forever()
 
-    # Start the Node in a separate thread
-    def start_multithreaded(self, thread_name=None, thread_group=None):
+    # Start the Node in a separate thread. Returns once a local peer has been seen or <discovery_timeout> has passed.
+    def start_multithreaded(self, thread_name=None, thread_group=None, discovery_timeout=1.5):
         proc = threading.Thread(
             name=thread_name, target=self.start, group=thread_group, daemon=True)
         proc.start()
         if self.features['local']:
-            self.peers = self.discover()
+            self.discovered.wait(discovery_timeout)
         return proc
 
-    def _command_one(self, command_path, args, kwargs, target, raise_errors, timeout):
-        ret = None
+    def _command_one(self, command_path, args, kwargs, target, raise_errors, timeout, failed=None):
+        return self._request_one(target, self.command_message(command_path, args, kwargs), raise_errors, timeout, failed)
+
+    # Deliver one message to <target> and return the response, or <failed> if there was none, recording its latency
+    def _request_one(self, target, message, raise_errors, timeout, failed=None):
+        path = 'local' if target in self.peers.keys() and self.features['local'] else 'relay'
+        start = time.perf_counter()
+        span = self.begin_span(message.get('trace'), start, side='client', peer=target, command=message.get('command', 'batch'))
+        self.metrics.add('outstanding_requests', 1)
+        try:
+            ret = self._route_request(target, message, raise_errors, timeout, failed)
+            return self.accept_stream(ret) if 'command' in message.keys() else ret
+        except:
+            self.metrics.count('request_errors', path=path)
+            raise
+        finally:
+            self.metrics.add('outstanding_requests', -1)
+            self.metrics.observe('request_seconds', time.perf_counter() - start, path=path)
+            self.end_span(span, path=path)
+
+    # The direct LAN route is preferred; relays are used if the peer is not on the LAN or cannot be reached there.
+    def _route_request(self, target, message, raise_errors, timeout, failed=None):
         i = target
+        remote = self.features['remote'] and len(self.remote_peers.get(i, ())) > 0
         if i in self.peers.keys() and self.features['local']:
-            '''if raise_errors:
-                raise LookupError(
-                    f'Could not find target {i} in peers. Available peers: {str(len(self.peers.keys()))}')
-            else:
-                continue'''
             try:
-                resp = requests.post(
-                    url=f'http://{self.peers[i][0]}:{self.peers[i][1]}',
-                    data=self.encode(json.dumps({
-                        'timestamp': time.time(),
-                        'command': command_path,
-                        'args': args,
-                        'kwargs': kwargs,
-                        'initiator': f'{self.network}.{self.name}'
-                    })),
-                    timeout=timeout
-                )
-            except requests.Timeout:
-                if raise_errors:
-                    raise TimeoutError(
-                        f'Attempt to reach peer {i} timed out after {str(timeout)} seconds.')
-                else:
-                    ret = None
-            if resp.status_code == 200:
-                ret = json.loads(self.decode(resp.text))[
-                    'response']
-            else:
-                ret = None
-                print(
-                    f'Encountered error with status {str(resp.status_code)}:\n{json.loads(self.decode(resp.text))["response"]}')
-        elif i in self.remote_peers.keys() and self.features['remote']:
-            while len(self.remote_peers[i]) > 0 and ret == None:
-                remote_target = random.choice(list(self.remote_peers[i]))
-                pid = hashlib.sha256(
-                    str(time.time() + random.random()).encode('utf-8')).hexdigest()
+                resp = self.local_deliver(i, message, timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if remote:
+                    return self._request_remote(i, message, raise_errors, timeout, failed)
+                return self.unreachable(i, isinstance(e, requests.Timeout), raise_errors, timeout, failed)
+            return self.local_result(i, message, resp.status_code, resp.content, failed)
+        elif remote:
+            return self._request_remote(i, message, raise_errors, timeout, failed)
+        return self.unknown_target(i, raise_errors, failed)
+
+    # The result of LAN peer <i>'s answer to <message>: its response, or <failed> if it ran into an error
+    def local_result(self, i, message, status, content, failed=None):
+        res = self.unpack_message(content)
+        if status != 200:
+            print(
+                f'Encountered error with status {str(status)}:\n{res["response"]}')
+            return failed
+        self.remember(i, message, res['response'], res.get('ttl'))
+        return res['response']
+
+    # The result for <i> when it is neither on the LAN nor behind a relay: <failed>, unless <raise_errors>
+    def unknown_target(self, i, raise_errors, failed=None):
+        if raise_errors:
+            raise LookupError(
+                f'Could not find target {i} in remote peers. Available peers: {str(len(self.remote_peers.keys()))}')
+        return failed
+
+    # The result for LAN peer <i> that could not be reached and has no relay route: <failed>, unless <raise_errors>
+    def unreachable(self, i, timed_out, raise_errors, timeout, failed=None):
+        if not raise_errors:
+            return failed
+        if timed_out:
+            raise TimeoutError(
+                f'Attempt to reach peer {i} timed out after {str(timeout)} seconds.')
+        raise ConnectionError(
+            f'Could not connect to peer {i}.')
+
+    # Post <message> to local peer <i>, waiting out overload (503) for up to <timeout> seconds. Returns the last response.
+    def local_deliver(self, i, message, timeout):
+        address = f'{self.peers[i][0]}:{self.peers[i][1]}'
+        deadline = deadline_after(timeout)
+        while True:
+            body, headers = self.local_request(i, message)
+            resp = self.pool.post(address, data=body, headers=headers, timeout=time_left(deadline, 0.01))
+            self.record_capabilities(
+                i, resp.headers.get(wire.CAPABILITIES_HEADER))
+            if resp.status_code != 503 or not 'Retry-After' in resp.headers.keys():
+                return resp
+            delay = retry_after(resp.headers)
+            if past_deadline(deadline, delay):
+                return resp
+            time.sleep(delay)
+
+    # Send a message to remote peer <i> over its relays, best route first. Without hedging each route gets <timeout> to answer
+    # before the next is tried. With hedging, a copy with the same packet id goes out on the next route once the current one
+    # has taken longer than its hedge delay, and all copies share the first one's <timeout>; the peer runs the request once.
+    def _request_remote(self, i, message, raise_errors, timeout, failed=None):
+        routes = self.route_stats.rank(i, list(self.remote_peers.get(i, ())))
+        pid = new_packet_id()
+        waiter = Future()
+        self.remote_buffer[(pid, i)] = waiter
+        sent = {}  # {relay: time the request went out through it}
+        busy = False  # A relay is up but the target's mailbox stayed full
+        deadline = deadline_after(timeout)
+        try:
+            for n, remote_target in enumerate(routes):
+                start = time.time()
                 try:
-                    resp = requests.post(
-                        url=f'http://{remote_target}/send/',
-                        json={
-                            'target': i,
-                            'data': self.encode(json.dumps({
-                                'timestamp': time.time(),
-                                'command': command_path,
-                                'args': args,
-                                'kwargs': kwargs,
-                                'initiator': f'{self.network}.{self.name}'
-                            })).decode('utf-8'),
-                            'packet_id': pid,
-                            'originator': self.name,
-                            'r_type': 'request',
-                            'remote_addr': remote_target
-                        }
-                    )
-                    if resp.status_code != 200:
-                        raise requests.ConnectionError
-                    wait_start = time.time()
-                    if timeout == None:
-                        _t = -1
-                    else:
-                        _t = timeout + 0
-                    while not pid in self.remote_buffer.keys() and (wait_start + _t > time.time() or _t == -1):
-                        pass
-                    if pid in self.remote_buffer.keys():
-                        res = json.loads(self.decode(
-                            copy.deepcopy(self.remote_buffer[pid])['data']))
-                        if res['status'] == 200:
-                            ret = res['result']
-                        else:
-                            print(
-                                f'Encountered error with status {str(res["status"])}:\n{res["result"]}')
-                        del self.remote_buffer[pid]
-                    else:
-                        raise requests.ConnectionError
+                    resp = self.relay_deliver(remote_target, self.request_packet(
+                        i, remote_target, pid, message), timeout)
                 except (requests.ConnectionError, requests.Timeout):
-                    self.remote_peers[i].remove(remote_target)
-            if ret == None:
-                del self.remote_peers[i]
-                if raise_errors:
-                    raise TimeoutError(
-                        f'Attempt to reach peer {i} remotely failed.')
-                else:
+                    self.route_stats.observe(remote_target, peer=i, error=True)
+                    continue
+                outcome = self.relay_outcome(i, remote_target, resp.status_code)
+                if outcome != 'sent':
+                    busy = busy or outcome == 'busy'
+                    continue
+                sent[remote_target] = start
+                wait = self.route_wait(i, remote_target, n + 1 < len(routes), timeout, deadline)
+                try:
+                    waiter.result(timeout=wait)
+                    break
+                except FutureTimeoutError:
+                    if not self.hedge:
+                        self.route_stats.observe(remote_target, peer=i, error=True)
+            if self.hedge and not waiter.done() and len(sent) > 0:  # Later routes failed to send; earlier copies may still answer
+                try:
+                    waiter.result(timeout=time_left(deadline))
+                except FutureTimeoutError:
                     pass
-                    
+        finally:
+            self.remote_buffer.pop((pid, i), None)
+
+        return self.remote_result(i, message, waiter.result() if waiter.done() else None, sent, busy, raise_errors, failed)
+
+    # Classify a relay's answer to a request packet for <i>: "sent" if it took the packet, "busy" if <i>'s mailbox had no
+    # room, "error" otherwise (which counts against the route)
+    def relay_outcome(self, i, relay, status):
+        if status in [429, 413]:
+            print(
+                f'Relay {relay} refused the request with status {str(status)}')
+            return 'busy'
+        if status != 200:
+            self.route_stats.observe(relay, peer=i, error=True)
+            return 'error'
+        return 'sent'
+
+    # Seconds to wait for an answer through <relay> before moving on: its hedge delay if a <later> route could take over,
+    # what is left of <deadline> on the last route, or all of <timeout> without hedging. None waits forever.
+    def route_wait(self, i, relay, later, timeout, deadline):
+        if not self.hedge:
+            wait = timeout
+        elif later:
+            wait = self.route_stats.hedge_delay(i, relay, self.hedge_percentile, timeout)
+            if deadline != None:
+                wait = min(wait, time_left(deadline))
         else:
+            wait = time_left(deadline)
+        return None if wait == None else max(0, wait)
+
+    # The result of a remote request for <i>, given the <buffered> answer (None if none came) and the relays it was <sent> through
+    def remote_result(self, i, message, buffered, sent, busy, raise_errors, failed=None):
+        if buffered == None:
+            if self.hedge:
+                for remote_target in sent.keys():
+                    self.route_stats.observe(remote_target, peer=i, error=True)
             if raise_errors:
-                raise LookupError(
-                    f'Could not find target {i} in remote peers. Available peers: {str(len(self.remote_peers.keys()))}')
-            else:
-                pass
-        
-        return ret
+                if busy:
+                    raise TimeoutError(
+                        f'Relays could not accept a request for peer {i}.')
+                raise TimeoutError(
+                    f'Attempt to reach peer {i} remotely failed.')
+            return failed
+        self.observe_round_trip(i, sent)
+        if buffered.get('waited') != None:
+            self.span_add('relay_queue', buffered['waited'])
+        res = self.unpack_message(buffered['data'])
+        if res['status'] != 200:
+            print(
+                f'Encountered error with status {str(res["status"])}:\n{res["result"]}')
+            return failed
+        self.remember(i, message, res['result'], res.get('ttl'))
+        return res['result']
 
-    def command(self, command_path='__echo__', args=[], kwargs={}, target='*', raise_errors=False, timeout=5, max_threads=32):
-        if target == '*' or target == []:
-            targets = list(self.peers.keys())
-            targets.extend(list(self.remote_peers.keys()))
+    # Feed the round trip of an answered remote request into the route estimates. Copies that lost a hedge (or timed out
+    # before a late answer) count as having taken at least as long as they were outstanding.
+    def observe_round_trip(self, peer, sent):
+        now = time.time()
+        for remote_target, start in sent.items():
+            self.route_stats.observe(remote_target, rtt=now - start, peer=peer)
+
+    # Expand a command target ("*", a list of names, or a single name) into a list of names
+    def resolve_targets(self, target):
+        if target == '*' or target == []:  # A peer on the LAN that is also attached to a relay is listed once
+            return list(dict.fromkeys([*self.peers.keys(), *self.remote_peers.keys()]))
         elif type(target) == list:
-            targets = target[:]
-        else:
-            targets = [target]
+            return list(dict.fromkeys(target))
+        return [target]
+
+    # Remote-only <targets> grouped by the best route to each that can multicast, and by payload format, compression codec and
+    # cipher: {(relay, binary, codec, aead): [names]}.
+    # Only groups of two or more are worth a multicast.
+    def multicast_groups(self, targets):
+        if not self.features['remote']:
+            return {}
+        groups = {}
+        for i in dict.fromkeys(targets):
+            if i == self.name or (i in self.peers.keys() and self.features['local']):
+                continue
+            routes = [r for r in self.remote_peers.get(i, ()) if MULTICAST_CAPABILITY in self.server_info.get(r, {}).get('capabilities', ())]
+            if len(routes) > 0:
+                relay = self.route_stats.rank(i, routes)[0]
+                codec = self.compressor.choose(self.peer_capabilities.get(i, ()))
+                groups.setdefault((relay, self.supports(i, wire.CAPABILITY), codec, self.uses_aead(i)), []).append(i)
+        return {k: v for k, v in groups.items() if len(v) > 1}
+
+    # Send <message> to remote targets that share a relay as one packet per relay, which the relay copies into each mailbox.
+    # Returns {target: (pid, relay, Future, send time)} for the targets a relay accepted; the rest need requests of their own.
+    def multicast(self, targets, message, timeout):
+        pending = {}
+        for (relay, binary, codec, aead), group in self.multicast_groups(targets).items():
+            pid = new_packet_id()
+            waiters = {i: Future() for i in group}
+            path, body, headers = self.multicast_request(relay, binary, group, pid, message, waiters)
+            start = time.time()
+            try:
+                resp = self.pool.post(relay, path, data=body, headers=headers, timeout=timeout)
+                accepted = self.multicast_accepted(relay, resp.status_code, resp.content)
+            except (requests.ConnectionError, requests.Timeout):
+                self.route_stats.observe(relay, error=True)
+                accepted = set()
+            self.multicast_pending(pending, pid, relay, waiters, accepted, start)
+        return pending
+
+    # Register <waiters> for the answers to multicast <pid> and build its request to <relay>. Returns (path, body, headers).
+    def multicast_request(self, relay, binary, group, pid, message, waiters):
+        for i, waiter in waiters.items():
+            self.remote_buffer[(pid, i)] = waiter
+        return self.relay_request(relay, {
+            'targets': group,
+            'data': self.pack_message(message, binary=binary, peer=group[0], multicast=True),  # The group shares one codec and cipher
+            'packet_id': pid,
+            'originator': self.name,
+            'r_type': 'request',
+            'remote_addr': relay
+        }, path='multicast')
+
+    # The targets <relay> accepted a multicast for, from its answer
+    def multicast_accepted(self, relay, status, content):
+        if status != 200:
+            print(
+                f'Relay {relay} refused a multicast with status {str(status)}')
+            return set()
+        try:
+            return set(wire.loads(content)['accepted'])
+        except (ValueError, KeyError):
+            self.route_stats.observe(relay, error=True)
+            return set()
+
+    # Add the targets of multicast <pid> that <relay> accepted to <pending>, and stop waiting for the rest
+    def multicast_pending(self, pending, pid, relay, waiters, accepted, start):
+        for i, waiter in waiters.items():
+            if i in accepted:
+                pending[i] = (pid, relay, waiter, start)
+            else:
+                self.remote_buffer.pop((pid, i), None)
+
+    # Wait until <deadline> for <i>'s answer to multicast <message>
+    def _await_multicast(self, i, message, pending, deadline, raise_errors, failed=None):
+        pid, relay, waiter, start = pending
+        try:
+            buffered = waiter.result(timeout=time_left(deadline))
+        except FutureTimeoutError:
+            buffered = None
+        return self.multicast_result(i, message, relay, start, buffered, raise_errors, failed)
+
+    # The result of <i>'s answer to a multicast sent through <relay> at <start>: <buffered>, or None if it did not come in time
+    def multicast_result(self, i, message, relay, start, buffered, raise_errors, failed=None):
+        self.metrics.observe('request_seconds', time.time() - start, path='multicast')
+        if buffered == None:
+            self.route_stats.observe(relay, peer=i, error=True)
+            self.metrics.count('request_errors', path='multicast')
+            if raise_errors:
+                raise TimeoutError(
+                    f'Attempt to reach peer {i} remotely failed.')
+            return failed
+        self.route_stats.observe(relay, rtt=time.time() - start, peer=i)
+        res = self.unpack_message(buffered['data'])
+        if res['status'] == 200:
+            self.remember(i, message, res['result'], res.get('ttl'))
+            return self.accept_stream(res['result'])
+        print(
+            f'Encountered error with status {str(res["status"])}:\n{res["result"]}')
+        return failed
+
+    # Submit <message> for every target to <executor>: multicast where peers share a relay, one request each otherwise.
+    # Targets whose result is cached get a completed Future unless <cache> is False. Returns {Future: target}.
+    def dispatch(self, executor, targets, message, raise_errors, timeout, failed=None, cache=True):
+        if len(targets) > 1 and stream.carries_streams(message):
+            raise ValueError('Streamed arguments can only be sent to a single target.')
+        hits = self.cached_results(targets, message) if cache else {}
+        pending = self.multicast([i for i in targets if not i in hits.keys()], message, timeout)
+        deadline = deadline_after(timeout)
+        futures = {}
+        for i in targets:
+            if i in hits.keys():
+                future = Future()
+                future.set_result(hits[i])
+            elif i in pending.keys():
+                entry = pending.pop(i)
+                future = executor.submit(self._await_multicast, i, message, entry, deadline, raise_errors, failed)
+                future.add_done_callback(lambda f, key=(entry[0], i): self.remote_buffer.pop(key, None))  # Also runs if cancelled
+            else:
+                future = executor.submit(self._request_one, i, message, raise_errors, timeout, failed)
+            futures[future] = i
+        return futures
+
+    # Yield (peer, result) for each target as its response arrives. Stragglers are abandoned when the caller stops iterating.
+    def command_iter(self, command_path='__echo__', args=[], kwargs={}, target='*', raise_errors=False, timeout=5, max_threads=32, failed=None, cache=True):
+        targets = self.resolve_targets(target)
+        if len(targets) == 0:
+            return
+        executor = ThreadPoolExecutor(max_workers=min(len(targets), max_threads))
+        futures = self.dispatch(executor, targets, self.command_message(command_path, args, kwargs), raise_errors, timeout, failed, cache)
+        try:
+            for future in as_completed(futures.keys()):
+                yield futures[future], future.result()
+        finally:
+            for future in futures.keys():
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def command(self, command_path='__echo__', args=[], kwargs={}, target='*', raise_errors=False, timeout=5, max_threads=32, first=None, quorum=None, cache=True):
+        if first != None or quorum != None:  # Failed targets only count against the result; errors are raised once it is out of reach
+            targets = self.resolve_targets(target)
+            fan_in = FanIn(first=first, quorum=quorum, targets=len(targets))
+            responses = self.command_iter(
+                command_path, args, kwargs, targets, False, timeout, max_threads, failed=NO_ANSWER, cache=cache)
+            for i, result in responses:
+                if fan_in.add(i, result) or (raise_errors and not fan_in.reachable()):
+                    break
+            responses.close()  # Cancel targets that have not started yet
+            return self.fan_in_result(fan_in, raise_errors)
+
+        targets = self.resolve_targets(target)
+        message = self.command_message(command_path, args, kwargs)
+        if cache and len(targets) == 1:  # A repeated lookup is answered without starting any threads
+            hits = self.cached_results(targets, message)
+            if len(hits) > 0:
+                return hits[targets[0]]
+            cache = False
 
         with ThreadPoolExecutor(max_workers=max_threads) as executor:
-            returned = {i:executor.submit(self._command_one,command_path,args,kwargs,i,raise_errors,timeout) for i in targets}
+            futures = self.dispatch(executor, targets, message, raise_errors, timeout, cache=cache)
         
-        returned = {i:returned[i].result() for i in returned.keys()}
+        returned = {i:future.result() for future, i in futures.items()}
         if len(targets) == 1:
             return returned[list(returned.keys())[0]]
         else:
             return returned
 
-    # Register <function> at <command_path>
-    def register_command(self, command_path, function):
+    def fan_in_result(self, fan_in, raise_errors):
+        if raise_errors and not fan_in.reached():
+            if fan_in.quorum != None:
+                raise TimeoutError(
+                    f'Fewer than {str(fan_in.quorum)} peers agreed on a result.')
+            raise TimeoutError(
+                f'Fewer than {str(fan_in.first)} peers answered.')
+        return fan_in.result()
+
+    # Run many commands on one peer in a single envelope. Results are returned in call order.
+    # Peers that do not advertise batch support are sent the calls one at a time.
+    def command_batch(self, target, calls, raise_errors=False, timeout=5, parallel=False):
+        calls = [self.batch_call(c) for c in calls]
+        results = []
+        while len(calls) > 0 and not self.supports(target, BATCH_CAPABILITY) and (target in self.peers.keys() or target in self.remote_peers.keys()):  # The first reply tells us what a local peer supports
+            call = calls.pop(0)
+            results.append(self._command_one(
+                call['command'], call['args'], call['kwargs'], target, raise_errors, timeout))
+        if len(calls) > 0:
+            resp = self._request_one(target, self.batch_message(
+                calls, parallel), raise_errors, timeout)
+            results.extend(self.batch_results(resp, len(calls)))
+        return results
+
+    # Look up the function registered at dotted <command_path>
+    def resolve_command(self, command_path):
+        try:
+            return self.command_index[command_path]
+        except KeyError:
+            raise InternalKeyError(f'Command {command_path} not found.')
+
+    # Walk registered_commands down <path> (a list of keys) to the dict that holds its commands
+    def command_parent(self, path):
+        parent = self.registered_commands
+        for i in path:
+            if type(parent.get(i)) != dict:
+                raise KeyError(i)
+            parent = parent[i]
+        return parent
+
+    # Put <cmd> at parent[name] (full path <prefix><name>) and update the command index for the replaced subtree.
+    # <cache> is the seconds results of the new commands may be cached for, or None.
+    def place_command(self, parent, prefix, name, cmd, execution='inline', cache=None):
+        added = flatten_dict({name: cmd}, start=prefix)
+        for function in added.values():
+            check_execution(function, execution)
+        removed = flatten_dict({name: parent[name]}, start=prefix).keys() if name in parent.keys() else []
+        for i in removed:
+            self.command_index.pop(i, None)
+            self.command_executions.pop(i, None)
+            self.command_caching.pop(i, None)
+        parent[name] = cmd
+        self.command_index.update(added)
+        if execution != 'inline':
+            self.command_executions.update({i: execution for i in added.keys()})
+        if cache != None:
+            self.command_caching.update({i: cache for i in added.keys()})
+        changed = set(removed) | set(added.keys()) | {'__list_commands__'}
+        self.memo.invalidate(lambda key: key[0] in changed)
+        self.command_list = None
+
+    # Register <function> at <command_path>, run by <execution> ("inline", "thread" or "process").
+    # Results of a command with a <cache> TTL are memoized for that many seconds here and by callers.
+    def register_command(self, command_path, function, execution='inline', cache=None):
+        path = command_path.split('.')
         try:
-            translated_path = '"]["'.join([i for i in command_path.split('.')])
-            exec(f'self.registered_commands["{translated_path}"] = function', globals(), {
-                 'self': self, 'function': function})
+            parent = self.command_parent(path[:-1])
         except KeyError:
             raise KeyError(
                 f'Unable to register {command_path} as the path to it does not exist.')
+        self.place_command(parent, '.'.join(path[:-1]+['']), path[-1], function, execution, cache)
 
-    # Register dict of <commands>. If <top> != None, will use <top> as the starting point.
-    def register_commands(self, commands, top=None):
+    # Register dict of <commands>, all run by <execution> and cached for <cache> seconds. If <top> != None, will use <top> as the starting point.
+    def register_commands(self, commands, top=None, execution='inline', cache=None):
         if top == None:
-            for i in commands.keys():
-                if type(commands[i]) == dict:
-                    cmd = commands[i].copy()
-                else:
-                    cmd = copy.copy(commands[i])
-                self.registered_commands[i] = cmd
+            parent = self.registered_commands
+            prefix = ''
         else:
-            for i in commands.keys():
-                if type(commands[i]) == dict:
-                    cmd = commands[i].copy()
+            try:
+                parent = self.command_parent(top.split('.'))
+            except KeyError:
+                raise KeyError(
+                    f'Unable to register commands to {top} as the path to it does not exist.')
+            prefix = top + '.'
+        for i in commands.keys():
+            if type(commands[i]) == dict:
+                cmd = commands[i].copy()
+            else:
+                cmd = copy.copy(commands[i])
+            self.place_command(parent, prefix, i, cmd, execution, cache)
+
+    # Forget cached results of <command_path> (or every command), both those this node ran and those it got from <target>
+    # (or from every peer). Returns how many results were dropped.
+    def invalidate(self, command_path=None, target=None):
+        dropped = 0
+        if target == None or target == self.name:
+            dropped += self.memo.invalidate(lambda key: command_path == None or key[0] == command_path)
+        return dropped + self.result_cache.invalidate(lambda key: (target == None or key[0] == target) and (command_path == None or key[1] == command_path))
+
+    # Keep <result> of <message> from <target> for <ttl> seconds, if the peer said it may be cached
+    def remember(self, target, message, result, ttl):
+        if ttl != None and 'command' in message.keys():
+            self.result_cache.put((target, message['command'], arguments_key(message['args'], message['kwargs'])), copy.deepcopy(result), ttl)  # The caller gets <result> itself
+
+    # {target: result} of the <targets> whose result for <message> is cached
+    def cached_results(self, targets, message):
+        if self.result_cache.max_entries <= 0 or not 'command' in message.keys():
+            return {}
+        arguments = arguments_key(message['args'], message['kwargs'])
+        hits = {}
+        for i in dict.fromkeys(targets):
+            found, result = self.result_cache.get((i, message['command'], arguments))
+            if found:
+                hits[i] = copy.deepcopy(result)  # Callers may change what they get
+        return hits
+
+    # The thread or process pool for commands registered with execution <kind>, or the "stream" thread pool
+    def executor(self, kind):
+        with self.executors_lock:
+            if not kind in self.executors.keys():
+                if kind == 'thread':
+                    self.executors[kind] = ThreadPoolExecutor(max_workers=self.command_threads, thread_name_prefix=f'{self.network}.{self.name}.command')
+                elif kind == 'stream':  # Pulls chunks of the streams this node reads
+                    self.executors[kind] = ThreadPoolExecutor(max_workers=stream.WORKERS, thread_name_prefix=f'{self.network}.{self.name}.stream')
                 else:
-                    cmd = copy.copy(commands[i])
-                try:
-                    translated_path = '"]["'.join([i for i in top.split('.')])
-                    exec(f'self.registered_commands["{translated_path}"][i] = cmd', globals(), {
-                         'self': self, 'i': i, 'cmd': cmd})
-                except KeyError:
-                    raise KeyError(
-                        f'Unable to register commands to {top} as the path to it does not exist.')
+                    self.executors[kind] = ProcessPoolExecutor(max_workers=self.command_processes, mp_context=multiprocessing.get_context(PROCESS_START))
+            return self.executors[kind]
+
+    # Forget a process pool that lost a worker, so the next process command starts a new one
+    def discard_executor(self, kind, executor):
+        with self.executors_lock:
+            if self.executors.get(kind) is executor:
+                del self.executors[kind]
+        executor.shutdown(wait=False)
+
+    # Run the command at <command_path> where it was registered to run. Process commands get None for the node.
+    def execute(self, command_path, args, kwargs):
+        function = self.resolve_command(command_path)
+        execution = self.command_executions.get(command_path, 'inline')
+        if execution == 'inline':
+            return function(self, args, kwargs)
+        executor = self.executor(execution)
+        try:
+            return executor.submit(function, self if execution == 'thread' else None, args, kwargs).result()
+        except BrokenProcessPool:
+            self.discard_executor(execution, executor)
+            raise
+
+    # Streams
+    # Keep <value> to be streamed if it is a file-like object or iterator and return its placeholder, otherwise return <value>
+    def offer_stream(self, value):
+        if not self.streamable(value):
+            return value
+        self.expire_streams()
+        stream_id = stream.new_id()
+        self.streams[stream_id] = stream.Outgoing(value, self.stream_chunk, self.stream_window)
+        return {stream.KEY: stream_id, 'node': self.name, 'window': self.stream_window}
+
+    def streamable(self, value):
+        return stream.is_streamable(value)
+
+    # Top-level <args> and <kwargs> with streamable values replaced by placeholders
+    def offer_arguments(self, args, kwargs):
+        if not any(self.streamable(v) for v in [*args, *kwargs.values()]):
+            return args, kwargs
+        return [self.offer_stream(v) for v in args], {k: self.offer_stream(v) for k, v in kwargs.items()}
+
+    # <value> with a stream placeholder replaced by a Stream reading it from the node that sent it
+    def accept_stream(self, value):
+        if not stream.is_placeholder(value):
+            return value
+        return self.open_stream(value)
+
+    def open_stream(self, placeholder):
+        return stream.Stream(self, placeholder['node'], placeholder[stream.KEY], placeholder.get('window', stream.WINDOW), self.stream_timeout)
+
+    def accept_arguments(self, args, kwargs):
+        if not any(stream.is_placeholder(v) for v in [*args, *kwargs.values()]):
+            return args, kwargs
+        return [self.accept_stream(v) for v in args], {k: self.accept_stream(v) for k, v in kwargs.items()}
+
+    # Close the streamed arguments a command left unread, unless its result is a stream that may still read them
+    def close_arguments(self, args, kwargs, resp):
+        if not stream.is_placeholder(resp):
+            for v in [*args, *kwargs.values()]:
+                if isinstance(v, stream.Stream):
+                    v.close()
+
+    # Drop streams that have not been read for stream_timeout seconds
+    def expire_streams(self):
+        cutoff = time.monotonic() - self.stream_timeout
+        for stream_id, outgoing in list(self.streams.items()):
+            if outgoing.used < cutoff and self.streams.pop(stream_id, None) != None:
+                outgoing.close()
+
+    # __stream__ command: args are [stream id, chunk, chunks received]. Returns the chunk, or None past the end.
+    # A chunk of None closes the stream.
+    def serve_stream(self, node, args, kwargs):
+        stream_id, seq, received = args
+        if seq == None:
+            outgoing = self.streams.pop(stream_id, None)
+            if outgoing != None:
+                outgoing.close()
+            return None
+        outgoing = self.streams.get(stream_id)
+        if outgoing == None:
+            raise LookupError(f'Stream {stream_id} is closed or expired.')
+        chunk = outgoing.pull(seq, received)
+        if chunk != None:
+            self.metrics.count('stream_bytes', len(chunk), direction='out')
+        return chunk
+
+    # Chunk <seq> of stream <stream_id> from <peer>, or None past its end, acknowledging the first <received> chunks
+    def pull_chunk(self, peer, stream_id, seq, received, timeout):
+        chunk = self._command_one('__stream__', [stream_id, seq, received], {}, peer, True, timeout, failed=NO_ANSWER)
+        if chunk is NO_ANSWER:
+            raise IOError(f'Reading stream {stream_id} from {peer} failed.')
+        if chunk != None:
+            self.metrics.count('stream_bytes', len(chunk), direction='in')
+        return chunk
+
+    # Tell <peer> to drop stream <stream_id> once the <pending> pulls of it have finished
+    def close_stream(self, peer, stream_id, pending, timeout):
+        wait(pending)
+        self._command_one('__stream__', [stream_id, None, 0], {}, peer, False, timeout)
 
     # Utility function to list methods of target(s). Similar args as with command()
     def get_commands(self, target='*', raise_errors=False, timeout=4):
         return self.command(command_path='__list_commands__', target=target, raise_errors=raise_errors, timeout=timeout)
+
+
+from peerbase.aio import AsyncNode  # Imported last: AsyncNode subclasses Node
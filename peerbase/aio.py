@@ -0,0 +1,611 @@
+import asyncio
+import collections.abc
+import http
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+from requests.structures import CaseInsensitiveDict
+from peerbase import Node, FanIn, CommandRun, wire, stream, open_request, result_ttl, new_packet_id, retry_after, deadline_after, time_left, past_deadline, BATCH_CAPABILITY, BATCH_WORKERS, NO_ANSWER, RESPONSE_RETRY_WINDOW
+from peerbase.peer_utils import *
+
+
+# Minimal HTTP/1.1 over asyncio streams. Only what Node traffic needs: Content-Length or chunked bodies, keep-alive.
+async def read_http(reader):
+    start = await reader.readline()
+    if not start:
+        return None
+    start = start.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    if len(start) < 2:
+        raise ConnectionError('Malformed HTTP start line.')
+    headers = CaseInsensitiveDict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, _, v = line.decode('latin-1').partition(':')
+        headers[k.strip()] = v.strip()
+    keep = headers.get('connection', '').lower() != 'close'
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif start[0].startswith('HTTP/'):  # Response without a length runs to EOF
+        body = await reader.read()
+        keep = False
+    else:
+        body = b''
+    return start, headers, body, keep
+
+
+def format_http(start, headers, body):
+    lines = [start] + [f'{k}: {v}' for k, v in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class AsyncHTTPPool:
+    # Keeps up to pool_size idle keep-alive connections per address, evicting ones left idle
+    def __init__(self, pool_size=4, idle_timeout=30):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # {address: [(reader, writer, last used)]}
+
+    def _checkout(self, address):
+        now = time.time()
+        while len(self.idle.get(address, [])) > 0:
+            reader, writer, last_used = self.idle[address].pop()
+            if writer.is_closing() or reader.at_eof() or (self.idle_timeout != None and last_used + self.idle_timeout < now):
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    def _checkin(self, address, reader, writer):
+        conns = self.idle.setdefault(address, [])
+        if len(conns) < self.pool_size:
+            conns.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    async def _exchange(self, reader, writer, data):
+        writer.write(data)
+        await writer.drain()
+        response = await read_http(reader)
+        if response == None:
+            raise ConnectionError('Connection closed before a response was received.')
+        return response
+
+    # Send a request to http://<address>/<path>. Returns (status, headers, body).
+    async def request(self, method, address, path='', body=b'', headers={}, timeout=None):
+        host, port = address.rsplit(':', 1)
+        data = format_http(f'{method} /{path} HTTP/1.1', dict({
+            'Host': address,
+            'Content-Length': str(len(body))
+        }, **headers), body)
+
+        async def attempt():
+            conn = self._checkout(address)
+            if conn != None:
+                try:
+                    return conn, await self._exchange(conn[0], conn[1], data)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn[1].close()  # Stale pooled connection; retry once on a fresh one
+            conn = await asyncio.open_connection(host, int(port))
+            return conn, await self._exchange(conn[0], conn[1], data)
+
+        try:
+            conn, (start, resp_headers, content, keep) = await asyncio.wait_for(attempt(), timeout=timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError(f'Connection to {address} closed mid-response.')
+        if keep:
+            self._checkin(address, conn[0], conn[1])
+        else:
+            conn[1].close()
+        return int(start[1]), resp_headers, content
+
+    def discard(self, address):
+        for reader, writer, last_used in self.idle.pop(address, []):
+            writer.close()
+
+    def prune(self, live):
+        for address in list(self.idle.keys()):
+            if not address in live:
+                self.discard(address)
+
+    def close(self):
+        for address in list(self.idle.keys()):
+            self.discard(address)
+
+
+async def run_command_async(node, command, args, kwargs):
+    run = CommandRun(node, command, args, kwargs)
+    answer = run.begin()
+    if answer != None:
+        return answer
+    try:
+        resp = node.offer_stream(await node.execute_async(command, run.args, run.kwargs))
+    except:
+        return run.failed()
+    return run.finished(resp)
+
+
+async def run_batch_async(node, calls, parallel):
+    runs = [run_command_async(node, call['command'], call['args'], call['kwargs']) for call in calls]
+    if parallel:
+        limit = asyncio.Semaphore(BATCH_WORKERS if parallel == True else int(parallel))
+
+        async def run(coro):
+            async with limit:
+                return list(await coro)
+
+        return list(await asyncio.gather(*[run(coro) for coro in runs]))
+    return [list(await coro) for coro in runs]
+
+
+async def process_request_async(data, node, waited=None, capabilities=None):
+    data, initiator, span = open_request(data, node, waited, capabilities)
+    try:
+        if 'batch' in data.keys():
+            return 200, await run_batch_async(node, data['batch'], data.get('parallel', False)), initiator, None
+        stat, resp = await run_command_async(node, data['command'], data['args'], data['kwargs'])
+        return stat, resp, initiator, result_ttl(node, data['command'], stat, resp)
+    finally:
+        node.end_span(span)
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, addr):
+        parsed = self.node.parse_advertisement(data)
+        if parsed != None:
+            self.node.saw_peer(*parsed)
+
+
+class AsyncNode(Node):
+    # Node running on a single asyncio event loop. Takes the same arguments as Node; command() must be awaited.
+    # Registered commands may be plain functions (run in an executor) or coroutine functions.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http = AsyncHTTPPool(pool_size=self.pool.pool_size,
+                                  idle_timeout=self.pool_idle_timeout)
+        self.tasks = set()
+        self.connections = set()  # Writers of open local server connections
+        self.workers = None  # Semaphore of requests run at once (up to server_queue more wait for it), made on the loop start() runs on
+        self.waiting = 0
+        self.discovery_transport = None
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def new_session(self, server, maintain):
+        session = super().new_session(server, maintain)
+        session['thread'] = None
+        return session
+
+    def open_session(self, server):
+        self.server_info[server] = self.new_session(server, False)
+        self.spawn(self.remote_keepalive_loop(server))
+
+    def drop_session(self, target):
+        super().drop_session(target)
+        self.http.discard(target)
+
+    def prune_pools(self):
+        self.http.prune(self.live_addresses())
+
+    # Event loop tasks
+    async def advertising_loop(self):
+        while self.running:
+            self.advertise_wakeup.clear()
+            self.advertising_socket.sendto(
+                self.advertisement(), ('<broadcast>', self.ports['local_advertiser']))
+            try:
+                await asyncio.wait_for(self.advertise_wakeup.wait(), timeout=self.next_advertise_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    async def expiry_loop(self):
+        while self.running:
+            await asyncio.sleep(self.peer_ttl / 4)
+            if self.expire_peers():
+                self.prune_pools()
+            self.expire_streams()
+
+    async def serve_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while self.running:
+                try:
+                    request = await asyncio.wait_for(read_http(reader), timeout=self.pool_idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request == None:
+                    break
+                start, headers, body, keep = request
+                if start[0] != 'POST':
+                    stat, content, resp_headers = 501, b'', {
+                        'Content-Length': '0'}
+                elif self.workers.locked() and self.waiting >= self.server_queue:
+                    self.metrics.count('rejected', reason='server')
+                    stat = 503
+                    content, resp_headers = self.local_response(
+                        f'NODE {self.name} BUSY', headers.get('content-type') == wire.CONTENT_TYPE, None, stat)
+                else:
+                    self.waiting += 1
+                    try:
+                        await self.workers.acquire()
+                    finally:
+                        self.waiting -= 1
+                    try:
+                        stat, resp, initiator, ttl = await process_request_async(body, self, capabilities=headers.get(wire.CAPABILITIES_HEADER))
+                    finally:
+                        self.workers.release()
+                    content, resp_headers = self.local_response(
+                        resp, headers.get('content-type') == wire.CONTENT_TYPE, initiator, stat, ttl)
+                if not keep:
+                    resp_headers['Connection'] = 'close'
+                writer.write(format_http(
+                    f'HTTP/1.1 {stat} {http.HTTPStatus(stat).phrase}', resp_headers, content))
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def process_single_buffer(self, pid, buffer_data):
+        stat, resp, initiator, ttl = await process_request_async(buffer_data['data'], self, buffer_data.get('waited'))
+        try:
+            await self.relay_deliver(buffer_data['remote'], self.response_packet(pid, buffer_data, stat, resp, ttl), RESPONSE_RETRY_WINDOW)
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    # Post a packet to a relay's /send. Returns the HTTP status and headers.
+    async def relay_send(self, relay, packet, timeout=None):
+        path, body, headers = self.relay_request(relay, packet)
+        start = time.time()
+        try:
+            status, resp_headers, content = await self.http.request('POST', relay, path, body, headers, timeout=timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.route_stats.observe(relay, error=True)
+            raise
+        self.route_stats.observe(relay, rtt=time.time() - start)
+        return status, resp_headers
+
+    async def relay_deliver(self, relay, packet, timeout):
+        deadline = deadline_after(timeout)
+        while True:
+            status, resp_headers = await self.relay_send(relay, packet, timeout=time_left(deadline, 0.01))
+            if status != 429:
+                return status
+            delay = retry_after(resp_headers)
+            if past_deadline(deadline, delay):
+                return status
+            await asyncio.sleep(delay)
+
+    async def remote_keepalive_loop(self, target):
+        long_poll = False
+        while self.running:
+            self.expire_streams()
+            try:
+                path, body, headers = self.ping_request(target, long_poll)
+                start = time.time()
+                status, resp_headers, content = await self.http.request('POST', target, path, body, headers, timeout=self.long_poll + 10)
+                if status != 200:
+                    raise ConnectionError
+                if not long_poll:
+                    self.route_stats.observe(target, rtt=time.time() - start)
+                self.metrics.count('keepalives', relay=target)
+                long_poll, incoming = self.handle_ping(target, content)
+                for b in incoming.keys():
+                    self.spawn(self.process_single_buffer(b, incoming[b]))
+            except (OSError, asyncio.TimeoutError):
+                long_poll = False
+                self.route_stats.observe(target, error=True)
+                self.metrics.count('keepalive_errors', relay=target)
+                self.server_info[target]['active'] = False
+                if not self.server_info[target]['maintain']:
+                    self.drop_session(target)
+                    return
+
+            if not self.server_info[target]['active']:
+                await asyncio.sleep(30)
+            elif not long_poll:
+                await asyncio.sleep(self.keepalive_tick)
+
+    # Node.start_multithreaded would run the start() coroutine in a thread without ever awaiting it
+    def start_multithreaded(self, thread_name=None, thread_group=None, discovery_timeout=1.5):
+        raise TypeError(
+            'AsyncNode cannot be started in a thread; it runs on an asyncio event loop. Call "await node.start()" from a coroutine instead.')
+
+    # Start the node on the running event loop. Returns once a local peer has been seen or <discovery_timeout> has passed.
+    async def start(self, discovery_timeout=1.5):
+        loop = asyncio.get_running_loop()
+        self.running = True
+        self.discovered = asyncio.Event()
+        self.advertise_wakeup = asyncio.Event()
+        self.workers = asyncio.Semaphore(self.server_workers)  # Before Python 3.10, made outside the loop it would bind to another one
+        if self.features['local']:
+            self.local_server = await asyncio.start_server(self.serve_connection, ip(), self.ports['local_server'])
+            self.discovery_transport, _ = await loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), sock=self.bind_discovery_socket())
+            self.spawn(self.advertising_loop())
+            self.spawn(self.expiry_loop())
+        if self.features['remote']:
+            for s in list(self.server_info.keys()):
+                self.spawn(self.remote_keepalive_loop(s))
+        if self.features['local']:
+            try:
+                await asyncio.wait_for(self.discovered.wait(), timeout=discovery_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        self.running = False
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        if self.local_server != None:
+            self.local_server.close()
+            for writer in list(self.connections):  # Open connections end their handlers with EOF
+                writer.close()
+            await self.local_server.wait_closed()
+        if self.discovery_transport != None:
+            self.discovery_transport.close()
+        self.advertising_socket.close()
+        self.http.close()
+        for executor in list(self.executors.values()):
+            if sys.version_info >= (3, 9):
+                executor.shutdown(wait=False, cancel_futures=True)
+            else:  # Queued commands still run, but stop() does not wait for them
+                executor.shutdown(wait=False)
+
+    # Streams. Async iterators are streamed too, and streams are read as AsyncStreams.
+    def streamable(self, value):
+        return isinstance(value, collections.abc.AsyncIterator) or super().streamable(value)
+
+    def open_stream(self, placeholder):
+        return stream.AsyncStream(self, placeholder['node'], placeholder[stream.KEY], placeholder.get('window', stream.WINDOW), self.stream_timeout)
+
+    def close_arguments(self, args, kwargs, resp):
+        if not stream.is_placeholder(resp):
+            for v in [*args, *kwargs.values()]:
+                if isinstance(v, stream.AsyncStream):
+                    self.spawn(v.close())
+
+    async def serve_stream(self, node, args, kwargs):
+        stream_id, seq, received = args
+        outgoing = self.streams.get(stream_id)
+        if seq == None or outgoing == None or not outgoing.asynchronous:  # File reads and plain iterators may block
+            return await asyncio.get_running_loop().run_in_executor(None, super().serve_stream, node, args, kwargs)
+        chunk = await outgoing.pull_async(seq, received)
+        if chunk != None:
+            self.metrics.count('stream_bytes', len(chunk), direction='out')
+        return chunk
+
+    async def pull_chunk(self, peer, stream_id, seq, received, timeout):
+        chunk = await self._command_one('__stream__', [stream_id, seq, received], {}, peer, True, timeout, failed=NO_ANSWER)
+        if chunk is NO_ANSWER:
+            raise IOError(f'Reading stream {stream_id} from {peer} failed.')
+        if chunk != None:
+            self.metrics.count('stream_bytes', len(chunk), direction='in')
+        return chunk
+
+    async def close_stream(self, peer, stream_id, pending, timeout):
+        await self._command_one('__stream__', [stream_id, None, 0], {}, peer, False, timeout)
+
+    # Run the command at <command_path>: coroutine commands on the loop, the rest in an executor so they cannot stall it
+    async def execute_async(self, command_path, args, kwargs):
+        function = self.resolve_command(command_path)
+        execution = self.command_executions.get(command_path, 'inline')
+        if asyncio.iscoroutinefunction(function):
+            return await function(self, args, kwargs)
+        if execution == 'inline':
+            return await asyncio.get_running_loop().run_in_executor(None, function, self, args, kwargs)
+        executor = self.executor(execution)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, self if execution == 'thread' else None, args, kwargs)
+        except BrokenProcessPool:
+            self.discard_executor(execution, executor)
+            raise
+
+    async def _command_one(self, command_path, args, kwargs, target, raise_errors, timeout, failed=None):
+        return await self._request_one(target, self.command_message(command_path, args, kwargs), raise_errors, timeout, failed)
+
+    async def _request_one(self, target, message, raise_errors, timeout, failed=None):
+        path = 'local' if target in self.peers.keys() and self.features['local'] else 'relay'
+        start = time.perf_counter()
+        span = self.begin_span(message.get('trace'), start, side='client', peer=target, command=message.get('command', 'batch'))
+        self.metrics.add('outstanding_requests', 1)
+        try:
+            ret = await self._route_request(target, message, raise_errors, timeout, failed)
+            return self.accept_stream(ret) if 'command' in message.keys() else ret
+        except:
+            self.metrics.count('request_errors', path=path)
+            raise
+        finally:
+            self.metrics.add('outstanding_requests', -1)
+            self.metrics.observe('request_seconds', time.perf_counter() - start, path=path)
+            self.end_span(span, path=path)
+
+    async def _route_request(self, target, message, raise_errors, timeout, failed=None):
+        i = target
+        remote = self.features['remote'] and len(self.remote_peers.get(i, ())) > 0
+        if i in self.peers.keys() and self.features['local']:
+            try:
+                status, resp_headers, content = await self.local_deliver(i, message, timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                if remote:
+                    return await self._request_remote(i, message, raise_errors, timeout, failed)
+                return self.unreachable(i, isinstance(e, asyncio.TimeoutError), raise_errors, timeout, failed)  # An OSError too since Python 3.11
+            return self.local_result(i, message, status, content, failed)
+        elif remote:
+            return await self._request_remote(i, message, raise_errors, timeout, failed)
+        return self.unknown_target(i, raise_errors, failed)
+
+    async def local_deliver(self, i, message, timeout):
+        address = f'{self.peers[i][0]}:{self.peers[i][1]}'
+        deadline = deadline_after(timeout)
+        while True:
+            body, headers = self.local_request(i, message)
+            status, resp_headers, content = await self.http.request('POST', address, '', body, headers, timeout=time_left(deadline, 0.01))
+            self.record_capabilities(
+                i, resp_headers.get(wire.CAPABILITIES_HEADER))
+            if status != 503 or not 'Retry-After' in resp_headers.keys():
+                return status, resp_headers, content
+            delay = retry_after(resp_headers)
+            if past_deadline(deadline, delay):
+                return status, resp_headers, content
+            await asyncio.sleep(delay)
+
+    async def _request_remote(self, i, message, raise_errors, timeout, failed=None):
+        routes = self.route_stats.rank(i, list(self.remote_peers.get(i, ())))
+        pid = new_packet_id()
+        waiter = asyncio.get_running_loop().create_future()
+        self.remote_buffer[(pid, i)] = waiter
+        sent = {}
+        busy = False
+        deadline = deadline_after(timeout)
+        try:
+            for n, remote_target in enumerate(routes):
+                start = time.time()
+                try:
+                    status = await self.relay_deliver(remote_target, self.request_packet(
+                        i, remote_target, pid, message), timeout)
+                except (OSError, asyncio.TimeoutError):
+                    self.route_stats.observe(remote_target, peer=i, error=True)
+                    continue
+                outcome = self.relay_outcome(i, remote_target, status)
+                if outcome != 'sent':
+                    busy = busy or outcome == 'busy'
+                    continue
+                sent[remote_target] = start
+                wait = self.route_wait(i, remote_target, n + 1 < len(routes), timeout, deadline)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=wait)
+                    break
+                except asyncio.TimeoutError:
+                    if not self.hedge:
+                        self.route_stats.observe(remote_target, peer=i, error=True)
+            if self.hedge and not waiter.done() and len(sent) > 0:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=time_left(deadline))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.remote_buffer.pop((pid, i), None)
+
+        return self.remote_result(i, message, waiter.result() if waiter.done() and not waiter.cancelled() else None, sent, busy, raise_errors, failed)
+
+    async def multicast(self, targets, message, timeout):
+        pending = {}
+        for (relay, binary, codec, aead), group in self.multicast_groups(targets).items():
+            pid = new_packet_id()
+            waiters = {i: asyncio.get_running_loop().create_future() for i in group}
+            path, body, headers = self.multicast_request(relay, binary, group, pid, message, waiters)
+            start = time.time()
+            try:
+                status, resp_headers, content = await self.http.request('POST', relay, path, body, headers, timeout=timeout)
+                accepted = self.multicast_accepted(relay, status, content)
+            except (OSError, asyncio.TimeoutError):
+                self.route_stats.observe(relay, error=True)
+                accepted = set()
+            self.multicast_pending(pending, pid, relay, waiters, accepted, start)
+        return pending
+
+    async def _await_multicast(self, i, message, pending, deadline, raise_errors, failed=None):
+        pid, relay, waiter, start = pending
+        try:
+            buffered = await asyncio.wait_for(asyncio.shield(waiter), timeout=time_left(deadline))
+        except asyncio.TimeoutError:
+            buffered = None
+        return self.multicast_result(i, message, relay, start, buffered, raise_errors, failed)
+
+    # Start a task per target that returns (target, result): multicast where peers share a relay, one request each otherwise.
+    # At most <max_threads> requests run at once.
+    async def dispatch(self, targets, message, raise_errors, timeout, max_threads, failed=None, cache=True):
+        if len(targets) > 1 and stream.carries_streams(message):
+            raise ValueError('Streamed arguments can only be sent to a single target.')
+        hits = self.cached_results(targets, message) if cache else {}
+        pending = await self.multicast([i for i in targets if not i in hits.keys()], message, timeout)
+        deadline = deadline_after(timeout)
+        limit = asyncio.Semaphore(max_threads)
+
+        async def run(i, entry):
+            if i in hits.keys():
+                return i, hits[i]
+            if entry != None:
+                return i, await self._await_multicast(i, message, entry, deadline, raise_errors, failed)
+            async with limit:
+                return i, await self._request_one(i, message, raise_errors, timeout, failed)
+
+        tasks = []
+        for i in targets:
+            entry = pending.pop(i, None)
+            task = asyncio.ensure_future(run(i, entry))
+            if entry != None:
+                task.add_done_callback(lambda t, key=(entry[0], i): self.remote_buffer.pop(key, None))  # Also runs if cancelled
+            tasks.append(task)
+        return tasks
+
+    async def command_iter(self, command_path='__echo__', args=[], kwargs={}, target='*', raise_errors=False, timeout=5, max_threads=32, failed=None, cache=True):
+        targets = self.resolve_targets(target)
+        tasks = await self.dispatch(targets, self.command_message(command_path, args, kwargs), raise_errors, timeout, max_threads, failed, cache)
+        try:
+            for response in asyncio.as_completed(tasks):
+                yield await response
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def command(self, command_path='__echo__', args=[], kwargs={}, target='*', raise_errors=False, timeout=5, max_threads=32, first=None, quorum=None, cache=True):
+        if first != None or quorum != None:
+            targets = self.resolve_targets(target)
+            fan_in = FanIn(first=first, quorum=quorum, targets=len(targets))
+            responses = self.command_iter(
+                command_path, args, kwargs, targets, False, timeout, max_threads, failed=NO_ANSWER, cache=cache)
+            async for i, result in responses:
+                if fan_in.add(i, result) or (raise_errors and not fan_in.reachable()):
+                    break
+            await responses.aclose()  # Cancel the stragglers
+            return self.fan_in_result(fan_in, raise_errors)
+
+        targets = self.resolve_targets(target)
+        message = self.command_message(command_path, args, kwargs)
+        if cache and len(targets) == 1:
+            hits = self.cached_results(targets, message)
+            if len(hits) > 0:
+                return hits[targets[0]]
+            cache = False
+        returned = dict(await asyncio.gather(*await self.dispatch(targets, message, raise_errors, timeout, max_threads, cache=cache)))
+        if len(targets) == 1:
+            return returned[targets[0]]
+        else:
+            return returned
+
+    async def command_batch(self, target, calls, raise_errors=False, timeout=5, parallel=False):
+        calls = [self.batch_call(c) for c in calls]
+        results = []
+        while len(calls) > 0 and not self.supports(target, BATCH_CAPABILITY) and (target in self.peers.keys() or target in self.remote_peers.keys()):
+            call = calls.pop(0)
+            results.append(await self._command_one(
+                call['command'], call['args'], call['kwargs'], target, raise_errors, timeout))
+        if len(calls) > 0:
+            resp = await self._request_one(target, self.batch_message(
+                calls, parallel), raise_errors, timeout)
+            results.extend(self.batch_results(resp, len(calls)))
+        return results
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Result caches for idempotent commands. A command registered with a cache TTL is memoized by the node that runs it,
+# and its responses carry the TTL so callers can keep the result too. Both caches are LRUs of a bounded size whose
+# entries also expire after their TTL.
+
+
+def arguments_key(args, kwargs):  # Hashable, order-independent key of a call's arguments
+    return json.dumps([args, kwargs], sort_keys=True, default=repr)
+
+
+class TTLCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: (expiry, value)}, least recently used first
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidated': 0}
+
+    # (True, value) if <key> is cached and fresh, otherwise (False, None)
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.counts['expired'] += 1
+                entry = None
+            if entry == None:
+                self.counts['misses'] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return True, entry[1]
+
+    def put(self, key, value, ttl):
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    # Drop every entry whose key <match> returns True for, or every entry. Returns how many were dropped.
+    def invalidate(self, match=None):
+        with self.lock:
+            keys = [k for k in self.entries.keys() if match == None or match(k)]
+            for k in keys:
+                del self.entries[k]
+            self.counts['invalidated'] += len(keys)
+            return len(keys)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries), max_entries=self.max_entries)
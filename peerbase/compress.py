@@ -0,0 +1,120 @@
+import threading
+import time
+import zlib
+import lzma
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed plaintext framing
+#
+# A message is compressed before it is sealed, and the plaintext inside the ciphertext becomes
+#   MAGIC (3 bytes) | codec id (1 byte) | compressed plaintext
+# where the compressed plaintext is a binary wire message or legacy JSON. Plaintext that does not
+# start with MAGIC is not compressed. Peers advertise the codecs they can decompress as capabilities
+# ("compress-zlib", ...), and a message is only compressed with a codec its recipient advertised.
+
+MAGIC = b'\xb7PZ'
+DEFAULT_THRESHOLD = 1024  # Plaintexts smaller than this many bytes are sent as is
+
+CODECS = {  # {name: (codec id, compress, decompress)}
+    'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (2, lambda data: lzma.compress(data, preset=1), lzma.decompress)
+}
+if zstandard != None:
+    CODECS['zstd'] = (3, lambda data: zstandard.ZstdCompressor(level=3).compress(data), lambda data: zstandard.ZstdDecompressor().decompress(data))
+CODEC_IDS = {v[0]: k for k, v in CODECS.items()}
+
+
+def capability(codec):
+    return f'compress-{codec}'
+
+
+CAPABILITIES = {capability(c) for c in CODECS.keys()}  # Codecs this process can decompress
+
+
+def is_compressed(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def compress(data, codec):  # Frame <data> compressed with <codec>
+    return MAGIC + bytes([CODECS[codec][0]]) + CODECS[codec][1](data)
+
+
+def decompress(data):  # Undo compress(), passing uncompressed plaintext through
+    if not is_compressed(data):
+        return data
+    codec = CODEC_IDS.get(data[len(MAGIC)])
+    if codec == None:
+        raise ValueError(f'Unknown compression codec {data[len(MAGIC)]}.')
+    return CODECS[codec][2](data[len(MAGIC) + 1:])
+
+
+class Compressor:
+    # Picks a codec for each recipient and keeps the ratio and time achieved, so <threshold> can be tuned.
+    # <codecs> lists the codecs to send with, best first; codecs that are not installed are skipped.
+    def __init__(self, codecs=['zstd', 'zlib'], threshold=DEFAULT_THRESHOLD):
+        self.codecs = [c for c in (codecs or []) if c in CODECS.keys()]
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.counts = {'small': 0, 'incompressible': 0}  # Messages sent as is: below the threshold, or not made smaller
+        self.codec_stats = {}  # {codec: {'messages', 'bytes_in', 'bytes_out', 'seconds', 'decompressed', 'decompress_seconds'}}
+
+    def _entry(self, codec):
+        if not codec in self.codec_stats.keys():
+            self.codec_stats[codec] = {'messages': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'decompressed': 0, 'decompress_seconds': 0.0}
+        return self.codec_stats[codec]
+
+    # The first of our codecs a recipient with <capabilities> can decompress, or None
+    def choose(self, capabilities):
+        for codec in self.codecs:
+            if capability(codec) in capabilities:
+                return codec
+        return None
+
+    # Compress plaintext <data> for a recipient with <capabilities> if that is possible and worth it
+    def compress(self, data, capabilities):
+        codec = self.choose(capabilities)
+        if codec == None:
+            return data
+        if len(data) < self.threshold:
+            with self.lock:
+                self.counts['small'] += 1
+            return data
+        start = time.perf_counter()
+        framed = compress(data, codec)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            if len(framed) >= len(data):
+                self.counts['incompressible'] += 1
+                return data
+            entry = self._entry(codec)
+            entry['messages'] += 1
+            entry['bytes_in'] += len(data)
+            entry['bytes_out'] += len(framed)
+            entry['seconds'] += elapsed
+        return framed
+
+    def decompress(self, data):
+        if not is_compressed(data):
+            return data
+        start = time.perf_counter()
+        plain = decompress(data)
+        with self.lock:
+            entry = self._entry(CODEC_IDS[data[len(MAGIC)]])
+            entry['decompressed'] += 1
+            entry['decompress_seconds'] += time.perf_counter() - start
+        return plain
+
+    # Counters plus, per codec, the achieved ratio (compressed / original size) and throughput in MB/s
+    def stats(self):
+        with self.lock:
+            ret = dict(self.counts, threshold=self.threshold, codecs={})
+            for codec, entry in self.codec_stats.items():
+                ret['codecs'][codec] = dict(
+                    entry,
+                    ratio=entry['bytes_out'] / entry['bytes_in'] if entry['bytes_in'] else None,
+                    mb_per_s=entry['bytes_in'] / entry['seconds'] / 1e6 if entry['seconds'] else None
+                )
+            return ret
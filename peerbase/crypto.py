@@ -0,0 +1,120 @@
+import base64
+import os
+import struct
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# AEAD message framing
+#
+# Raw ciphertext is either a Fernet token (first byte 0x80) or an AEAD frame:
+#   cipher id (1 byte) | stream (1 byte) | sender length (1 byte) | sender name | session id (8 bytes) | counter (u64) | sealed data
+# The sender picks a random session id each run. Each (sender, recipient, session) has its own key,
+# HKDF-SHA256(network key, info = cipher | network | sender | recipient | session id), and its own counter, which is the
+# nonce. Stream 1 is a multicast stream whose recipient is "*", as one ciphertext goes to many peers. The header is
+# authenticated as associated data. Receivers keep a sliding window of the counters they have accepted per stream and
+# reject repeats and counters that fell behind it.
+
+CIPHERS = {  # {name: (cipher id, AEAD class)}
+    'aes-gcm': (0xa1, AESGCM),
+    'chacha20': (0xa2, ChaCha20Poly1305)
+}
+CIPHER_IDS = {v[0]: k for k, v in CIPHERS.items()}
+UNICAST = 0
+MULTICAST = 1
+REPLAY_WINDOW = 4096  # Counters a stream may arrive out of order by
+MAX_STREAMS = 4096  # Receive streams (keys and replay windows) kept, least recently used dropped first
+
+_U64 = struct.Struct('>Q')
+_WINDOW_MASK = (1 << REPLAY_WINDOW) - 1
+
+
+def capability(cipher):
+    return f'aead-{cipher}'
+
+
+def is_aead(data):
+    return len(data) > 0 and data[0] in CIPHER_IDS.keys()
+
+
+class ReplayError(ValueError):
+    pass
+
+
+class ReplayWindow:
+    def __init__(self):
+        self.top = 0  # Highest counter accepted; counters start at 1
+        self.bitmap = 0  # Bit n set: counter top - n was accepted
+
+    # Accept <counter> once, if it is not behind the window
+    def accept(self, counter):
+        if counter > self.top:
+            self.bitmap = ((self.bitmap << (counter - self.top)) | 1) & _WINDOW_MASK
+            self.top = counter
+            return True
+        offset = self.top - counter
+        if offset >= REPLAY_WINDOW or (self.bitmap >> offset) & 1:
+            return False
+        self.bitmap |= 1 << offset
+        return True
+
+
+class SessionCrypto:
+    # Seals messages from <name> with <cipher> and opens AEAD frames from any peer of <network>
+    def __init__(self, network, name, network_key, cipher='aes-gcm'):
+        if not cipher in CIPHERS.keys():
+            raise ValueError(f'Unknown cipher {cipher}. Use one of {", ".join(CIPHERS.keys())}.')
+        self.network = network
+        self.name = name
+        self.cipher = cipher
+        self.master = base64.urlsafe_b64decode(network_key)
+        self.session = os.urandom(8)
+        self.lock = threading.Lock()
+        self.send_streams = {}  # {recipient or "*": [AEAD, last counter]}
+        self.receive_streams = OrderedDict()  # {(cipher, sender, session, stream): (AEAD, ReplayWindow)}
+
+    def derive(self, cipher, sender, recipient, session):
+        info = f'peerbase {cipher} {self.network} {sender} {recipient} '.encode('utf-8') + session
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(self.master)
+        return CIPHERS[cipher][1](key)
+
+    # Seal <data> for <recipient>, or for every recipient of a multicast
+    def seal(self, data, recipient, multicast=False):
+        stream = MULTICAST if multicast else UNICAST
+        recipient = '*' if multicast else recipient
+        with self.lock:
+            entry = self.send_streams.get(recipient)
+            if entry == None:
+                entry = self.send_streams[recipient] = [self.derive(self.cipher, self.name, recipient, self.session), 0]
+            entry[1] += 1
+            counter = entry[1]
+        name = self.name.encode('utf-8')
+        header = bytes([CIPHERS[self.cipher][0], stream, len(name)]) + name + self.session + _U64.pack(counter)
+        return header + entry[0].encrypt(b'\x00\x00\x00\x00' + _U64.pack(counter), data, header)
+
+    # Open an AEAD frame addressed to this node. Raises cryptography's InvalidTag if it was forged or altered,
+    # ReplayError if it was already opened.
+    def unseal(self, data):
+        try:
+            cipher, stream, length = CIPHER_IDS[data[0]], data[1], data[2]
+            sender = data[3:3 + length].decode('utf-8')
+            session = data[3 + length:11 + length]
+            (counter,) = _U64.unpack_from(data, 11 + length)
+        except (KeyError, IndexError, UnicodeDecodeError, struct.error):
+            raise ValueError('Malformed AEAD frame.')
+        key = (cipher, sender, session, stream)
+        with self.lock:
+            entry = self.receive_streams.get(key)
+        if entry == None:
+            entry = (self.derive(cipher, sender, '*' if stream == MULTICAST else self.name, session), ReplayWindow())
+        plain = entry[0].decrypt(b'\x00\x00\x00\x00' + _U64.pack(counter), data[19 + length:], data[:19 + length])
+        with self.lock:  # Only authentic frames create streams or move their window
+            entry = self.receive_streams.setdefault(key, entry)
+            self.receive_streams.move_to_end(key)
+            if len(self.receive_streams) > MAX_STREAMS:
+                self.receive_streams.popitem(last=False)
+            if not entry[1].accept(counter):
+                raise ReplayError(f'Replayed message {counter} from {sender}.')
+        return plain
@@ -0,0 +1,138 @@
+import bisect
+import contextvars
+import math
+import threading
+
+# Counters, gauges and latency histograms for a Node or Relay, read as a dict (the __metrics__ command) or in the
+# Prometheus text format (the relay's /metrics). Histograms have fixed buckets, so recording a value is a bisect and
+# a few additions under a lock. Series are named like Prometheus series: name{label="value",...}.
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+SPAN = contextvars.ContextVar('peerbase_span', default=None)  # Stage timings of the traced request running in this context
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def series(name, labels=()):
+    if len(labels) == 0:
+        return name
+    return name + '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the <q> quantile, or None without observations
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else math.inf
+        return math.inf
+
+    def cumulative(self):
+        ret, seen = [], 0
+        for n in self.counts:
+            seen += n
+            ret.append(seen)
+        return ret
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # {(name, labels): value}
+        self.gauges = {}
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.collectors = []  # [(name, function, label, kind)] read when the metrics are
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add(self, name, n, **labels):  # Move a gauge up or down
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    # Read <function> whenever the metrics are read. It returns a number, or {<label> value: number} for a series per value.
+    def register(self, name, function, label=None, kind='gauge'):
+        self.collectors.append((name, function, label, kind))
+
+    def collect(self):
+        counters, gauges = {}, {}
+        for name, function, label, kind in self.collectors:
+            values = function()
+            values = values.items() if label != None else [(None, values)]
+            for value, n in values:
+                (counters if kind == 'counter' else gauges)[(name, () if label == None else ((label, value),))] = n
+        with self.lock:
+            counters.update(self.counters)
+            gauges.update(self.gauges)
+            histograms = {k: (v.snapshot(), v.cumulative()) for k, v in self.histograms.items()}
+        return counters, gauges, histograms
+
+    # {'counters': {series: value}, 'gauges': {series: value}, 'histograms': {series: {count, sum, mean, p50, p90, p99}}}
+    def snapshot(self):
+        counters, gauges, histograms = self.collect()
+        return {
+            'counters': {series(*k): v for k, v in counters.items()},
+            'gauges': {series(*k): v for k, v in gauges.items()},
+            'histograms': {series(*k): v[0] for k, v in histograms.items()}
+        }
+
+    # Every metric in the Prometheus text exposition format, with names prefixed by <prefix>_
+    def prometheus(self, prefix):
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, values, suffix in [('counter', counters, '_total'), ('gauge', gauges, '')]:
+            for name in sorted(set(k[0] for k in values.keys())):
+                lines.append(f'# TYPE {prefix}_{name}{suffix} {kind}')
+                for (n, labels), value in values.items():
+                    if n == name:
+                        lines.append(f'{series(f"{prefix}_{name}{suffix}", labels)} {value}')
+        for name in sorted(set(k[0] for k in histograms.keys())):
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for (n, labels), (snapshot, cumulative) in histograms.items():
+                if n != name:
+                    continue
+                for le, seen in zip([*(str(b) for b in BUCKETS), '+Inf'], cumulative):
+                    lines.append(f'{series(f"{prefix}_{name}_bucket", labels + (("le", le),))} {seen}')
+                lines.append(f'{series(f"{prefix}_{name}_sum", labels)} {snapshot["sum"]}')
+                lines.append(f'{series(f"{prefix}_{name}_count", labels)} {snapshot["count"]}')
+        return '\n'.join(lines) + '\n'
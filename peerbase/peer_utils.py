@@ -1,6 +1,7 @@
 from socket import *
 from cryptography.fernet import Fernet
 import copy
+import warnings
 
 def key_generate():
     return Fernet.generate_key()
@@ -11,7 +12,9 @@ def ip():
 class InternalKeyError(KeyError):
     pass
 
+# Deprecated: look up dotted <path> in nested <obj>. Use Node().resolve_command() instead.
 def get_multikey(path, obj, sep='.'):
+    warnings.warn('get_multikey is deprecated; look commands up with Node().resolve_command() instead.', DeprecationWarning, stacklevel=2)
     cur = obj.copy()
     past = ['object']
     for i in path.split(sep):
@@ -27,4 +30,4 @@ def get_multikey(path, obj, sep='.'):
             past.append(i)
         except KeyError:
             raise InternalKeyError(f'Key {i} not found at path {".".join(past)}')
-    return cur
\ No newline at end of file
+    return cur
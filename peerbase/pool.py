@@ -0,0 +1,77 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    # Keeps one keep-alive requests.Session per address (peer or relay), evicting sessions left idle
+    def __init__(self, pool_size=4, idle_timeout=30):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _evict_idle(self, now):
+        if self.idle_timeout == None:
+            return
+        for address in list(self.sessions.keys()):
+            info = self.sessions[address]
+            if info['active'] == 0 and info['last_used'] + self.idle_timeout < now:
+                info['session'].close()
+                del self.sessions[address]
+
+    def _acquire(self, address):
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            if not address in self.sessions.keys():
+                self.sessions[address] = {
+                    'session': self._new_session(),
+                    'last_used': now,
+                    'active': 0
+                }
+            info = self.sessions[address]
+            info['last_used'] = now
+            info['active'] += 1
+            return info
+
+    def _release(self, info):
+        with self.lock:
+            info['active'] -= 1
+            info['last_used'] = time.time()
+
+    # Send a request to http://<address>/<path> over the pooled session for <address>
+    def request(self, method, address, path='', **kwargs):
+        info = self._acquire(address)
+        try:
+            return info['session'].request(method, f'http://{address}/{path}', **kwargs)
+        finally:
+            self._release(info)
+
+    def post(self, address, path='', **kwargs):
+        return self.request('POST', address, path=path, **kwargs)
+
+    # Close and forget the session for <address>
+    def discard(self, address):
+        with self.lock:
+            if address in self.sessions.keys():
+                self.sessions[address]['session'].close()
+                del self.sessions[address]
+
+    # Discard every session whose address is not in <live>
+    def prune(self, live):
+        for address in list(self.sessions.keys()):
+            if not address in live:
+                self.discard(address)
+
+    def close(self):
+        for address in list(self.sessions.keys()):
+            self.discard(address)
@@ -1,11 +1,20 @@
 import typing
 from starlette.status import HTTP_404_NOT_FOUND
 import uvicorn
+from uvicorn.protocols.http.h11_impl import H11Protocol
 from fastapi import status, FastAPI, Request, Response
 try:
     from peerbase.peer_utils import *
+    from peerbase import wire
+    from peerbase.relay_state import MemoryState, SQLiteState, Journal, write_atomic
+    from peerbase.pool import SessionPool
+    from peerbase.metrics import Metrics
 except ImportError:
     from peer_utils import *
+    import wire
+    from relay_state import MemoryState, SQLiteState, Journal, write_atomic
+    from pool import SessionPool
+    from metrics import Metrics
 from threading import Thread
 import base64
 import argparse
@@ -15,53 +24,198 @@ import os
 import logging
 import time
 import requests
+import asyncio
+import math
+from socket import IPPROTO_TCP, TCP_NODELAY
 
 logging.basicConfig(format='%(levelname)s:%(message)s',level=0)
 
+FEDERATION_CAPABILITY = 'federation'  # Relay forwards packets to peers attached to the relays it federates with
+FORWARDED_HEADER = 'X-PeerBase-Forwarded'  # Marks a packet forwarded by another relay, which is never forwarded again
+MULTICAST_CAPABILITY = 'multicast'  # Relay fans one packet out to the mailboxes of many peers
+
 app = FastAPI()
 
 class Relay:
-    def __init__(self, port, clear_time=1.5, save_to=None, peers={}, altservers=[]):
+    def __init__(self, port, clear_time=1.5, save_to=None, peers={}, altservers=[], max_wait=30, max_messages=1000, max_bytes=16777216, packet_ttl=30, state_backend='memory', state_db='relay_state.db', address=None, restore=False, worker=False):
         logging.info(f'Instantiating relay on port {str(port)}.')
         self.port = port
-        self.peers = peers
-        self.altservers = set(altservers)
         self.save_location = save_to
         self.clear_time = clear_time
+        self.max_wait = max_wait
+        self.max_messages = max_messages  # Per-peer mailbox caps
+        self.max_bytes = max_bytes
+        self.packet_ttl = packet_ttl
+        self.state_backend = state_backend
+        self.state_db = state_db
+        self.worker = worker  # One of several worker processes, which leave the save file to their parent process
+        if state_backend == 'memory':
+            self.state = MemoryState(peers=peers, altservers=altservers, packet_ttl=packet_ttl)
+        elif state_backend == 'sqlite':
+            self.state = SQLiteState(state_db, peers=peers, altservers=altservers)
+        else:
+            raise ValueError(f'Unknown state backend {state_backend}. Use "memory" or "sqlite".')
+        self.waiters = {}  # {peer name: asyncio.Event} set when a packet for the peer arrives
+        self.doorbell = None  # UDP transport other workers use to wake long-polls held by this one
+        self.doorbell_port = None
+        self.workers = []  # Doorbell ports of every worker, refreshed by check_peers_loop
+        self.address = address or f'{ip()}:{str(port)}'  # Address other relays reach this one at
+        self.pool = SessionPool()  # Keep-alive sessions to federated relays
+        self.federation = {}  # {relay address: [epoch, version] of the routing table it last sent}
+        self.aliases = set()  # Listed relay addresses that turned out to be this relay
+        self.snapshot_size = 0
+        self.metrics = Metrics()  # Request rates and latencies of this worker, served at /metrics
+        self.metrics.register('mailbox_messages', lambda: {k: v['messages'] for k, v in self.state.mailboxes().items()}, label='peer')
+        self.metrics.register('mailbox_bytes', lambda: {k: v['bytes'] for k, v in self.state.mailboxes().items()}, label='peer')
+        self.metrics.register('peers', lambda: len(self.state.names()))
+        self.metrics.register('packets', self.state.counters, label='outcome', kind='counter')
+        self.metrics.add('long_polls', 0)
+
+        if self.save_location and not self.state.durable:
+            # Changes since the last snapshot are journaled next to it; a restored relay replays them
+            journal = self.save_location + '.journal'
+            if restore:
+                self.state.restore(Journal.entries(journal))
+            else:
+                Journal.remove(journal)
+            self.state.journal = Journal(journal)
 
         self.save_state()
 
     @classmethod
-    def from_config(cls, path):  # Load new instance from config
+    def from_config(cls, path, worker=False):  # Load new instance from config
         logging.info(f'Loading new relay from config file {path}.')
         with open(path, 'r') as f:
             conf = json.load(f)
-        return cls(conf['port'], save_to=conf['save_location'], clear_time=conf['clear_time'])
+        return cls(conf['port'], save_to=conf['save_location'], clear_time=conf['clear_time'], worker=worker, **cls.options(conf))
 
     @classmethod
-    def from_state(cls, path, config=None):  # Load saved instance from JSON file
+    def from_state(cls, path, config=None, worker=False):  # Load saved instance from JSON file
         logging.info(f'Loading saved relay from state file {path}.')
         if os.path.exists(path):
             with open(path, 'r') as f:
                 conf = json.load(f)
-            return cls(conf['port'], save_to=conf['save_location'], peers=conf['peers'], altservers=conf['altservers'], clear_time=conf['clear_time'])
+            return cls(conf['port'], save_to=conf['save_location'], peers=conf['peers'], altservers=conf['altservers'], clear_time=conf['clear_time'], restore=True, worker=worker, **cls.options(conf))
         elif config:
             logging.warning(f'No state file found at {path}. Loading new instance from config file {config}')
-            return cls.from_config(config)
+            return cls.from_config(config, worker=worker)
         else:
             raise OSError('State file not found and no initial configuration file has been provided.')
 
+    @staticmethod
+    def options(conf):  # Optional settings of a config or state file, with their defaults
+        return {
+            'max_wait': conf.get('max_wait', 30),
+            'max_messages': conf.get('max_messages', 1000),
+            'max_bytes': conf.get('max_bytes', 16777216),
+            'packet_ttl': conf.get('packet_ttl', 30),
+            'state_backend': conf.get('state_backend', 'memory'),
+            'state_db': conf.get('state_db', 'relay_state.db'),
+            'address': conf.get('address')
+        }
+
+    # Write a compacted snapshot of the state and start a new journal. Durable backends keep their own state, so only settings are saved.
     def save_state(self):
-        if self.save_location:
-            with open(self.save_location, 'w') as f:
-                state = {
-                    'port': self.port,
-                    'save_location': self.save_location,
-                    'peers': self.peers,
-                    'altservers': list(self.altservers),
-                    'clear_time': self.clear_time
-                }
-                json.dump(state, f)
+        if self.save_location and not self.worker:
+            if self.state.durable:
+                peers, servers = {}, self.state.servers()
+            else:
+                peers, servers = self.state.checkpoint()
+            state = {
+                'port': self.port,
+                'save_location': self.save_location,
+                'peers': peers,
+                'altservers': servers,
+                'clear_time': self.clear_time,
+                'max_wait': self.max_wait,
+                'max_messages': self.max_messages,
+                'max_bytes': self.max_bytes,
+                'packet_ttl': self.packet_ttl,
+                'state_backend': self.state_backend,
+                'state_db': self.state_db,
+                'address': self.address
+            }
+            data = json.dumps(state, default=wire.to_text)  # Binary packets are saved in legacy text form
+            write_atomic(self.save_location, data)
+            self.snapshot_size = len(data)
+            if self.state.journal != None:
+                self.state.journal.discard_rotated()
+
+    # Compact once the journal outgrows the snapshot, so persistence costs stay proportional to the change volume
+    def journal_full(self):
+        return self.state.journal_size() > max(1048576, self.snapshot_size)
+
+    # Remove peers that have not pinged within clear_time. Peers holding a long-poll open are kept alive by their ping.
+    def expire_peers(self):
+        return self.state.expire_peers(self.clear_time)
+
+    # Call state method <fn> from the event loop. A shared backend can wait on other workers' write locks, so it runs in an executor.
+    async def run_state(self, fn, *args):
+        if not self.state.shared:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    # Wake every long-poll held by this worker so nodes pick up membership changes
+    def wake_all(self):
+        for event in list(self.waiters.values()):
+            event.set()
+
+    # Wake long-polls waiting on <name> ("*" for every peer) in this worker and, through their doorbells, in all others
+    def notify(self, name):
+        if name == '*':
+            self.wake_all()
+        elif name in self.waiters.keys():
+            self.waiters[name].set()
+        if self.doorbell != None:
+            for port in self.workers:
+                if port != self.doorbell_port:
+                    self.doorbell.sendto(name.encode('utf-8'), ('127.0.0.1', port))
+
+    # Exchange routing tables with federated relay <server>: fetch the peers attached to it (a delta once we have a version)
+    # and tell it about this relay. Returns True if the routes changed.
+    def federate(self, server):
+        try:
+            resp = self.pool.post(server, 'routes', json={'relay': self.address, 'membership': self.federation.get(server)}, timeout=5)
+            if resp.status_code != 200:  # A relay without federation
+                raise requests.ConnectionError
+            dat = resp.json()
+        except (requests.ConnectionError, requests.Timeout, ValueError):
+            self.federation.pop(server, None)
+            return self.state.update_routes(server, {}, [], full=True)
+        if dat['membership'][0] == self.state.epoch:
+            self.aliases.add(server)
+            return False
+        self.federation[server] = dat['membership']
+        if 'peers' in dat:
+            self.state.add_servers(dat['servers'])
+            return self.state.update_routes(server, {i: dat['peer_capabilities'].get(i, []) for i in dat['peers']}, [], full=True)
+        self.state.add_servers(dat['servers_added'])
+        return self.state.update_routes(server, dat['joined'], dat['left'])
+
+    # Pass a packet for a peer attached to federated relay <server> on to it. Returns (status, headers, body).
+    def forward(self, server, packet, path='send/bin'):
+        packet = dict(packet, data=wire.to_raw(packet['data']))
+        try:
+            resp = self.pool.post(server, path, data=wire.dumps(packet), timeout=5,
+                                  headers={'Content-Type': wire.CONTENT_TYPE, FORWARDED_HEADER: self.address})
+            return resp.status_code, resp.headers, wire.loads(resp.content)
+        except (requests.ConnectionError, requests.Timeout, ValueError):
+            return status.HTTP_502_BAD_GATEWAY, {}, {'detail': f'relay {server} could not be reached.'}
+
+    # Buffer <packet> for <target>, dropping expired packets to make room if its mailbox is full. Returns "accepted", "missing" or "full".
+    def admit(self, target, pid, packet, size):
+        result = self.state.enqueue(target, pid, packet, size, self.packet_ttl, self.max_messages, self.max_bytes)
+        if result == 'full' and self.state.expire_packets(target) > 0:  # Stale packets made room
+            result = self.state.enqueue(target, pid, packet, size, self.packet_ttl, self.max_messages, self.max_bytes)
+        return result
+
+    # Seconds a sender should wait before retrying <name>'s full mailbox: until the peer's next ping or the oldest packet's expiry
+    def retry_after(self, name):
+        wait = self.clear_time
+        oldest = self.state.oldest_expiry(name)
+        if oldest != None:
+            wait = min(wait, oldest - time.time())
+        return max(1, math.ceil(wait))
 
     def decode(self, data):  # Recieves encrypted data in base64, returns string of data
         if type(data) == bytes:
@@ -87,54 +241,159 @@ parser.add_argument(
     '--saveloc', help='Location to save the server state to. Defaults to None, in which case no states will be saved.', default=None)
 parser.add_argument(
     '--timeout', help='Seconds to wait for another keepalive request before removing an active peer.', default=0.5, type=float)
+parser.add_argument(
+    '--max-wait', help='Maximum seconds a long-poll /ping may be held open while waiting for packets.', default=30, type=float, dest='max_wait')
+parser.add_argument(
+    '--max-messages', help='Maximum number of packets buffered for a single peer.', default=1000, type=int, dest='max_messages')
+parser.add_argument(
+    '--max-bytes', help='Maximum total size in bytes of the packets buffered for a single peer.', default=16777216, type=int, dest='max_bytes')
+parser.add_argument(
+    '--packet-ttl', help='Seconds a buffered packet may wait for its peer before it is dropped.', default=30, type=float, dest='packet_ttl')
+parser.add_argument(
+    '--state-backend', help='Where peers and mailboxes are kept: "memory" (single worker) or "sqlite" (shared by all workers).', default='memory', choices=['memory', 'sqlite'], dest='state_backend')
+parser.add_argument(
+    '--state-db', help='SQLite database file used by the sqlite state backend.', default='relay_state.db', dest='state_db')
+parser.add_argument(
+    '--address', help='Address (ip:port) other relays reach this relay at. Defaults to this machine\'s IP and --port.', default=None)
+parser.add_argument(
+    '--workers', help='Number of relay worker processes. More than one requires --state-backend sqlite.', default=1, type=int)
 
-args = parser.parse_args()
+# Build a relay from command-line arguments (sys.argv if <argv> is None). Returns (parsed arguments, Relay).
+# With <worker>, the relay is one of the --workers processes serving the app, and does not write the save file.
+def relay_from_args(argv=None, worker=False):
+    args = parser.parse_args(argv)
+    if args.state:
+        return args, Relay.from_state(args.state, config=args.config, worker=worker)
+    elif args.config:
+        return args, Relay.from_config(args.config, worker=worker)
+    elif args.port > 0:
+        return args, Relay(args.port, 
+                        save_to=args.saveloc, clear_time=args.timeout, max_wait=args.max_wait,
+                        max_messages=args.max_messages, max_bytes=args.max_bytes, packet_ttl=args.packet_ttl,
+                        state_backend=args.state_backend, state_db=args.state_db, address=args.address, worker=worker)
+    else:
+        raise ValueError(
+            'Please include --state, --config, or [--port, and optionally --saveloc]')
 
-if args.state:
-    relay = Relay.from_state(args.state, config=args.config)
-elif args.config:
-    relay = Relay.from_config(args.config)
-elif args.port > 0:
-    relay = Relay(args.port, 
-                    save_to=args.saveloc, clear_time=args.timeout)
-else:
-    raise ValueError(
-        'Please include --state, --config, or [--port, and optionally --saveloc]')
+# The relay the app serves. Set from the command line when this file is run as a script (or loaded as "relay" by
+# uvicorn for it); programs that import peerbase.relay set it themselves, e.g. with serve_in_thread().
+relay = None
+if __name__ in ['__main__', 'relay']:
+    # With several workers, each loads this module as "relay" in its own process; the __main__ process owns the save file
+    args, relay = relay_from_args(worker=__name__ == 'relay' and parser.parse_args().workers > 1)
 
 # Define endpoints
 class PingRequestModel(BaseModel):
     node_name: str
     known_servers: list
+    wait: float = 0  # Seconds to hold the request open while the peer's buffer is empty
+    capabilities: list = []
+    membership: typing.Optional[list] = None  # [epoch, version] of the membership the node last saw, to get a delta
 
 @app.get('/')
 async def root():
     return {'time':time.ctime()}
 
-@app.post('/ping')
-async def ping(model: PingRequestModel, request: Request, response: Response):
+def binary_response(content, response):
+    headers = {k: v for k, v in response.headers.items() if not k.lower() in ['content-length', 'content-type']}
+    return Response(content=wire.dumps(content), media_type=wire.CONTENT_TYPE, status_code=response.status_code or status.HTTP_200_OK, headers=headers)
+
+async def handle_ping(model, request, response):
     global relay
-    if model.node_name in relay.peers.keys():
-        relay.peers[model.node_name]['timeout'] = time.time()
-    else:
-        relay.peers[model.node_name] = {
-            'timeout':time.time(),
-            'buffer':{}
-        }
+    relay.metrics.count('requests', endpoint=request.url.path)
+    wait = min(model.wait, relay.max_wait)
+    if wait > 0:  # Cleared before the ping reads the mailbox, so a packet landing in between still wakes the long-poll
+        event = relay.waiters.setdefault(model.node_name, asyncio.Event())
+        event.clear()
+    since = model.membership[1] if model.membership != None and model.membership[0] == relay.state.epoch else None
+    new, expired, version, wait, buf = await relay.run_state(
+        relay.state.ping, model.node_name, model.capabilities, model.known_servers, relay.clear_time, wait, since)
+    if new:
         logging.info(f'New connection from {model.node_name}')
-    for s in model.known_servers:
-        if not s in relay.altservers:
-            relay.altservers.add(s)
-    buf = relay.peers[model.node_name]['buffer'].copy()
-    relay.peers[model.node_name]['buffer'] = {}
-    for i in list(relay.peers.keys()):
-        if relay.peers[i]['timeout'] + relay.clear_time < time.time():
-            del relay.peers[i]
+    if new or expired:
+        relay.notify('*')
+
+    # Long-poll: hold the request until a packet lands for this peer, membership changes or the wait expires.
+    # The ping kept the peer alive for the whole wait, in every worker.
+    if wait > 0:
+        end = time.time() + wait
+        relay.metrics.add('long_polls', 1)
+        try:
+            while time.time() < end:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(end - time.time(), relay.state.poll_interval or wait))
+                    break
+                except asyncio.TimeoutError:  # Fallback for a missed doorbell from another worker
+                    if await relay.run_state(relay.state.pending, model.node_name) > 0 or await relay.run_state(relay.state.membership_version) != version:
+                        break
+        finally:
+            relay.metrics.add('long_polls', -1)
+        if not await relay.run_state(relay.state.exists, model.node_name):
+            relay.waiters.pop(model.node_name, None)
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return {'detail': f'peer {model.node_name} expired.'}
+        if await request.is_disconnected():  # Keep the buffer for the next ping
+            return {}
+        buf = await relay.run_state(relay.state.drain, model.node_name)
+
+    now = time.time()
+    for packet in buf.values():  # Tell the peer how long each packet waited in its mailbox
+        queued = packet.pop('queued', None)
+        if queued != None:
+            packet['waited'] = max(0.0, now - queued)
+            relay.metrics.observe('queue_seconds', packet['waited'])
+    return dict(await relay.run_state(membership, model), buffer=buf, long_poll=True, relay_capabilities=[wire.CAPABILITY, FEDERATION_CAPABILITY, MULTICAST_CAPABILITY])
+
+# Peers and relays for a ping: joins and leaves since the node's membership version, or full lists if it has none or is too far behind.
+# Peers attached to federated relays are included unless <routes> is False.
+def membership(model, routes=True):
+    epoch = relay.state.epoch
+    if model.membership != None and model.membership[0] == epoch:
+        version, delta = relay.state.membership_since(model.membership[1], routes)
+        if delta != None:
+            return dict(delta, membership=[epoch, version])
+    version = relay.state.membership_version()  # Read first: changes racing the lists below are resent in the next delta
+    peers, capabilities = relay.state.names(), relay.state.capabilities()
+    if routes:
+        routed, local = relay.state.routed(), set(peers)
+        peers.extend(i for i in routed.keys() if not i in local)
+        capabilities = {**routed, **capabilities}
     return {
-        'peers': list(relay.peers.keys()),
-        'servers': list(relay.altservers),
-        'buffer': buf
+        'peers': peers,
+        'servers': relay.state.servers(),
+        'peer_capabilities': capabilities,
+        'membership': [epoch, version]
     }
 
+class RoutesRequestModel(BaseModel):
+    relay: str  # Address of the asking relay
+    membership: typing.Optional[list] = None
+
+# Routing table exchange between federated relays: the peers attached to this relay, as a delta when possible
+@app.post('/routes')
+async def routes(model: RoutesRequestModel):
+    await relay.run_state(relay.state.add_servers, [model.relay])
+    return await relay.run_state(membership, model, False)
+
+@app.post('/ping')
+async def ping(model: PingRequestModel, request: Request, response: Response):
+    result = await handle_ping(model, request, response)
+    for packet in result.get('buffer', {}).values():
+        packet['data'] = wire.to_text(packet['data'])
+    return result
+
+@app.post('/ping/bin')
+async def ping_bin(request: Request, response: Response):
+    try:
+        model = PingRequestModel(**wire.loads(await request.body()))
+    except (ValueError, TypeError):
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return binary_response({'detail': 'malformed ping.'}, response)
+    result = await handle_ping(model, request, response)
+    for packet in result.get('buffer', {}).values():
+        packet['data'] = wire.to_raw(packet['data'])
+    return binary_response(result, response)
+
 class SendDataRequestModel(BaseModel):
     target: str
     data: str
@@ -143,53 +402,253 @@ class SendDataRequestModel(BaseModel):
     r_type: str
     remote_addr: str
 
+# Relay a request's target should send its response to. A packet forwarded by a federated relay is answered through
+# this relay, which forwards the response to the originator's relay over its routes, so the target never has to
+# reach a relay it has no session with.
+def answer_through(packet, request):
+    if FORWARDED_HEADER in request.headers.keys():
+        return relay.address
+    return packet['remote_addr']
+
+async def handle_send(packet, request, response):
+    global relay
+    relay.metrics.count('requests', endpoint=request.url.path)
+    start = time.perf_counter()
+    try:
+        return await enqueue_send(packet, request, response)
+    finally:
+        relay.metrics.observe('send_seconds', time.perf_counter() - start)
+
+async def enqueue_send(packet, request, response):
+    logging.info(f'Packet {packet["originator"]} -> {packet["target"]}')
+    size = len(packet['data'])
+    if size > relay.max_bytes:
+        await relay.run_state(relay.state.count, 'rejected')
+        response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        return {'detail':f'packet of {size} bytes exceeds the {relay.max_bytes} byte mailbox limit.'}
+    buffered = {
+        'originator': packet['originator'],
+        'data': packet['data'],
+        'type': packet['r_type'],
+        'remote': answer_through(packet, request),
+        'queued': time.time()
+    }
+    result = await relay.run_state(relay.admit, packet['target'], packet['packet_id'], buffered, size)
+    if result == 'missing' and not FORWARDED_HEADER in request.headers.keys():
+        server = await relay.run_state(relay.state.route, packet['target'])
+        if server != None:
+            code, headers, body = await asyncio.get_running_loop().run_in_executor(None, relay.forward, server, packet)
+            response.status_code = code
+            if 'Retry-After' in headers.keys():
+                response.headers['Retry-After'] = headers['Retry-After']
+            if code == status.HTTP_200_OK:
+                await relay.run_state(relay.state.count, 'forwarded')
+            return body
+    if result == 'missing':
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {'detail':f'target {packet["target"]} not found in peers.'}
+    if result == 'full':
+        response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        response.headers['Retry-After'] = str(await relay.run_state(relay.retry_after, packet['target']))
+        return {'detail':f'mailbox of {packet["target"]} is full.'}
+    relay.notify(packet['target'])
+    return {'pid': packet['packet_id']}
+
 @app.post('/send')
 async def send(model: SendDataRequestModel, request: Request, response: Response):
+    return await handle_send(dict(model), request, response)
+
+@app.post('/send/bin')
+async def send_bin(request: Request, response: Response):
+    try:
+        packet = wire.loads(await request.body())
+        if not all(type(packet.get(k)) == str for k in ['target', 'packet_id', 'originator', 'r_type', 'remote_addr']) or type(packet.get('data')) != bytes:
+            raise ValueError
+    except (ValueError, TypeError, AttributeError):
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return binary_response({'detail': 'malformed packet.'}, response)
+    return binary_response(await handle_send(packet, request, response), response)
+
+class MulticastRequestModel(BaseModel):
+    targets: typing.Union[list, str]  # Peer names, or '*' for every peer but the originator
+    data: str
+    packet_id: str
+    originator: str
+    r_type: str
+    remote_addr: str
+
+# Enqueue one packet for many targets. Each copy gets the packet id <packet_id>:<target> (':' is reserved in names);
+# targets attached to federated relays are forwarded as one multicast per relay.
+async def handle_multicast(packet, request, response):
     global relay
-    logging.info(f'Packet {model.originator} -> {model.target}')
-    if not model.target in relay.peers.keys():
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return {'detail':f'target {model.target} not found in peers.'}
-    relay.peers[model.target]['buffer'][model.packet_id] = {
-        'originator': model.originator,
-        'data': model.data,
-        'type': model.r_type,
-        'remote': model.remote_addr
+    relay.metrics.count('requests', endpoint=request.url.path)
+    size = len(packet['data'])
+    if size > relay.max_bytes:
+        await relay.run_state(relay.state.count, 'rejected')
+        response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        return {'detail':f'packet of {size} bytes exceeds the {relay.max_bytes} byte mailbox limit.'}
+    await relay.run_state(relay.state.count, 'multicast')
+    forwarded = FORWARDED_HEADER in request.headers.keys()
+    targets = packet['targets']
+    if targets == '*':
+        targets = await relay.run_state(relay.state.names) + ([] if forwarded else list((await relay.run_state(relay.state.routed)).keys()))
+    logging.info(f'Multicast {packet["originator"]} -> {len(targets)} peers')
+    buffered = {
+        'originator': packet['originator'],
+        'data': packet['data'],
+        'type': packet['r_type'],
+        'remote': answer_through(packet, request),
+        'queued': time.time()
+    }
+    result = {'accepted': [], 'missing': [], 'full': []}
+    remote = {}  # {relay address: [targets attached to it]}
+    for target in dict.fromkeys(targets):
+        if target == packet['originator']:
+            continue
+        pid = f'{packet["packet_id"]}:{target}'
+        outcome = await relay.run_state(relay.admit, target, pid, buffered, size)
+        if outcome == 'missing' and not forwarded:
+            server = await relay.run_state(relay.state.route, target)
+            if server != None:
+                remote.setdefault(server, []).append(target)
+                continue
+        result[outcome].append(target)
+        if outcome == 'accepted':
+            relay.notify(target)
+    loop = asyncio.get_running_loop()
+    servers = list(remote.keys())
+    answers = await asyncio.gather(*[loop.run_in_executor(None, relay.forward, s, dict(packet, targets=remote[s]), 'multicast/bin') for s in servers])
+    for server, (code, headers, body) in zip(servers, answers):
+        if code != status.HTTP_200_OK:
+            result['missing'].extend(remote[server])
+            continue
+        for k in result.keys():
+            result[k].extend(body.get(k, []))
+        await relay.run_state(relay.state.count, 'forwarded', len(body.get('accepted', [])))
+    if len(result['full']) > 0:
+        response.headers['Retry-After'] = str(min([await relay.run_state(relay.retry_after, t) for t in result['full']]))
+    return result
+
+@app.post('/multicast')
+async def multicast(model: MulticastRequestModel, request: Request, response: Response):
+    return await handle_multicast(dict(model), request, response)
+
+@app.post('/multicast/bin')
+async def multicast_bin(request: Request, response: Response):
+    try:
+        packet = wire.loads(await request.body())
+        if not all(type(packet.get(k)) == str for k in ['packet_id', 'originator', 'r_type', 'remote_addr']) or type(packet.get('data')) != bytes:
+            raise ValueError
+        if packet.get('targets') != '*' and not (type(packet.get('targets')) == list and all(type(t) == str for t in packet['targets'])):
+            raise ValueError
+    except (ValueError, TypeError, AttributeError):
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return binary_response({'detail': 'malformed packet.'}, response)
+    return binary_response(await handle_multicast(packet, request, response), response)
+
+@app.get('/stats')
+async def stats():
+    await relay.run_state(relay.state.expire_packets)
+    return {
+        'counters': await relay.run_state(relay.state.counters),
+        'mailboxes': await relay.run_state(relay.state.mailboxes)
     }
-    return {'pid': model.packet_id}
+
+# Counters, gauges and latency histograms of this worker in the Prometheus text format
+@app.get('/metrics')
+async def metrics():
+    await relay.run_state(relay.state.expire_packets)
+    content = await relay.run_state(relay.metrics.prometheus, 'peerbase_relay')  # Its gauges read the state
+    return Response(content=content, media_type='text/plain; version=0.0.4')
 
 def check_peers_loop():
     global relay
     while True:
-        for i in list(relay.peers.keys()):
-            if relay.peers[i]['timeout'] + relay.clear_time < time.time():
-                del relay.peers[i]
+        relay.expire_peers()
+        relay.state.expire_packets()
+        if relay.doorbell_port != None:
+            relay.state.register_worker(relay.doorbell_port)  # Keep this worker's doorbell listed
+            relay.workers = relay.state.worker_ports()
         time.sleep(relay.clear_time)
 
 def check_altservers_loop():
     global relay
     while True:
-        for s in list(relay.altservers):
+        for s in relay.state.servers():
             try:
-                requests.get(s)
-            except requests.ConnectionError:
-                relay.altservers.remove(s)
+                requests.get(f'http://{s}/', timeout=5)
+            except (requests.ConnectionError, requests.Timeout):
+                relay.state.remove_server(s)
         time.sleep(30)
 
+# Keep routing tables of federated relays (every relay in altservers) current, and wake long-polls when they change
+async def federation_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        servers = [s for s in await relay.run_state(relay.state.servers) if not s in relay.aliases]
+        changed = await asyncio.gather(*[loop.run_in_executor(None, relay.federate, s) for s in servers])
+        if any(changed):
+            relay.notify('*')
+        await asyncio.sleep(relay.clear_time)
+
 def save_state_loop():
     global relay
     while True:
-        relay.save_state()
+        if relay.journal_full():
+            relay.save_state()
         time.sleep(5)
 
-check_peers_thread = Thread(target=check_peers_loop, name='peerbase.relay.check_peers', daemon=True)
-check_altservers_thread = Thread(target=check_altservers_loop, name='peerbase.relay.check_altservers', daemon=True)
-save_state_thread = Thread(target=save_state_loop, name='peerbase.relay.save_state', daemon=True)
+# uvicorn's multi-worker listener socket makes asyncio skip TCP_NODELAY on accepted connections, which
+# holds the body of every long-poll response back by a delayed ACK (~40 ms)
+class RelayHTTPProtocol(H11Protocol):
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        if sock != None:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        super().connection_made(transport)
+
+class Doorbell(asyncio.DatagramProtocol):  # Receives peer names from workers that buffered packets for them
+    def datagram_received(self, data, addr):
+        name = data.decode('utf-8', 'replace')
+        if name == '*':
+            relay.wake_all()
+        elif name in relay.waiters.keys():
+            relay.waiters[name].set()
+
+# Background loops start with the server so they act on the relay instance the served app uses.
+# (When run as a script, this module is loaded twice: once as __main__ and once as relay for uvicorn.)
+@app.on_event('startup')
+async def start_background_loops():
+    if relay.state.shared:
+        relay.doorbell, _ = await asyncio.get_running_loop().create_datagram_endpoint(Doorbell, local_addr=('127.0.0.1', 0))
+        relay.doorbell_port = relay.doorbell.get_extra_info('sockname')[1]
+        relay.state.register_worker(relay.doorbell_port)
+    Thread(target=check_peers_loop, name='peerbase.relay.check_peers', daemon=True).start()
+    Thread(target=check_altservers_loop, name='peerbase.relay.check_altservers', daemon=True).start()
+    asyncio.get_running_loop().create_task(federation_loop())
+    if relay.save_location and not relay.state.durable:
+        Thread(target=save_state_loop, name='peerbase.relay.save_state', daemon=True).start()
+
+# Serve <instance> from a background thread of this process. Returns the uvicorn.Server once it accepts connections;
+# set its should_exit to stop it. Only one relay can be served per process.
+def serve_in_thread(instance, timeout=10):
+    global relay
+    relay = instance
+    server = uvicorn.Server(uvicorn.Config(app, host=ip(), port=instance.port, access_log=False, log_level='warning'))
+    Thread(target=server.run, name='peerbase.relay.server', daemon=True).start()
+    deadline = time.time() + timeout
+    while not server.started:
+        if time.time() > deadline:
+            raise TimeoutError(f'Relay did not start on port {instance.port} within {timeout} seconds.')
+        time.sleep(0.01)
+    return server
 
 if __name__ == '__main__':
+    if args.workers > 1 and relay.state_backend != 'sqlite':
+        raise ValueError('Running more than one worker requires --state-backend sqlite.')
     print([i.path for i in app.routes])
     logging.info(f'Starting relay server on http://{ip()}:{str(relay.port)}')
-    check_peers_thread.start()
-    check_altservers_thread.start()
-    save_state_thread.start()
-    uvicorn.run('relay:app', host=ip(), port=relay.port, access_log=False)
+    if args.workers > 1:
+        uvicorn.run('relay:app', host=ip(), port=relay.port, access_log=False, workers=args.workers, http=RelayHTTPProtocol)
+    else:
+        uvicorn.run('relay:app', host=ip(), port=relay.port, access_log=False)
@@ -0,0 +1,700 @@
+import threading
+import sqlite3
+import time
+import json
+import os
+import heapq
+import tempfile
+from collections import deque
+try:
+    from peerbase import wire
+except ImportError:
+    import wire
+
+# Relay state backends: the peer registry, per-peer mailboxes, known relays and counters.
+# MemoryState keeps everything in this process and only supports one relay worker.
+# SQLiteState keeps it in a SQLite database in WAL mode, shared by every worker on the host.
+
+COUNTERS = ['accepted', 'delivered', 'rejected', 'expired', 'dropped', 'forwarded', 'multicast']
+MEMBERSHIP_HISTORY = 1000  # Membership changes kept for delta pings. Nodes further behind get the full lists.
+
+
+# Collapse (kind, name, capabilities) membership changes, oldest first, into what a node has to apply.
+# Peers routed through federated relays count as members unless <routes> is False (the view other relays get).
+# Each peer named in the changes is reported as it is now: <reachable(name, routes)> gives its current capabilities, or None if it is gone.
+def membership_delta(changes, reachable, routes=True):
+    peers = set()
+    delta = {'joined': {}, 'left': [], 'servers_added': set(), 'servers_removed': set()}
+    for kind, name, capabilities in changes:
+        if kind in ['join', 'leave'] or (routes and kind in ['route', 'unroute']):
+            peers.add(name)
+        elif kind == 'server':
+            delta['servers_added'].add(name)
+            delta['servers_removed'].discard(name)
+        elif kind == 'unserver':
+            delta['servers_added'].discard(name)
+            delta['servers_removed'].add(name)
+    for name in peers:
+        capabilities = reachable(name, routes)
+        if capabilities == None:
+            delta['left'].append(name)
+        else:
+            delta['joined'][name] = capabilities
+    return {k: v if k in ['joined', 'left'] else list(v) for k, v in delta.items()}
+
+
+# Seconds a ping should be held open as a long-poll: only while the peer has nothing to take and has not missed
+# membership changes since version <since> (None if it has no version of this epoch)
+def hold_time(wait, messages, version, since):
+    return wait if wait > 0 and messages == 0 and (since == None or since == version) else 0
+
+
+def new_epoch():  # Identifies one run of membership versions; nodes holding another epoch's version need a full resync
+    return int.from_bytes(os.urandom(6), 'big')
+
+
+# Write <data> to <path> so that a crash leaves either the old or the new file, never a partial one.
+# Each write gets its own temporary file, so concurrent writers never rename each other's.
+def write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# Append-only log of MemoryState changes, one JSON list per line. Every entry sets state absolutely
+# ("peer x has packet p", "peer x's mailbox is empty"), so replaying entries a snapshot already holds is harmless.
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def append(self, entry):
+        line = json.dumps(entry, default=wire.to_text) + '\n'  # Binary packets are journaled in legacy text form
+        self.file.write(line)
+        self.file.flush()  # Survives a crash of the relay process; snapshots are fsynced
+        self.size += len(line)
+
+    # Move the log aside to <path>.old and start an empty one. Entries in .old are covered by the snapshot being written.
+    def rotate(self):
+        self.file.close()
+        os.replace(self.path, self.path + '.old')
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def discard_rotated(self):
+        if os.path.exists(self.path + '.old'):
+            os.remove(self.path + '.old')
+
+    def close(self):
+        self.file.close()
+
+    # Entries of a journal at <path>, including a rotated log a crash left behind, oldest first
+    @staticmethod
+    def entries(path):
+        for p in [path + '.old', path]:
+            if os.path.exists(p):
+                with open(p, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:  # Torn final line from a crash mid-append
+                            break
+
+    @staticmethod
+    def remove(path):
+        for p in [path + '.old', path]:
+            if os.path.exists(p):
+                os.remove(p)
+
+
+class MemoryState:
+    durable = False  # Must be saved with Relay.save_state to survive a restart
+    shared = False  # Visible to other worker processes
+    poll_interval = None  # Every worker shares this process, so asyncio events alone wake long-polls
+
+    def __init__(self, peers={}, altservers=[], packet_ttl=30):
+        self.lock = threading.Lock()
+        self.packet_ttl = packet_ttl
+        self.peers = {name: self.mailbox(peer) for name, peer in peers.items()}
+        self.altservers = set(altservers)
+        self.counts = {k: 0 for k in COUNTERS}
+        self.version = 0  # Bumped on every membership change: peers joining, leaving or changing capabilities, and relays
+        self.epoch = new_epoch()
+        self.changes = deque(maxlen=MEMBERSHIP_HISTORY)  # (version, kind, name, capabilities)
+        self.routes = {}  # {peer name: (relay address, capabilities)} for peers attached to federated relays
+        self.journal = None  # Journal recording every change, if the relay persists its state
+        self.schedule()
+
+    def changed(self, kind, name, capabilities=None):  # Called with the lock held
+        self.version += 1
+        self.changes.append((self.version, kind, name, capabilities))
+
+    # Expiry queue: a min-heap with one (deadline, name) entry per peer. Pings only move a peer's timeout;
+    # its entry catches up when it reaches the top of the heap, so a ping is O(1) and expiry O(log N) per popped entry.
+    # Packets have a heap of (expiry, peer name, packet id) of their own. Entries of packets that were drained or
+    # replaced are skipped when popped, so a sweep only touches packets that are due.
+    def schedule(self):
+        self.deadlines = [(p['timeout'], name) for name, p in self.peers.items()]
+        heapq.heapify(self.deadlines)
+        self.expiries = [(p['expires'], name, pid) for name, peer in self.peers.items() for pid, p in peer['buffer'].items()]
+        heapq.heapify(self.expiries)
+
+    def log(self, *entry):  # Called with the lock held
+        if self.journal != None:
+            self.journal.append(entry)
+
+    # Replay journal entries on top of the loaded snapshot
+    def restore(self, entries):
+        for entry in entries:
+            kind, name = entry[0], entry[1]
+            if kind == 'peer':
+                self.peers.setdefault(name, {'timeout': time.time(), 'buffer': {}})['capabilities'] = entry[2]
+            elif kind == 'drop':
+                self.peers.pop(name, None)
+            elif kind == 'put' and name in self.peers.keys():
+                self.peers[name]['buffer'][entry[2]] = entry[3]
+            elif kind == 'take' and name in self.peers.keys():
+                self.peers[name]['buffer'] = {}
+            elif kind == 'del' and name in self.peers.keys():
+                self.peers[name]['buffer'].pop(entry[2], None)
+            elif kind == 'server':
+                self.altservers.add(name)
+            elif kind == 'unserver':
+                self.altservers.discard(name)
+        for name, peer in self.peers.items():
+            peer['timeout'] = max(peer.get('timeout', 0), time.time())  # Give restored peers a full clear_time to reconnect
+            peer['bytes'] = sum(p['size'] for p in self.mailbox(peer)['buffer'].values())
+        self.schedule()
+
+    # Copy the state for a snapshot and rotate the journal, atomically with respect to changes
+    def checkpoint(self):
+        with self.lock:
+            if self.journal != None:
+                self.journal.rotate()
+            return {i: dict(p, buffer=dict(p['buffer'])) for i, p in self.peers.items()}, list(self.altservers)
+
+    # Fill in mailbox bookkeeping for a peer loaded from a state file saved by an older relay
+    def mailbox(self, peer):
+        for packet in peer['buffer'].values():
+            packet.setdefault('size', len(packet['data']))
+            packet.setdefault('expires', time.time() + self.packet_ttl)
+        peer.setdefault('bytes', sum(p['size'] for p in peer['buffer'].values()))
+        return peer
+
+    # Register or refresh a peer. Returns True if it is new.
+    def touch(self, name, capabilities):
+        with self.lock:
+            new = not name in self.peers.keys()
+            if new:
+                self.peers[name] = {'timeout': time.time(), 'buffer': {}, 'bytes': 0}
+                heapq.heappush(self.deadlines, (self.peers[name]['timeout'], name))
+            if new or self.peers[name].get('capabilities') != capabilities:
+                self.log('peer', name, capabilities)
+                self.changed('join', name, capabilities)
+            self.peers[name]['timeout'] = time.time()
+            self.peers[name]['capabilities'] = capabilities
+            return new
+
+    # One keepalive from <name>: register or refresh it, add the relays it knows and expire silent peers. A peer that can
+    # long-poll (see hold_time) is kept alive for the <wait> seconds it is held; otherwise its mailbox is drained.
+    # Returns (new, expired, membership version, seconds to hold, drained packets).
+    def ping(self, name, capabilities, servers, clear_time, wait=0, since=None):
+        new = self.touch(name, capabilities)
+        self.add_servers(servers)
+        expired = self.expire_peers(clear_time)
+        with self.lock:
+            version = self.version
+            held = hold_time(wait, len(self.peers[name]['buffer']), version, since)
+            self.peers[name]['timeout'] = time.time() + held
+        return new, expired, version, held, {} if held > 0 else self.drain(name)
+
+    def exists(self, name):
+        return name in self.peers.keys()
+
+    def names(self):
+        return list(self.peers.keys())
+
+    def capabilities(self):
+        with self.lock:
+            return {i: p['capabilities'] for i, p in self.peers.items() if p.get('capabilities')}
+
+    def membership_version(self):
+        return self.version
+
+    # (current version, membership_delta since <version>), or (current version, None) if <version> is too old to send a delta
+    def membership_since(self, version, routes=True):
+        with self.lock:
+            if version > self.version or (version < self.version and (len(self.changes) == 0 or self.changes[0][0] > version + 1)):
+                return self.version, None
+            return self.version, membership_delta([c[1:] for c in self.changes if c[0] > version], self.reachable, routes)
+
+    def reachable(self, name, routes=True):  # Capabilities of a local (or, with <routes>, routed) peer, or None
+        if name in self.peers.keys():
+            return self.peers[name].get('capabilities', [])
+        if routes and name in self.routes.keys():
+            return self.routes[name][1]
+        return None
+
+    # Apply a routing table from federated relay <relay>: its peers that joined (with their capabilities) and left.
+    # With <full>, <joined> is the relay's whole table. Returns True if anything changed.
+    def update_routes(self, relay, joined, left, full=False):
+        with self.lock:
+            if full:
+                left = [i for i, r in self.routes.items() if r[0] == relay and not i in joined.keys()]
+            changed = False
+            for i in left:
+                if i in self.routes.keys() and self.routes[i][0] == relay:
+                    del self.routes[i]
+                    self.changed('unroute', i)
+                    changed = True
+            for i, capabilities in joined.items():
+                if self.routes.get(i) != (relay, capabilities):
+                    self.routes[i] = (relay, capabilities)
+                    self.changed('route', i, capabilities)
+                    changed = True
+            return changed
+
+    def route(self, name):  # Address of the federated relay <name> is attached to, or None
+        r = self.routes.get(name)
+        return None if r == None else r[0]
+
+    def routed(self):  # {peer name: capabilities} of peers reachable through federated relays
+        with self.lock:
+            return {i: r[1] for i, r in self.routes.items()}
+
+    # Remove peers whose last ping is older than clear_time. Returns True if any were removed.
+    def expire_peers(self, clear_time):
+        with self.lock:
+            cutoff = time.time() - clear_time
+            expired = False
+            while len(self.deadlines) > 0 and self.deadlines[0][0] < cutoff:
+                _, name = heapq.heappop(self.deadlines)
+                peer = self.peers[name]
+                if peer['timeout'] >= cutoff:  # Pinged since it was queued
+                    heapq.heappush(self.deadlines, (peer['timeout'], name))
+                    continue
+                self.counts['dropped'] += len(peer['buffer'])
+                del self.peers[name]
+                self.log('drop', name)
+                self.changed('leave', name)
+                expired = True
+            return expired
+
+    # Buffer a packet for <target>. Returns "accepted", "missing" (unknown target) or "full".
+    def enqueue(self, target, pid, packet, size, ttl, max_messages, max_bytes):
+        with self.lock:
+            if not target in self.peers.keys():
+                return 'missing'
+            peer = self.peers[target]
+            previous = peer['buffer'].get(pid)  # A resent packet replaces its earlier copy rather than adding to it
+            replaced = 0 if previous == None else previous['size']
+            if (previous == None and len(peer['buffer']) >= max_messages) or peer['bytes'] - replaced + size > max_bytes:
+                self.counts['rejected'] += 1
+                return 'full'
+            packet = dict(packet, size=size, expires=time.time() + ttl)
+            peer['buffer'][pid] = packet
+            peer['bytes'] += size - replaced
+            heapq.heappush(self.expiries, (packet['expires'], target, pid))
+            self.log('put', target, pid, packet)
+            self.counts['accepted'] += 1
+            return 'accepted'
+
+    def pending(self, name):
+        peer = self.peers.get(name)
+        return 0 if peer == None else len(peer['buffer'])
+
+    def oldest_expiry(self, name):
+        with self.lock:
+            buf = self.peers[name]['buffer'] if name in self.peers.keys() else {}
+            return min([p['expires'] for p in buf.values()], default=None)
+
+    # Take every packet buffered for <name>. Returns {packet id: {originator, data, type, remote, queued}}.
+    def drain(self, name):
+        with self.lock:
+            peer = self.peers.get(name)
+            if peer == None:
+                return {}
+            buf = {pid: {k: p[k] for k in ['originator', 'data', 'type', 'remote', 'queued'] if k in p} for pid, p in peer['buffer'].items()}
+            if len(buf) > 0:
+                self.log('take', name)
+            peer['buffer'] = {}
+            peer['bytes'] = 0
+            self.counts['delivered'] += len(buf)
+            return buf
+
+    # Drop packets that have waited longer than their TTL, only from <name>'s mailbox if given. Returns how many were dropped.
+    def expire_packets(self, name=None):
+        with self.lock:
+            now = time.time()
+            if name != None:
+                peer = self.peers.get(name, {'buffer': {}})
+                due = [(name, pid) for pid, p in peer['buffer'].items() if p['expires'] < now]
+            else:
+                due = []
+                while len(self.expiries) > 0 and self.expiries[0][0] < now:
+                    due.append(heapq.heappop(self.expiries)[1:])
+            dropped = 0
+            for name, pid in due:
+                peer = self.peers.get(name)
+                packet = None if peer == None else peer['buffer'].get(pid)
+                if packet == None or packet['expires'] >= now:  # Drained, or resent since the entry was queued
+                    continue
+                del peer['buffer'][pid]
+                peer['bytes'] -= packet['size']
+                dropped += 1
+                self.log('del', name, pid)
+            self.counts['expired'] += dropped
+            return dropped
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counts[counter] += n
+
+    def counters(self):
+        return self.counts.copy()
+
+    def mailboxes(self):
+        with self.lock:
+            return {i: {'messages': len(p['buffer']), 'bytes': p['bytes']} for i, p in self.peers.items()}
+
+    def add_servers(self, servers):
+        with self.lock:
+            for s in set(servers).difference(self.altservers):
+                self.altservers.add(s)
+                self.log('server', s)
+                self.changed('server', s)
+
+    def remove_server(self, server):
+        with self.lock:
+            if server in self.altservers:
+                self.altservers.discard(server)
+                self.log('unserver', server)
+                self.changed('unserver', server)
+
+    def servers(self):
+        return list(self.altservers)
+
+    def snapshot(self):  # Peers and their mailboxes in the state file layout
+        with self.lock:
+            return {i: dict(p, buffer=dict(p['buffer'])) for i, p in self.peers.items()}
+
+    def journal_size(self):
+        return 0 if self.journal == None else self.journal.size
+
+    def register_worker(self, port):
+        pass
+
+    def worker_ports(self):
+        return []
+
+    def close(self):
+        if self.journal != None:
+            self.journal.close()
+
+
+class SQLiteState:
+    durable = True
+    shared = True  # Calls can wait on other workers' write locks, so the relay runs them off its event loop
+    poll_interval = 0.5  # Fallback mailbox check for held long-polls, in case a worker's doorbell was missed
+    journal = None  # Every change is committed to the database, so nothing is journaled
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS peers (name TEXT PRIMARY KEY, timeout REAL, capabilities TEXT, messages INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS packets (seq INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT, pid TEXT, packet BLOB, size INTEGER, expires REAL);
+        CREATE INDEX IF NOT EXISTS packets_target ON packets (target);
+        CREATE INDEX IF NOT EXISTS packets_expires ON packets (expires);
+        CREATE INDEX IF NOT EXISTS peers_timeout ON peers (timeout);
+        CREATE TABLE IF NOT EXISTS servers (address TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS workers (port INTEGER PRIMARY KEY, seen REAL);
+        CREATE TABLE IF NOT EXISTS changes (version INTEGER PRIMARY KEY, kind TEXT, name TEXT, capabilities TEXT);
+        CREATE TABLE IF NOT EXISTS routes (name TEXT PRIMARY KEY, relay TEXT, capabilities TEXT);
+    '''
+
+    def __init__(self, path, peers={}, altservers=[]):
+        self.path = path
+        self.lock = threading.Lock()  # One connection per process, shared by the event loop and background threads
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock:
+            self.db.executescript(self.SCHEMA)
+            self.db.executemany('INSERT OR IGNORE INTO counters VALUES (?, 0)', [(k,) for k in COUNTERS])
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES ('epoch', ?)", (new_epoch(),))
+            self.epoch = self.db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        self.add_servers(altservers)
+        for name, peer in peers.items():  # Seed from a JSON state file
+            self.touch(name, peer.get('capabilities', []))
+
+    # Run <fn(db)> in one write transaction
+    def transaction(self, fn):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                ret = fn(self.db)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return ret
+
+    # Run <fn(db)> in one read transaction, which sees a single snapshot of the database without taking the write lock
+    def snapshot_read(self, fn):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                return fn(self.db)
+            finally:
+                self.db.execute('COMMIT')
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    # Record a membership change inside a transaction
+    @staticmethod
+    def changed(db, kind, name, capabilities=None):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        db.execute("INSERT INTO changes SELECT value, ?, ?, ? FROM meta WHERE key = 'version'", (kind, name, json.dumps(capabilities)))
+        db.execute("DELETE FROM changes WHERE version <= (SELECT value FROM meta WHERE key = 'version') - ?", (MEMBERSHIP_HISTORY,))
+
+    def touch(self, name, capabilities):
+        caps = json.dumps(capabilities)
+
+        def run(db):
+            row = db.execute('SELECT capabilities FROM peers WHERE name = ?', (name,)).fetchone()
+            if row == None:
+                db.execute('INSERT INTO peers (name, timeout, capabilities) VALUES (?, ?, ?)', (name, time.time(), caps))
+            else:
+                db.execute('UPDATE peers SET timeout = ?, capabilities = ? WHERE name = ?', (time.time(), caps, name))
+            if row == None or row[0] != caps:
+                self.changed(db, 'join', name, capabilities)
+            return row == None
+        return self.transaction(run)
+
+    # Like MemoryState.ping, in at most one write transaction. The write is skipped while nothing changed and the peer's
+    # timeout is within half a clear_time of where the ping would set it, so idle peers cost reads only.
+    def ping(self, name, capabilities, servers, clear_time, wait=0, since=None):
+        caps = json.dumps(capabilities)
+
+        def unchanged(db):
+            now = time.time()
+            row = db.execute('SELECT timeout, capabilities, messages FROM peers WHERE name = ?', (name,)).fetchone()
+            if row == None or row[1] != caps or row[2] > 0:
+                return None
+            if db.execute('SELECT 1 FROM peers WHERE timeout < ? LIMIT 1', (now - clear_time,)).fetchone() != None:
+                return None
+            if not set(servers).issubset(r[0] for r in db.execute('SELECT address FROM servers')):
+                return None
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            held = hold_time(wait, 0, version, since)
+            if row[0] < now + held - clear_time / 2:
+                return None
+            return False, False, version, held, {}
+
+        def run(db):
+            now = time.time()
+            row = db.execute('SELECT capabilities FROM peers WHERE name = ?', (name,)).fetchone()
+            if row == None:
+                db.execute('INSERT INTO peers (name, timeout, capabilities) VALUES (?, ?, ?)', (name, now, caps))
+            else:
+                db.execute('UPDATE peers SET timeout = ?, capabilities = ? WHERE name = ?', (now, caps, name))
+            if row == None or row[0] != caps:
+                self.changed(db, 'join', name, capabilities)
+            self.insert_servers(db, servers)
+            expired = self.drop_expired(db, now - clear_time)
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            held = hold_time(wait, db.execute('SELECT messages FROM peers WHERE name = ?', (name,)).fetchone()[0], version, since)
+            if held > 0:
+                db.execute('UPDATE peers SET timeout = ? WHERE name = ?', (now + held, name))
+            return row == None, expired, version, held, {} if held > 0 else self.take(db, name)
+
+        return self.snapshot_read(unchanged) or self.transaction(run)
+
+    def exists(self, name):
+        return len(self.query('SELECT 1 FROM peers WHERE name = ?', (name,))) > 0
+
+    def names(self):
+        return [r[0] for r in self.query('SELECT name FROM peers')]
+
+    def capabilities(self):
+        return {r[0]: json.loads(r[1]) for r in self.query('SELECT name, capabilities FROM peers') if r[1] and json.loads(r[1])}
+
+    def membership_version(self):
+        return self.query("SELECT value FROM meta WHERE key = 'version'")[0][0]
+
+    def membership_since(self, version, routes=True):
+        def run(db):
+            current = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            oldest = db.execute('SELECT MIN(version) FROM changes').fetchone()[0]
+            if version > current or (version < current and (oldest == None or oldest > version + 1)):
+                return current, None
+            rows = db.execute('SELECT kind, name, capabilities FROM changes WHERE version > ? ORDER BY version', (version,)).fetchall()
+            return current, membership_delta([(k, n, json.loads(c)) for k, n, c in rows], lambda name, routes: self.reachable(db, name, routes), routes)
+        return self.snapshot_read(run)
+
+    @staticmethod
+    def reachable(db, name, routes=True):
+        row = db.execute('SELECT capabilities FROM peers WHERE name = ?', (name,)).fetchone()
+        if row == None and routes:
+            row = db.execute('SELECT capabilities FROM routes WHERE name = ?', (name,)).fetchone()
+        return None if row == None else json.loads(row[0] or '[]')
+
+    def update_routes(self, relay, joined, left, full=False):
+        def run(db):
+            nonlocal left
+            if full:
+                left = [r[0] for r in db.execute('SELECT name FROM routes WHERE relay = ?', (relay,)) if not r[0] in joined.keys()]
+            changed = False
+            for i in left:
+                if db.execute('DELETE FROM routes WHERE name = ? AND relay = ?', (i, relay)).rowcount == 1:
+                    self.changed(db, 'unroute', i)
+                    changed = True
+            for i, capabilities in joined.items():
+                caps = json.dumps(capabilities)
+                if db.execute('SELECT relay, capabilities FROM routes WHERE name = ?', (i,)).fetchone() != (relay, caps):
+                    db.execute('INSERT OR REPLACE INTO routes VALUES (?, ?, ?)', (i, relay, caps))
+                    self.changed(db, 'route', i, capabilities)
+                    changed = True
+            return changed
+        return self.transaction(run)
+
+    def route(self, name):
+        rows = self.query('SELECT relay FROM routes WHERE name = ?', (name,))
+        return None if len(rows) == 0 else rows[0][0]
+
+    def routed(self):
+        return {r[0]: json.loads(r[1]) for r in self.query('SELECT name, capabilities FROM routes')}
+
+    def expire_peers(self, clear_time):
+        if len(self.query('SELECT 1 FROM peers WHERE timeout < ? LIMIT 1', (time.time() - clear_time,))) == 0:
+            return False  # Skip the write lock on the common path
+
+        return self.transaction(lambda db: self.drop_expired(db, time.time() - clear_time))
+
+    # Remove peers whose last ping is older than <cutoff> inside a transaction. Returns True if any were removed.
+    def drop_expired(self, db, cutoff):
+        expired = db.execute('SELECT name, messages FROM peers WHERE timeout < ?', (cutoff,)).fetchall()
+        for name, messages in expired:
+            db.execute('DELETE FROM packets WHERE target = ?', (name,))
+            db.execute('DELETE FROM peers WHERE name = ?', (name,))
+            self.changed(db, 'leave', name)
+        if len(expired) > 0:
+            db.execute("UPDATE counters SET value = value + ? WHERE name = 'dropped'", (sum(r[1] for r in expired),))
+        return len(expired) > 0
+
+    def enqueue(self, target, pid, packet, size, ttl, max_messages, max_bytes):
+        def run(db):
+            row = db.execute('SELECT messages, bytes FROM peers WHERE name = ?', (target,)).fetchone()
+            if row == None:
+                return 'missing'
+            previous = db.execute('SELECT seq, size FROM packets WHERE target = ? AND pid = ?', (target, pid)).fetchone()
+            replaced = 0 if previous == None else previous[1]
+            if (previous == None and row[0] >= max_messages) or row[1] - replaced + size > max_bytes:
+                db.execute("UPDATE counters SET value = value + 1 WHERE name = 'rejected'")
+                return 'full'
+            if previous == None:
+                db.execute('INSERT INTO packets (target, pid, packet, size, expires) VALUES (?, ?, ?, ?, ?)', (target, pid, wire.dumps(packet), size, time.time() + ttl))
+                db.execute('UPDATE peers SET messages = messages + 1, bytes = bytes + ? WHERE name = ?', (size, target))
+            else:  # A resent packet replaces its earlier copy
+                db.execute('UPDATE packets SET packet = ?, size = ?, expires = ? WHERE seq = ?', (wire.dumps(packet), size, time.time() + ttl, previous[0]))
+                db.execute('UPDATE peers SET bytes = bytes + ? WHERE name = ?', (size - replaced, target))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'accepted'")
+            return 'accepted'
+        return self.transaction(run)
+
+    def pending(self, name):
+        row = self.query('SELECT messages FROM peers WHERE name = ?', (name,))
+        return 0 if len(row) == 0 else row[0][0]
+
+    def oldest_expiry(self, name):
+        return self.query('SELECT MIN(expires) FROM packets WHERE target = ?', (name,))[0][0]
+
+    def drain(self, name):
+        if self.pending(name) == 0:
+            return {}  # Skip the write lock on the common path
+        return self.transaction(lambda db: self.take(db, name))
+
+    # Take every packet buffered for <name> inside a transaction
+    def take(self, db, name):
+        rows = db.execute('SELECT pid, packet FROM packets WHERE target = ? ORDER BY seq', (name,)).fetchall()
+        if len(rows) == 0:
+            return {}
+        db.execute('DELETE FROM packets WHERE target = ?', (name,))
+        db.execute('UPDATE peers SET messages = 0, bytes = 0 WHERE name = ?', (name,))
+        db.execute("UPDATE counters SET value = value + ? WHERE name = 'delivered'", (len(rows),))
+        return {pid: wire.loads(packet) for pid, packet in rows}
+
+    def expire_packets(self, name=None):
+        where, params = ('target = ? AND expires < ?', (name,)) if name != None else ('expires < ?', ())
+        if len(self.query(f'SELECT 1 FROM packets WHERE {where} LIMIT 1', params + (time.time(),))) == 0:
+            return 0  # Skip the write lock on the common path
+
+        def run(db):
+            now = time.time()
+            rows = db.execute(f'SELECT target, COUNT(*), SUM(size) FROM packets WHERE {where} GROUP BY target', params + (now,)).fetchall()
+            if len(rows) == 0:
+                return 0
+            db.execute(f'DELETE FROM packets WHERE {where}', params + (now,))
+            for target, messages, size in rows:
+                db.execute('UPDATE peers SET messages = messages - ?, bytes = bytes - ? WHERE name = ?', (messages, size, target))
+            dropped = sum(r[1] for r in rows)
+            db.execute("UPDATE counters SET value = value + ? WHERE name = 'expired'", (dropped,))
+            return dropped
+        return self.transaction(run)
+
+    def count(self, counter, n=1):
+        self.transaction(lambda db: db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (n, counter)))
+
+    def counters(self):
+        return dict(self.query('SELECT name, value FROM counters'))
+
+    def mailboxes(self):
+        return {r[0]: {'messages': r[1], 'bytes': r[2]} for r in self.query('SELECT name, messages, bytes FROM peers')}
+
+    def add_servers(self, servers):
+        servers = set(servers).difference(self.servers())
+        if len(servers) > 0:
+            self.transaction(lambda db: self.insert_servers(db, servers))
+
+    def insert_servers(self, db, servers):  # Called inside a transaction
+        for s in servers:
+            if db.execute('INSERT OR IGNORE INTO servers VALUES (?)', (s,)).rowcount == 1:
+                self.changed(db, 'server', s)
+
+    def remove_server(self, server):
+        def run(db):
+            if db.execute('DELETE FROM servers WHERE address = ?', (server,)).rowcount == 1:
+                self.changed(db, 'unserver', server)
+        self.transaction(run)
+
+    def servers(self):
+        return [r[0] for r in self.query('SELECT address FROM servers')]
+
+    # Record (or refresh) the doorbell port of a live worker
+    def register_worker(self, port):
+        self.transaction(lambda db: db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (port, time.time())))
+
+    def worker_ports(self, max_age=30):
+        return [r[0] for r in self.query('SELECT port FROM workers WHERE seen > ?', (time.time() - max_age,))]
+
+    def snapshot(self):
+        return {r[0]: {'timeout': r[1], 'capabilities': json.loads(r[2] or '[]'), 'buffer': {}, 'bytes': 0} for r in self.query('SELECT name, timeout, capabilities FROM peers')}
+
+    def journal_size(self):
+        return 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
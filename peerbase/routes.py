@@ -0,0 +1,92 @@
+import threading
+import time
+import math
+from collections import deque
+
+ERROR_HALF_LIFE = 30  # Seconds for a route's error rate to halve without new observations
+UNHEALTHY = 0.5  # Routes whose error rate is at least this are only tried after the healthy ones
+MIN_PERCENTILE_SAMPLES = 8  # Round trips needed before hedge delays come from the percentile
+HEDGE_GUESS = 1  # Seconds to wait before the first hedge on a route without round trips when there is no timeout
+
+
+class RouteStats:
+    # RTT and error-rate estimates for relays and for (peer, relay) routes. Relay estimates come from keepalives and
+    # /send requests, route estimates from command round trips; a route with no round trips yet falls back to its relay.
+    def __init__(self, window=64, alpha=0.125, beta=0.25, error_alpha=0.2):
+        self.window = window
+        self.alpha = alpha  # Weights of a new sample in the smoothed RTT and its variation (as in TCP)
+        self.beta = beta
+        self.error_alpha = error_alpha
+        self.lock = threading.Lock()
+        self.stats = {}  # {(peer or None, relay): {'srtt', 'rttvar', 'samples', 'errors', 'updated'}}
+
+    def _entry(self, key):
+        if not key in self.stats.keys():
+            self.stats[key] = {'srtt': None, 'rttvar': 0, 'samples': deque(maxlen=self.window), 'errors': 0.0, 'updated': time.time()}
+        return self.stats[key]
+
+    def _error_rate(self, entry, now):
+        return entry['errors'] * 0.5 ** ((now - entry['updated']) / ERROR_HALF_LIFE)
+
+    # Record a round trip of <rtt> seconds, or a failure, for <relay> (or the route to <peer> through it)
+    def observe(self, relay, rtt=None, peer=None, error=False):
+        now = time.time()
+        with self.lock:
+            entry = self._entry((peer, relay))
+            entry['errors'] = self._error_rate(entry, now) * (1 - self.error_alpha) + (self.error_alpha if error else 0)
+            entry['updated'] = now
+            if rtt != None:
+                if entry['srtt'] == None:
+                    entry['srtt'], entry['rttvar'] = rtt, rtt / 2
+                else:
+                    entry['rttvar'] = (1 - self.beta) * entry['rttvar'] + self.beta * abs(entry['srtt'] - rtt)
+                    entry['srtt'] = (1 - self.alpha) * entry['srtt'] + self.alpha * rtt
+                entry['samples'].append(rtt)
+
+    # (smoothed RTT or None if unknown, error rate) of the route to <peer> through <relay>
+    def estimate(self, relay, peer=None):
+        now = time.time()
+        with self.lock:
+            route, link = self.stats.get((peer, relay)), self.stats.get((None, relay))
+            errors = max([self._error_rate(e, now) for e in [route, link] if e != None] or [0])
+            for entry in [route, link]:
+                if entry != None and entry['srtt'] != None:
+                    return entry['srtt'], errors
+            return None, errors
+
+    # <relays> ordered best first: healthy before unhealthy, then untried (to measure them) and fastest
+    def rank(self, peer, relays):
+        def key(relay):
+            rtt, errors = self.estimate(relay, peer)
+            return (errors >= UNHEALTHY, 0 if rtt == None else rtt)
+        return sorted(relays, key=key)
+
+    # Seconds to wait for an answer through <relay> before hedging on another route: the <percentile>th percentile of
+    # recent round trips to <peer>, or srtt + 4 * rttvar until there are enough of them, or half of <timeout> (HEDGE_GUESS
+    # without one) before the first.
+    def hedge_delay(self, peer, relay, percentile, timeout):
+        with self.lock:
+            entry = self.stats.get((peer, relay))
+            if entry == None or entry['srtt'] == None:
+                return HEDGE_GUESS if timeout == None else timeout / 2
+            if len(entry['samples']) >= MIN_PERCENTILE_SAMPLES:
+                samples = sorted(entry['samples'])
+                delay = samples[min(len(samples) - 1, math.ceil(len(samples) * percentile / 100) - 1)]
+            else:
+                delay = entry['srtt'] + 4 * entry['rttvar']
+            return delay if timeout == None else min(delay, timeout)
+
+    # Drop every estimate involving <relay>
+    def forget(self, relay):
+        with self.lock:
+            for key in [k for k in self.stats.keys() if k[1] == relay]:
+                del self.stats[key]
+
+    # {relay: {peer or None: {'rtt', 'errors', 'samples'}}} for inspection
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            ret = {}
+            for (peer, relay), entry in self.stats.items():
+                ret.setdefault(relay, {})[peer] = {'rtt': entry['srtt'], 'errors': self._error_rate(entry, now), 'samples': len(entry['samples'])}
+            return ret
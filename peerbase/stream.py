@@ -0,0 +1,255 @@
+import asyncio
+import collections
+import collections.abc
+import secrets
+import threading
+import time
+
+# Streamed command arguments and results. A file-like object or iterator passed as a top-level argument, or returned by a
+# command, is not serialized with the message. The sending node keeps it as an Outgoing stream and sends a placeholder
+# ({'__stream__': id, 'node': name}) instead. The receiving node swaps the placeholder for a Stream, which pulls the data
+# one chunk per __stream__ request, so each chunk is sealed on its own and travels the same direct or relay route as any
+# other command. A Stream keeps at most <window> pulls in flight and the sender holds at most <window> unacknowledged
+# chunks, so the memory a transfer takes on either side and in a relay mailbox is bounded by window * chunk size.
+
+KEY = '__stream__'
+CHUNK_SIZE = 262144  # Bytes per chunk
+WINDOW = 4  # Chunks in flight per stream
+TIMEOUT = 30  # Seconds an Outgoing stream is kept without being pulled
+WORKERS = 32  # Threads pulling chunks for all of a Node's streams
+
+
+def is_streamable(value):  # File-like objects and iterators. Async iterators are only streamed by an AsyncNode.
+    if isinstance(value, (str, bytes, bytearray, memoryview, dict, list, tuple)):
+        return False
+    return callable(getattr(value, 'read', None)) or isinstance(value, collections.abc.Iterator)
+
+
+def new_id():
+    return secrets.token_hex(16)
+
+
+def is_placeholder(value):
+    return type(value) == dict and KEY in value.keys()
+
+
+def carries_streams(message):  # Whether a command message has streamed arguments
+    return any(is_placeholder(v) for v in [*message.get('args', ()), *message.get('kwargs', {}).values()])
+
+
+def split(data, chunk_size):  # Yield <data> (bytes or str) in pieces of at most <chunk_size> bytes
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    for i in range(0, len(data), chunk_size):
+        yield bytes(data[i:i+chunk_size])
+
+
+def chunks(source, chunk_size):  # Chunks of a file-like object or an iterator of bytes or str
+    if callable(getattr(source, 'read', None)):
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            yield from split(data, chunk_size)
+    else:
+        for data in source:
+            yield from split(data, chunk_size)
+
+
+async def chunks_async(source, chunk_size):  # Chunks of an async iterator of bytes or str
+    async for data in source:
+        for chunk in split(data, chunk_size):
+            yield chunk
+
+
+class Outgoing:
+    def __init__(self, source, chunk_size=CHUNK_SIZE, window=WINDOW):
+        self.source = source
+        self.window = window
+        self.asynchronous = isinstance(source, collections.abc.AsyncIterator)
+        self.chunks = chunks_async(source, chunk_size) if self.asynchronous else chunks(source, chunk_size)
+        self.pending = {}  # {seq: chunk} read from the source but not yet acknowledged
+        self.produced = 0  # Chunks read from the source
+        self.ended = False
+        self.lock = threading.Lock()
+        self.async_lock = None  # Created on the event loop that first pulls an async source
+        self.used = time.monotonic()
+
+    # Drop the chunks the puller has <received> and check that <seq> is within its window
+    def acknowledge(self, seq, received):
+        self.used = time.monotonic()
+        for i in [i for i in self.pending.keys() if i < received]:
+            del self.pending[i]
+        if seq < received or seq >= received + self.window:
+            raise ValueError(f'Chunk {seq} is outside the window of a stream with {received} chunks received.')
+
+    # Chunk <seq>, or None past the end. <received> is the number of chunks the puller has, in order.
+    def pull(self, seq, received):
+        with self.lock:
+            self.acknowledge(seq, received)
+            while self.produced <= seq and not self.ended:
+                try:
+                    self.pending[self.produced] = next(self.chunks)
+                    self.produced += 1
+                except StopIteration:
+                    self.ended = True
+            return self.pending.get(seq)
+
+    async def pull_async(self, seq, received):
+        if self.async_lock == None:
+            self.async_lock = asyncio.Lock()
+        async with self.async_lock:
+            self.acknowledge(seq, received)
+            while self.produced <= seq and not self.ended:
+                try:
+                    self.pending[self.produced] = await self.chunks.__anext__()
+                    self.produced += 1
+                except StopAsyncIteration:
+                    self.ended = True
+            return self.pending.get(seq)
+
+    def close(self):
+        self.pending = {}
+        close = getattr(self.source, 'close', None)
+        if callable(close) and not self.asynchronous:
+            close()
+
+
+class Stream:
+    # Iterable of the bytes chunks of a stream sent by <peer>, also readable like a binary file. Pulls up to <window> chunks ahead.
+    def __init__(self, node, peer, stream_id, window=WINDOW, timeout=5):
+        self.node = node
+        self.peer = peer
+        self.id = stream_id
+        self.window = window
+        self.timeout = timeout
+        self.received = 0  # Chunks returned, in order
+        self.requested = 0  # Next chunk to pull
+        self.inflight = collections.deque()  # Futures of pulled chunks, in order
+        self.buffer = b''  # Part of a chunk not yet returned by read()
+        self.ended = False
+        self.closed = False
+
+    def __repr__(self):
+        return f'<Stream {self.id} from {self.peer}>'
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.buffer) > 0:
+            chunk, self.buffer = self.buffer, b''
+            return chunk
+        if self.ended or self.closed:
+            raise StopIteration
+        while len(self.inflight) < self.window:
+            self.inflight.append(self.node.executor('stream').submit(
+                self.node.pull_chunk, self.peer, self.id, self.requested, self.received, self.timeout))
+            self.requested += 1
+        try:
+            chunk = self.inflight.popleft().result()
+        except:
+            self.close()
+            raise
+        if chunk == None:
+            self.ended = True
+            self.close()
+            raise StopIteration
+        self.received += 1
+        return chunk
+
+    # Up to <size> bytes, or everything left if <size> is negative. Returns b'' at the end of the stream.
+    def read(self, size=-1):
+        if size < 0:
+            return b''.join(self)
+        data = [self.buffer]
+        length = len(self.buffer)
+        self.buffer = b''
+        while length < size:
+            try:
+                chunk = next(self)
+            except StopIteration:
+                break
+            data.append(chunk)
+            length += len(chunk)
+        data = b''.join(data)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    # Stop pulling and let the sender drop the stream. Called once the end is reached.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        inflight, self.inflight = list(self.inflight), collections.deque()
+        for future in inflight:
+            future.cancel()
+        self.node.executor('stream').submit(self.node.close_stream, self.peer, self.id, [f for f in inflight if not f.cancelled()], self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncStream(Stream):
+    # Stream of an AsyncNode: iterate with "async for" and "await stream.read()"
+    def __repr__(self):
+        return f'<AsyncStream {self.id} from {self.peer}>'
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.buffer) > 0:
+            chunk, self.buffer = self.buffer, b''
+            return chunk
+        if self.ended or self.closed:
+            raise StopAsyncIteration
+        while len(self.inflight) < self.window:
+            self.inflight.append(asyncio.ensure_future(self.node.pull_chunk(self.peer, self.id, self.requested, self.received, self.timeout)))
+            self.requested += 1
+        try:
+            chunk = await self.inflight.popleft()
+        except:
+            await self.close()
+            raise
+        if chunk == None:
+            self.ended = True
+            await self.close()
+            raise StopAsyncIteration
+        self.received += 1
+        return chunk
+
+    async def read(self, size=-1):
+        data = [self.buffer]
+        length = len(self.buffer)
+        self.buffer = b''
+        while size < 0 or length < size:
+            try:
+                chunk = await self.__anext__()
+            except StopAsyncIteration:
+                break
+            data.append(chunk)
+            length += len(chunk)
+        data = b''.join(data)
+        if size < 0:
+            return data
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        inflight, self.inflight = list(self.inflight), collections.deque()
+        for task in inflight:
+            task.cancel()
+        self.node.spawn(self.node.close_stream(self.peer, self.id, [], self.timeout))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,197 @@
+import struct
+import base64
+import json
+
+# Binary wire format (version 1)
+#
+# Sealed messages travel as raw ciphertext bytes instead of base64(Fernet token), and the plaintext
+# inside is a length-prefixed, tagged serialization instead of JSON:
+#   MAGIC (3 bytes) | VERSION (1 byte) | value
+# where value is one of
+#   N | T | F                                     None, True, False
+#   i <int64>                                     int
+#   I <u32 len> <ascii digits>                    int outside the int64 range
+#   d <float64>                                   float
+#   s <u32 len> <utf-8>                           str
+#   b <u32 len> <raw>                             bytes
+#   l <u32 count> <value>*count                   list / tuple
+#   m <u32 count> (<value> <value>)*count         dict
+#   j <u32 len> <compact JSON>                    list / dict containing no bytes
+# All integers are big-endian. Plaintext that does not start with MAGIC is legacy JSON.
+# Containers are written as JSON segments (C-accelerated) unless they hold bytes, which are only
+# representable with the tagged encoding.
+
+MAGIC = b'\xb7PB'
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+CONTENT_TYPE = 'application/x-peerbase'
+CAPABILITIES_HEADER = 'X-PeerBase-Capabilities'
+CAPABILITY = f'bin{VERSION}'
+
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(b'N')
+    elif obj is True:
+        out.append(b'T')
+    elif obj is False:
+        out.append(b'F')
+    elif isinstance(obj, int):
+        if -0x8000000000000000 <= obj <= 0x7fffffffffffffff:
+            out.append(b'i' + _I64.pack(obj))
+        else:
+            raw = str(obj).encode('ascii')
+            out.append(b'I' + _U32.pack(len(raw)))
+            out.append(raw)
+    elif isinstance(obj, float):
+        out.append(b'd' + _F64.pack(obj))
+    elif isinstance(obj, str):
+        raw = obj.encode('utf-8')
+        out.append(b's' + _U32.pack(len(raw)))
+        out.append(raw)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        out.append(b'b' + _U32.pack(len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple, dict)) and _pack_json(obj, out):
+        pass
+    elif isinstance(obj, (list, tuple)):
+        out.append(b'l' + _U32.pack(len(obj)))
+        for i in obj:
+            _pack(i, out)
+    elif isinstance(obj, dict):
+        out.append(b'm' + _U32.pack(len(obj)))
+        for k, v in obj.items():
+            _pack(k, out)
+            _pack(v, out)
+    else:
+        raise TypeError(
+            f'Object of type {type(obj).__name__} cannot be serialized to the PeerBase wire format.')
+
+
+def _pack_json(obj, out):
+    values = obj.values() if isinstance(obj, dict) else obj
+    if any(isinstance(v, (bytes, bytearray, memoryview)) for v in values):  # Skip a doomed encode attempt
+        return False
+    try:
+        raw = _json_encoder.encode(obj).encode('utf-8')
+    except (TypeError, ValueError):
+        return False
+    out.append(b'j' + _U32.pack(len(raw)))
+    out.append(raw)
+    return True
+
+
+def _unpack(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x73:  # s
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return str(buf[pos:pos+length], 'utf-8'), pos+length
+    if tag == 0x6a:  # j
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return json.loads(str(buf[pos:pos+length], 'utf-8')), pos+length
+    if tag == 0x69:  # i
+        return _I64.unpack_from(buf, pos)[0], pos+8
+    if tag == 0x6d:  # m
+        (count,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        ret = {}
+        for _ in range(count):
+            k, pos = _unpack(buf, pos)
+            ret[k], pos = _unpack(buf, pos)
+        return ret, pos
+    if tag == 0x6c:  # l
+        (count,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        ret = []
+        for _ in range(count):
+            item, pos = _unpack(buf, pos)
+            ret.append(item)
+        return ret, pos
+    if tag == 0x62:  # b
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return bytes(buf[pos:pos+length]), pos+length
+    if tag == 0x64:  # d
+        return _F64.unpack_from(buf, pos)[0], pos+8
+    if tag == 0x4e:  # N
+        return None, pos
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x49:  # I
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return int(str(buf[pos:pos+length], 'ascii')), pos+length
+    raise ValueError(f'Unknown wire tag {bytes([tag])!r} at offset {pos-1}.')
+
+
+def pack(obj):  # Serialize obj without the version header
+    out = []
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def unpack(data, pos=0):  # Deserialize a value produced by pack()
+    buf = memoryview(data)
+    try:
+        obj, end = _unpack(buf, pos)
+    except (IndexError, struct.error):
+        raise ValueError('Truncated PeerBase wire data.')
+    if end != len(buf):
+        raise ValueError('Trailing bytes after PeerBase wire data.')
+    return obj
+
+
+def dumps(obj):  # Serialize obj with the versioned header
+    out = [HEADER]
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def loads(data):  # Deserialize versioned wire data, falling back to legacy JSON
+    if is_binary(data):
+        if data[len(MAGIC)] > VERSION:
+            raise ValueError(
+                f'PeerBase wire version {data[len(MAGIC)]} is newer than supported version {VERSION}.')
+        return unpack(data, len(HEADER))
+    return json.loads(data)
+
+
+# Legacy transports carry base64(base64(ciphertext)) as text; the binary transport carries raw ciphertext
+def is_legacy(data):
+    return type(data) == str or (len(data) > 0 and data[0] < 0x80)
+
+
+def to_legacy(raw):
+    return base64.urlsafe_b64encode(base64.urlsafe_b64encode(raw)).decode('utf-8')
+
+
+def from_legacy(text):
+    if type(text) == str:
+        text = text.encode('utf-8')
+    return base64.urlsafe_b64decode(base64.urlsafe_b64decode(text))
+
+
+def to_text(data):  # Accept either transport form, return legacy text
+    if type(data) == str:
+        return data
+    return to_legacy(data)
+
+
+def to_raw(data):  # Accept either transport form, return raw ciphertext
+    if is_legacy(data):
+        return from_legacy(data)
+    return bytes(data)
@@ -20,6 +20,9 @@ setup(
           'fastapi',
           'uvicorn'
       ],
+  extras_require={
+          'zstd': ['zstandard']
+      },
   classifiers=[
     'Development Status :: 3 - Alpha',      # Chose either "3 - Alpha", "4 - Beta" or "5 - Production/Stable" as the current state of your package
     'Intended Audience :: Developers',      # Define that your audience are developers
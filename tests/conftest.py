@@ -0,0 +1,57 @@
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import pytest
+import peerbase
+from peerbase import relay
+
+KEY = peerbase.key_generate().decode('utf-8')
+RELAY_PORT = 27000
+RELAY_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'peerbase', 'relay.py')
+
+
+@pytest.fixture(scope='session')
+def relay_address():  # Only one relay can be served per process, so the tests share it
+    logging.getLogger().setLevel(logging.WARNING)  # The relay logs every packet at INFO
+    relay.serve_in_thread(relay.Relay(RELAY_PORT))
+    return f'{peerbase.ip()}:{RELAY_PORT}'
+
+
+# Wait up to <timeout> seconds for <condition>
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError('Condition not met in time.')
+        time.sleep(0.05)
+
+
+def listening(port):
+    try:
+        socket.create_connection((peerbase.ip(), port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+# Run relay.py with <args> in a process of its own, for relays a test cannot share this process's relay with.
+# Returns the Popen once the relay accepts connections; stop it with stop_relay().
+def start_relay(port, args, cwd):
+    process = subprocess.Popen(
+        [sys.executable, RELAY_SCRIPT, '--port', str(port), *args],
+        cwd=str(cwd), stdout=subprocess.DEVNULL, stderr=open(os.path.join(str(cwd), f'relay{port}.log'), 'wb'), start_new_session=True)
+    wait_for(lambda: listening(port) or process.poll() != None, timeout=20)
+    time.sleep(1)  # Let every worker start accepting
+    if process.poll() != None:
+        with open(os.path.join(str(cwd), f'relay{port}.log')) as f:
+            raise RuntimeError(f.read())
+    return process
+
+
+def stop_relay(process):
+    os.killpg(process.pid, signal.SIGKILL)  # Its workers too; a graceful stop waits out held long-polls
+    process.wait(10)
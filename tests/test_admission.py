@@ -0,0 +1,52 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import peerbase
+from conftest import KEY, wait_for
+
+
+def sleep(node, args, kwargs):
+    time.sleep(args[0])
+    return args[0]
+
+
+COMMANDS = {'sleep': sleep, 'limited': sleep}
+
+
+# Post a request to local peer <target> on a connection of its own. Returns (status, Retry-After header).
+def post(node, target, command, args):
+    body, headers = node.local_request(target, node.command_message(command, args, {}))
+    resp = requests.post(f'http://{node.peers[target][0]}:{node.peers[target][1]}', data=body, headers=headers, timeout=10)
+    return resp.status_code, resp.headers.get('Retry-After')
+
+
+# Requests beyond the workers and the queue are refused with 503 and a Retry-After hint instead of waiting; a command at
+# its limit is refused the same way. Senders retry the refusals within their timeout.
+def test_admission_control():
+    a = peerbase.Node('aa', 'admission', KEY, ports=[28002, 28001])
+    b = peerbase.Node('ab', 'admission', KEY, ports=[28004, 28001], registered_commands=COMMANDS,
+                      server_workers=2, server_queue=1, command_limits={'limited': 1})
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'ab' in a.peers.keys())
+    a.command('sleep', [0], target='ab')  # Learn what ab supports
+    with ThreadPoolExecutor(6) as executor:
+        answers = list(executor.map(lambda _: post(a, 'ab', 'sleep', [0.3]), range(6)))
+    assert (200, None) in answers
+    assert (503, str(peerbase.BUSY_RETRY)) in answers
+    assert b.metrics.snapshot()['counters']['rejected{reason="server"}'] >= 1
+
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(a.command, 'limited', [0.5], target='ab')
+        time.sleep(0.1)
+        start = time.time()
+        assert a.command('limited', [0], target='ab', timeout=5) == 0  # Retried until the first call finished
+        assert time.time() - start > 0.25
+        assert first.result() == 0.5
+    assert b.metrics.snapshot()['counters']['rejected{reason="command",command="limited"}'] >= 1
+
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(a.command, 'limited', [1], target='ab')
+        time.sleep(0.1)
+        assert a.command('limited', [0], target='ab', timeout=0.3) == None  # Out of time before a retry could run
+        assert first.result() == 1
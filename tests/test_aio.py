@@ -0,0 +1,29 @@
+import asyncio
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY
+
+
+def echo(node, args, kwargs):
+    return args
+
+
+# An AsyncNode built before its event loop runs still queues requests past server_workers and stops with commands
+# in its thread pool (its semaphore must belong to the loop it serves on, on Python 3.8 and 3.9 too)
+def test_node_built_outside_loop():
+    x = AsyncNode('ax', 'aio', KEY, ports=[27702, 27701])
+    y = AsyncNode('ay', 'aio', KEY, ports=[27704, 27701], server_workers=4)
+    y.register_command('echo', echo, execution='thread')
+
+    async def main():
+        await x.start()
+        await y.start()
+        try:
+            while not 'ay' in x.peers.keys():
+                await asyncio.sleep(0.05)
+            assert await asyncio.gather(*[x.command('echo', [i], target='ay', raise_errors=True) for i in range(12)]) == [[i] for i in range(12)]
+        finally:
+            await x.stop()
+            await y.stop()
+
+    asyncio.run(asyncio.wait_for(main(), 15))
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, start_relay, stop_relay, wait_for
+
+
+def echo(node, args, kwargs):
+    return [*args, kwargs]
+
+
+def fail(node, args, kwargs):
+    raise ValueError('Failed on purpose.')
+
+
+def sleep(node, args, kwargs):
+    time.sleep(args[0])
+    return threading.get_ident()
+
+
+COMMANDS = {'echo': echo, 'fail': fail, 'sleep': sleep}
+CALLS = [('echo', [1]), ('fail',), ('echo', [2], {'k': 'v'}), ('missing', [])]
+RESULTS = [[1, {}], None, [2, {'k': 'v'}], None]
+
+
+def requests_sent(node, path):
+    return node.metrics.snapshot()['histograms'].get(f'request_seconds{{path="{path}"}}', {}).get('count', 0)
+
+
+# A batch returns each call's result in order, with None for calls that failed, over the LAN and through a relay
+def test_batch_round_trip(tmp_path):
+    relay = start_relay(27800, [], tmp_path)
+    try:
+        relay_address = f'{peerbase.ip()}:27800'
+        a = peerbase.Node('ba', 'batch', KEY, ports=[27802, 27801], servers=relay_address)
+        b = peerbase.Node('bb', 'batch', KEY, ports=[27804, 27801], registered_commands=COMMANDS)
+        c = peerbase.Node('bc', 'batch', KEY, ports=[27806, 27801], servers=relay_address, use_local=False, registered_commands=COMMANDS)
+        for node in [a, b, c]:
+            node.start_multithreaded()
+        wait_for(lambda: 'bb' in a.peers.keys() and 'bc' in a.remote_peers.keys())
+        a.command('echo', target='bb')  # Learn what bb supports
+        sent = requests_sent(a, 'local')
+        assert a.command_batch('bb', CALLS) == RESULTS
+        assert requests_sent(a, 'local') == sent + 1
+        assert a.command_batch('bc', CALLS, raise_errors=True) == RESULTS
+        start = time.time()
+        idents = a.command_batch('bb', [('sleep', [0.5])] * 4, parallel=True)
+        assert time.time() - start < 1.5 and len(set(idents)) == 4
+        assert a.command_batch('bb', []) == []
+
+        async def main():
+            x = AsyncNode('bx', 'batch', KEY, ports=[27808, 27801], registered_commands=COMMANDS)
+            await x.start()
+            try:
+                while not ('bb' in x.peers.keys() and 'bx' in a.peers.keys()):
+                    await asyncio.sleep(0.05)
+                assert await x.command_batch('bb', CALLS) == RESULTS
+                assert await asyncio.get_running_loop().run_in_executor(None, a.command_batch, 'bx', CALLS) == RESULTS  # Served by an AsyncNode
+            finally:
+                await x.stop()
+
+        asyncio.run(asyncio.wait_for(main(), 15))
+    finally:
+        stop_relay(relay)
@@ -0,0 +1,53 @@
+import threading
+import time
+import peerbase
+from peerbase.cache import TTLCache, arguments_key
+from conftest import KEY, wait_for
+
+calls = {}
+calls_lock = threading.Lock()
+
+
+def count(node, args, kwargs):
+    with calls_lock:
+        calls[args[0]] = calls.get(args[0], 0) + 1
+    return {'calls': calls[args[0]]}
+
+
+def test_ttl_cache():
+    cache = TTLCache(max_entries=2)
+    cache.put('a', 1, 0.2)
+    cache.put('b', 2, 10)
+    cache.put('c', 3, 0)  # Not cached
+    assert cache.get('a') == (True, 1) and cache.get('c') == (False, None)
+    cache.put('d', 4, 10)  # Evicts b, the least recently used
+    assert cache.get('b') == (False, None) and cache.get('d') == (True, 4)
+    time.sleep(0.25)
+    assert cache.get('a') == (False, None)
+    assert cache.invalidate(lambda key: key == 'd') == 1 and cache.get('d') == (False, None)
+    assert cache.stats() == {'hits': 2, 'misses': 4, 'evictions': 1, 'expired': 1, 'invalidated': 1, 'entries': 0, 'max_entries': 2}
+    assert arguments_key([1], {'a': 1, 'b': 2}) == arguments_key([1], {'b': 2, 'a': 1})
+
+
+# A cacheable result is kept by the node that ran it and by the node that asked, until its TTL runs out or it is invalidated
+def test_result_cache():
+    a = peerbase.Node('ca', 'cache', KEY, ports=[28202, 28201])
+    b = peerbase.Node('cb', 'cache', KEY, ports=[28204, 28201])
+    b.register_command('count', count, cache=0.5)
+    b.register_command('uncached', count)
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'cb' in a.peers.keys())
+    result = a.command('count', ['x'], target='cb')
+    result['calls'] = 'changed'  # Callers get a copy
+    assert a.command('count', ['x'], target='cb') == {'calls': 1}
+    assert a.metrics.snapshot()['histograms']['request_seconds{path="local"}']['count'] == 1  # Answered by a's cache
+    assert a.command('count', ['x'], target='cb', cache=False) == {'calls': 1}  # Answered by b's memo
+    assert a.command('count', ['y'], target='cb') == {'calls': 1}
+    assert a.command('uncached', ['z'], target='cb') == {'calls': 1} and a.command('uncached', ['z'], target='cb') == {'calls': 2}
+    time.sleep(0.6)
+    assert a.command('count', ['x'], target='cb') == {'calls': 2}
+    assert a.invalidate('count', target='cb') == 2 and b.invalidate('count') == 2
+    assert a.command('count', ['x'], target='cb') == {'calls': 3}
+    b.register_command('count', count, cache=0.5)  # Replacing a command drops its memoized results
+    assert a.command('count', ['x'], target='cb', cache=False) == {'calls': 4}
@@ -0,0 +1,49 @@
+import os
+import pytest
+import peerbase
+from peerbase import compress
+from peerbase.compress import Compressor
+from conftest import KEY
+
+DATA = b'{"reading": 21.5, "unit": "C"}' * 200
+
+
+@pytest.mark.parametrize('codec', list(compress.CODECS.keys()))
+def test_codec_round_trip(codec):
+    framed = compress.compress(DATA, codec)
+    assert compress.is_compressed(framed) and len(framed) < len(DATA)
+    assert compress.decompress(framed) == DATA
+    assert compress.decompress(DATA) == DATA  # Uncompressed plaintext passes through
+    with pytest.raises(ValueError):
+        compress.decompress(compress.MAGIC + bytes([0xff]) + framed)
+
+
+# A message is only compressed with a codec its recipient advertised, and only if it is big enough to be worth it
+def test_negotiation():
+    compressor = Compressor(['zstd', 'lzma', 'zlib'], threshold=1024)
+    assert compressor.choose(['compress-zlib', 'compress-lzma']) == 'lzma'
+    assert compressor.compress(DATA, []) == DATA
+    assert compressor.compress(DATA[:100], ['compress-zlib']) == DATA[:100]
+    noise = os.urandom(4096)
+    assert compressor.compress(noise, ['compress-zlib']) == noise
+    framed = compressor.compress(DATA, ['compress-zlib'])
+    assert compressor.decompress(framed) == DATA
+    stats = compressor.stats()
+    assert stats['small'] == 1 and stats['incompressible'] == 1
+    assert stats['codecs']['zlib']['messages'] == 1 and stats['codecs']['zlib']['decompressed'] == 1
+    assert stats['codecs']['zlib']['ratio'] == len(framed) / len(DATA)
+    assert Compressor(None).choose(compress.CAPABILITIES) == None
+
+
+# Nodes compress large messages for each other with the first codec both support, and read them back
+@pytest.mark.parametrize('binary', [False, True])
+def test_message_round_trip(binary):
+    a = peerbase.Node('a', 'compress', KEY, compression=['lzma', 'zlib'])
+    b = peerbase.Node('b', 'compress', KEY, compression=['zlib'])
+    a.peer_capabilities['b'] = set(b.capabilities)
+    message = {'command': 'store', 'args': [DATA.decode('utf-8')], 'kwargs': {}}
+    assert b.unpack_message(a.pack_message(message, binary=binary, peer='b')) == message
+    assert b.compressor.stats()['codecs']['lzma']['decompressed'] == 1
+    a.peer_capabilities['b'] = {'compress-zlib'}  # Only zlib advertised
+    assert b.unpack_message(a.pack_message(message, binary=binary, peer='b')) == message
+    assert b.compressor.stats()['codecs']['zlib']['decompressed'] == 1
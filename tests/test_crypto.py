@@ -0,0 +1,42 @@
+import pytest
+import peerbase
+from peerbase import crypto
+from peerbase.crypto import ReplayError, ReplayWindow, SessionCrypto
+from conftest import KEY
+
+
+# Each counter is accepted once; counters may arrive out of order while they are within the window, not behind it
+def test_replay_window():
+    window = ReplayWindow()
+    assert window.accept(5)
+    assert not window.accept(5)  # Duplicate
+    assert window.accept(3) and window.accept(4)  # Out of order, within the window
+    assert not window.accept(3)
+    assert window.accept(5 + crypto.REPLAY_WINDOW)
+    assert not window.accept(5)  # Now behind the window
+    assert window.accept(6) and not window.accept(6)
+    assert not window.accept(0)
+
+
+def test_unseal_rejects_replays():
+    a = SessionCrypto('net', 'a', KEY)
+    b = SessionCrypto('net', 'b', KEY)
+    first, second = a.seal(b'one', 'b'), a.seal(b'two', 'b')
+    assert b.unseal(second) == b'two'
+    assert b.unseal(first) == b'one'
+    with pytest.raises(ReplayError):
+        b.unseal(first)
+
+
+# A node only advertises the cipher it seals with, so peers with another cipher (or Fernet) fall back to Fernet
+def test_advertised_cipher():
+    nodes = {c: peerbase.Node(c, 'crypto', KEY, cipher=c) for c in ['aes-gcm', 'chacha20', 'fernet']}
+    assert {c for c in nodes['aes-gcm'].capabilities if c.startswith('aead-')} == {'aead-aes-gcm'}
+    assert {c for c in nodes['chacha20'].capabilities if c.startswith('aead-')} == {'aead-chacha20'}
+    assert {c for c in nodes['fernet'].capabilities if c.startswith('aead-')} == set()
+    for node in nodes.values():
+        for other in nodes.values():
+            node.peer_capabilities[other.name] = set(other.capabilities)
+    assert nodes['aes-gcm'].uses_aead('aes-gcm') and not nodes['aes-gcm'].uses_aead('chacha20') and not nodes['aes-gcm'].uses_aead('fernet')
+    sealed = nodes['aes-gcm'].seal(b'data', 'fernet')
+    assert not crypto.is_aead(sealed) and nodes['fernet'].unseal(sealed) == b'data'
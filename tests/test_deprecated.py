@@ -0,0 +1,13 @@
+import pytest
+from peerbase import format_dict, get_multikey, InternalKeyError
+
+
+# The helpers the command index replaced still work, but warn
+def test_deprecated_helpers():
+    with pytest.warns(DeprecationWarning):
+        assert format_dict({'a': {'b': 1, 'c': {'d': 2}}, 'e': 3}) == ['a.b', 'a.c.d', 'e']
+    with pytest.warns(DeprecationWarning):
+        assert get_multikey('a.c.d', {'a': {'b': 1, 'c': {'d': 2}}}) == 2
+    with pytest.warns(DeprecationWarning):
+        with pytest.raises(InternalKeyError):
+            get_multikey('a.x', {'a': {'b': 1}})
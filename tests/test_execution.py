@@ -0,0 +1,65 @@
+import asyncio
+import os
+import threading
+import pytest
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, wait_for
+
+
+def where(node, args, kwargs):
+    return [threading.current_thread().name, os.getpid(), node == None]
+
+
+def crash(node, args, kwargs):
+    os._exit(1)
+
+
+async def coroutine(node, args, kwargs):
+    return args
+
+
+# Each command runs where it was registered to: on the request's thread, the command thread pool or a worker process
+def test_executions():
+    a = peerbase.Node('ea', 'execution', KEY, ports=[28102, 28101])
+    b = peerbase.Node('eb', 'execution', KEY, ports=[28104, 28101], command_processes=1)
+    b.register_command('inline', where)
+    b.register_command('thread', where, execution='thread')
+    b.register_commands({'process': where, 'crash': crash}, execution='process')
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'eb' in a.peers.keys())
+    name, pid, no_node = a.command('inline', target='eb', raise_errors=True)
+    assert name.startswith('execution.eb.server.worker') and pid == os.getpid() and not no_node
+    name, pid, no_node = a.command('thread', target='eb', raise_errors=True)
+    assert name.startswith('execution.eb.command') and pid == os.getpid() and not no_node
+    name, pid, no_node = a.command('process', target='eb', raise_errors=True, timeout=30)
+    assert pid != os.getpid() and no_node
+    assert a.command('crash', target='eb', timeout=30) == None  # The worker died: the call fails with 500
+    assert a.command('process', target='eb', raise_errors=True, timeout=30)[1] not in [os.getpid(), pid]  # On a new pool
+
+    async def main():
+        x = AsyncNode('ex', 'execution', KEY, ports=[28106, 28101], registered_commands={'coroutine': coroutine})
+        x.register_command('process', where, execution='process')
+        await x.start()
+        try:
+            while not 'ex' in a.peers.keys():
+                await asyncio.sleep(0.05)
+            loop = asyncio.get_running_loop()
+            answer = await loop.run_in_executor(None, lambda: a.command('process', target='ex', raise_errors=True, timeout=30))
+            assert answer[1] != os.getpid() and answer[2]
+            assert await loop.run_in_executor(None, lambda: a.command('coroutine', [1], target='ex', raise_errors=True)) == [1]
+        finally:
+            await x.stop()
+
+    asyncio.run(asyncio.wait_for(main(), 60))
+
+
+def test_invalid_executions():
+    node = peerbase.Node('ey', 'execution', KEY)
+    with pytest.raises(ValueError):
+        node.register_command('x', where, execution='gpu')
+    with pytest.raises(ValueError):
+        node.register_command('x', coroutine, execution='thread')
+    with pytest.raises(ValueError):
+        node.register_command('x', lambda node, args, kwargs: args, execution='process')
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, start_relay, stop_relay, wait_for
+
+PORT = 27500
+
+
+def echo(node, args, kwargs):
+    return [node.name, *args]
+
+
+# A node on one relay commands a peer attached to a federated relay. The peer only has a session with its own relay
+# and answers through it; the response is forwarded back over the relays' routes.
+def test_response_returns_through_delivering_relay(tmp_path):
+    first = f'{peerbase.ip()}:{PORT}'
+    second = f'{peerbase.ip()}:{PORT + 2}'
+    with open(tmp_path / 'second.json', 'w') as f:  # The second relay starts out federated with the first
+        json.dump({'port': PORT + 2, 'save_location': None, 'peers': {}, 'altservers': [first], 'clear_time': 1.5}, f)
+    relays = [start_relay(PORT, ['--timeout', '1.5'], tmp_path)]
+    try:
+        relays.append(start_relay(PORT + 2, ['--state', str(tmp_path / 'second.json')], tmp_path))
+        a = peerbase.Node('fa', 'federation', KEY, ports=[27504, 27503], servers=first, use_local=False, registered_commands={'echo': echo})
+        b = peerbase.Node('fb', 'federation', KEY, ports=[27506, 27503], servers=second, use_local=False, registered_commands={'echo': echo})
+        a.start_multithreaded()
+        b.start_multithreaded()
+        wait_for(lambda: 'fb' in a.remote_peers.keys() and 'fa' in b.remote_peers.keys(), timeout=15)
+        assert a.remote_peers['fb'] == {first} and b.remote_peers['fa'] == {second}
+        assert a.command('echo', [1], target='fb', raise_errors=True) == ['fb', 1]
+        assert b.command('echo', [2], target='fa', raise_errors=True) == ['fa', 2]
+        assert not first in b.pool.sessions.keys()  # fb never contacted the first relay, nor fa the second
+        assert not second in a.pool.sessions.keys()
+
+        async def main():
+            x = AsyncNode('fx', 'federation', KEY, ports=[27508, 27503], servers=second, use_local=False, registered_commands={'echo': echo})
+            await x.start()
+            try:
+                while not 'fa' in x.remote_peers.keys() or not 'fx' in a.remote_peers.keys():
+                    await asyncio.sleep(0.05)
+                assert await asyncio.get_running_loop().run_in_executor(None, lambda: a.command('echo', [3], target='fx', raise_errors=True)) == ['fx', 3]
+                assert not first in x.http.idle.keys()
+            finally:
+                await x.stop()
+
+        asyncio.run(asyncio.wait_for(main(), 20))
+    finally:
+        for relay in relays:
+            stop_relay(relay)
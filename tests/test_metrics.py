@@ -0,0 +1,54 @@
+import requests
+import peerbase
+from peerbase.metrics import Metrics
+from conftest import KEY, start_relay, stop_relay, wait_for
+
+
+def echo(node, args, kwargs):
+    return args
+
+
+def test_prometheus_output():
+    metrics = Metrics()
+    metrics.count('commands', command='echo', status=200)
+    metrics.count('commands', 2, command='echo', status=200)
+    metrics.add('outstanding', 3)
+    metrics.observe('seconds', 0.003, path='a "b"')
+    metrics.observe('seconds', 20, path='a "b"')
+    metrics.register('peers', lambda: {'x': 1, 'y': 2}, label='relay')
+    lines = metrics.prometheus('pb').splitlines()
+    assert '# TYPE pb_commands_total counter' in lines
+    assert 'pb_commands_total{command="echo",status="200"} 3' in lines
+    assert 'pb_outstanding 3' in lines and 'pb_peers{relay="y"} 2' in lines
+    assert '# TYPE pb_seconds histogram' in lines
+    assert 'pb_seconds_bucket{path="a \\"b\\"",le="0.0025"} 0' in lines
+    assert 'pb_seconds_bucket{path="a \\"b\\"",le="0.005"} 1' in lines
+    assert 'pb_seconds_bucket{path="a \\"b\\"",le="+Inf"} 2' in lines
+    assert 'pb_seconds_count{path="a \\"b\\""} 2' in lines
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['commands{command="echo",status="200"}'] == 3
+    assert snapshot['histograms']['seconds{path="a \\"b\\""}']['p50'] == 0.005
+    assert snapshot['histograms']['seconds{path="a \\"b\\""}']['p99'] == float('inf')
+
+
+# A node's __metrics__ command and the relay's /metrics page report the traffic they served
+def test_node_and_relay_metrics(tmp_path):
+    relay = start_relay(27900, [], tmp_path)
+    try:
+        relay_address = f'{peerbase.ip()}:27900'
+        a = peerbase.Node('ma1', 'metrics', KEY, ports=[27902, 27901], servers=relay_address, use_local=False)
+        b = peerbase.Node('mb1', 'metrics', KEY, ports=[27904, 27901], servers=relay_address, use_local=False, registered_commands={'echo': echo})
+        a.start_multithreaded()
+        b.start_multithreaded()
+        wait_for(lambda: 'mb1' in a.remote_peers.keys())
+        assert a.command('echo', [1], target='mb1', raise_errors=True) == [1]
+        remote = a.command('__metrics__', target='mb1', raise_errors=True)
+        assert remote['counters']['commands{command="echo",status="200"}'] == 1
+        assert remote['histograms']['handler_seconds{command="echo"}']['count'] == 1
+        assert a.metrics.snapshot()['histograms']['request_seconds{path="relay"}']['count'] == 2
+        page = requests.get(f'http://{relay_address}/metrics', timeout=5)
+        assert page.status_code == 200 and page.headers['content-type'].startswith('text/plain')
+        assert 'peerbase_relay_mailbox_messages{peer="mb1"} 0' in page.text.splitlines()
+        assert '# TYPE peerbase_relay_packets_total counter' in page.text.splitlines()
+    finally:
+        stop_relay(relay)
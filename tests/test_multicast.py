@@ -0,0 +1,48 @@
+import asyncio
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, start_relay, stop_relay, wait_for
+
+PORT = 27600
+
+
+def echo(node, args, kwargs):
+    return [node.name, *args]
+
+
+def fail(node, args, kwargs):
+    raise ValueError('Failed on purpose.')
+
+
+COMMANDS = {'echo': echo, 'fail': fail}
+
+
+# Remote peers behind the same relay get one multicast packet, and each answers through its own mailbox.
+# The relay is the test's own, so peers of other tests do not join the group.
+def test_multicast_round_trip(tmp_path):
+    relay = start_relay(PORT, ['--timeout', '1.5'], tmp_path)
+    try:
+        relay_address = f'{peerbase.ip()}:{PORT}'
+        a = peerbase.Node('ma', 'multicast', KEY, ports=[27602, 27601], servers=relay_address, use_local=False)
+        peers = [peerbase.Node(n, 'multicast', KEY, ports=[27604 + 2 * i, 27601], servers=relay_address, use_local=False, registered_commands=COMMANDS)
+                 for i, n in enumerate(['mb', 'mc', 'md'])]
+        for node in [a, *peers]:
+            node.start_multithreaded()
+        wait_for(lambda: set(a.remote_peers.keys()).issuperset(['mb', 'mc', 'md']) and len(a.multicast_groups(['mb', 'mc', 'md'])) == 1)
+        assert a.command('echo', [1], target=['mb', 'mc', 'md'], raise_errors=True) == {n: [n, 1] for n in ['mb', 'mc', 'md']}
+        assert a.metrics.snapshot()['histograms']['request_seconds{path="multicast"}']['count'] == 3
+        assert a.command('fail', target=['mb', 'mc']) == {'mb': None, 'mc': None}
+
+        async def main():
+            x = AsyncNode('mx', 'multicast', KEY, ports=[27612, 27601], servers=relay_address, use_local=False)
+            await x.start()
+            try:
+                while len(x.multicast_groups(['mb', 'mc', 'md'])) != 1:
+                    await asyncio.sleep(0.05)
+                assert await x.command('echo', [2], target=['mb', 'mc', 'md'], raise_errors=True) == {n: [n, 2] for n in ['mb', 'mc', 'md']}
+            finally:
+                await x.stop()
+
+        asyncio.run(asyncio.wait_for(main(), 15))
+    finally:
+        stop_relay(relay)
@@ -0,0 +1,82 @@
+import asyncio
+import http.server
+import threading
+import time
+from peerbase.pool import SessionPool
+from peerbase.aio import AsyncHTTPPool
+
+PORT = 28300
+
+
+class Echo(http.server.BaseHTTPRequestHandler):  # Answers with the client port, so tests can tell connections apart
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = str(self.client_address[1]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Echo)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Requests to an address reuse its keep-alive connection. Sessions left idle are closed when another request comes in,
+# unless a request on them is still running.
+def test_session_pool_eviction():
+    servers = [serve(PORT), serve(PORT + 1)]
+    try:
+        first, second = f'127.0.0.1:{PORT}', f'127.0.0.1:{PORT + 1}'
+        pool = SessionPool(idle_timeout=0.2)
+        ports = {pool.post(first, data=b'x').text for _ in range(3)}
+        assert len(ports) == 1
+        busy = pool._acquire(second)  # A request in flight
+        time.sleep(0.3)
+        assert pool.post(first, data=b'x').text not in ports  # The idle session was closed and replaced
+        assert set(pool.sessions.keys()) == {first, second}
+        pool._release(busy)
+        time.sleep(0.3)
+        pool.post(first, data=b'x')
+        assert set(pool.sessions.keys()) == {first}
+        pool.post(second, data=b'x')
+        pool.prune([second])
+        assert set(pool.sessions.keys()) == {second}
+        pool.close()
+        assert pool.sessions == {}
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_async_pool_eviction():
+    server = serve(PORT + 2)
+    address = f'127.0.0.1:{PORT + 2}'
+
+    async def main():
+        pool = AsyncHTTPPool(pool_size=1, idle_timeout=0.2)
+        ports = set()
+        for _ in range(3):
+            ports.add((await pool.request('POST', address, body=b'x'))[2])
+        assert len(ports) == 1 and len(pool.idle[address]) == 1
+        await asyncio.sleep(0.3)
+        assert (await pool.request('POST', address, body=b'x'))[2] not in ports  # The idle connection was dropped
+        await asyncio.gather(*[pool.request('POST', address, body=b'x') for _ in range(3)])
+        assert len(pool.idle[address]) == 1  # At most pool_size idle connections are kept
+        pool.prune([])
+        assert pool.idle == {}
+
+    try:
+        asyncio.run(asyncio.wait_for(main(), 10))
+    finally:
+        server.shutdown()
+        server.server_close()
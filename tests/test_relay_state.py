@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+import pytest
+from peerbase.relay import Relay
+from peerbase.relay_state import MemoryState, SQLiteState, write_atomic, MEMBERSHIP_HISTORY
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def state(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryState()
+    return SQLiteState(str(tmp_path / 'relay_state.db'))
+
+
+# A resent packet replaces its earlier copy in the mailbox instead of counting twice toward max_bytes and max_messages
+def test_resent_packet_counted_once(state):
+    state.touch('b', [])
+    packet = {'originator': 'a', 'data': b'x' * 600, 'type': 'request', 'remote': 'relay'}
+    assert state.enqueue('b', 'pid', packet, 600, 30, 1, 1000) == 'accepted'
+    assert state.enqueue('b', 'pid', packet, 600, 30, 1, 1000) == 'accepted'
+    assert state.mailboxes()['b'] == {'messages': 1, 'bytes': 600}
+    assert state.enqueue('b', 'other', packet, 600, 30, 2, 1000) == 'full'
+    assert list(state.drain('b').keys()) == ['pid']
+    assert state.mailboxes()['b'] == {'messages': 0, 'bytes': 0}
+
+
+# Writers racing on one save file each use their own temporary file, so every write lands whole and none fails
+def test_concurrent_atomic_writes(tmp_path):
+    path = str(tmp_path / 'state.json')
+    errors = []
+
+    def write(n):
+        try:
+            for _ in range(50):
+                write_atomic(path, str(n) * 1000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    with open(path) as f:
+        data = f.read()
+    assert len(data) == 1000 and len(set(data)) == 1
+    assert [p.name for p in tmp_path.iterdir()] == ['state.json']
+
+
+# A ping registers the peer, and holds it for a long-poll only while its mailbox is empty and it has not missed changes
+def test_ping(state):
+    new, expired, version, held, buf = state.ping('a', ['binary'], ['relay:1'], 1.5)
+    assert new and not expired and held == 0 and buf == {}
+    assert state.servers() == ['relay:1'] and state.capabilities() == {'a': ['binary']}
+    assert state.ping('a', ['binary'], [], 1.5, 10, version)[3] == 10
+    assert state.ping('a', ['binary'], [], 1.5, 10, version - 1)[3] == 0  # Missed a change: answer at once
+    state.touch('b', [])
+    packet = {'originator': 'b', 'data': b'x', 'type': 'request', 'remote': 'relay'}
+    state.enqueue('a', 'pid', packet, 1, 30, 10, 1000)
+    new, expired, version, held, buf = state.ping('a', ['binary'], [], 1.5, 10, None)
+    assert held == 0 and list(buf.keys()) == ['pid']  # Packets waiting: drained in the same call
+
+
+# Repeated pings that change nothing only read the shared database
+def test_idle_ping_does_not_write(tmp_path):
+    state = SQLiteState(str(tmp_path / 'relay_state.db'))
+    state.ping('a', [], ['relay:1'], 1.5)
+    writes = state.db.total_changes
+    for _ in range(5):
+        assert state.ping('a', [], ['relay:1'], 1.5) == (False, False, state.membership_version(), 0, {})
+    assert state.db.total_changes == writes
+    state.ping('a', [], ['relay:1'], 1.5, 10)  # A long-poll moves the peer's timeout once
+    writes = state.db.total_changes
+    state.ping('a', [], ['relay:1'], 1.5, 10)
+    assert state.db.total_changes == writes
+
+
+# A full mailbox only expires its own packets; a sweep drops what is due and skips packets drained or resent since
+def test_expire_packets(state):
+    for name in ['a', 'b']:
+        state.touch(name, [])
+    packet = {'originator': 'c', 'data': b'x', 'type': 'request', 'remote': 'relay'}
+    for name in ['a', 'b']:
+        state.enqueue(name, 'old', packet, 1, 0.05, 10, 1000)
+    state.enqueue('a', 'resent', packet, 1, 0.05, 10, 1000)
+    state.enqueue('a', 'resent', packet, 1, 30, 10, 1000)
+    time.sleep(0.1)
+    assert state.expire_packets('a') == 1
+    assert state.mailboxes() == {'a': {'messages': 1, 'bytes': 1}, 'b': {'messages': 1, 'bytes': 1}}
+    state.enqueue('b', 'drained', packet, 1, 0.05, 10, 1000)
+    state.drain('b')
+    time.sleep(0.1)
+    assert state.expire_packets() == 0
+    assert state.mailboxes()['a'] == {'messages': 1, 'bytes': 1}
+    state.enqueue('b', 'late', packet, 1, 0.05, 10, 1000)
+    time.sleep(0.1)
+    assert state.expire_packets() == 1 and state.counters()['expired'] == 2
+
+
+# A relay that crashed between snapshots restores the last snapshot and replays the journal written since
+def test_journal_replay(tmp_path):
+    path = str(tmp_path / 'relay.json')
+    first = Relay(27490, save_to=path)
+    first.state.touch('a', ['binary'])
+    first.state.touch('b', [])
+    first.state.enqueue('a', 'pid', {'originator': 'b', 'data': 'x', 'type': 'request', 'remote': 'relay'}, 1, 30, 10, 1000)
+    first.state.add_servers(['relay:1'])
+    first.state.close()  # Crash: no snapshot after the changes
+    second = Relay.from_state(path)
+    assert sorted(second.state.names()) == ['a', 'b'] and second.state.capabilities() == {'a': ['binary']}
+    assert second.state.servers() == ['relay:1']
+    assert second.state.mailboxes()['a'] == {'messages': 1, 'bytes': 1}
+    assert list(second.state.drain('a').keys()) == ['pid']
+    second.state.close()
+
+
+# A crash after a checkpoint rotated the journal, but before its snapshot was written, loses nothing: the old
+# snapshot is restored and both the rotated journal and the one started after it are replayed
+def test_crash_mid_checkpoint(tmp_path):
+    path = str(tmp_path / 'relay.json')
+    first = Relay(27490, save_to=path)
+    first.state.touch('a', [])
+    first.state.checkpoint()  # Journal rotated, snapshot never written
+    first.state.touch('b', [])
+    first.state.close()
+    assert os.path.exists(path + '.journal.old')
+    second = Relay.from_state(path)
+    assert sorted(second.state.names()) == ['a', 'b']
+    second.save_state()
+    assert not os.path.exists(path + '.journal.old')
+    second.state.close()
+    third = Relay.from_state(path)  # The new snapshot holds both peers on its own
+    assert sorted(third.state.names()) == ['a', 'b']
+    third.state.close()
+
+
+# Silent peers expire with their mailboxes. A peer that pinged since its expiry entry was queued is kept, and
+# repeated pings do not add entries to the queue.
+def test_expire_peers(state):
+    for name in ['a', 'b']:
+        state.touch(name, [])
+    state.enqueue('b', 'pid', {'originator': 'a', 'data': b'x', 'type': 'request', 'remote': 'relay'}, 1, 30, 10, 1000)
+    time.sleep(0.2)
+    for _ in range(10):
+        state.touch('a', [])
+    assert state.expire_peers(0.1) == True
+    assert state.names() == ['a'] and state.counters()['dropped'] == 1
+    assert state.expire_peers(0.1) == False
+    if isinstance(state, MemoryState):
+        assert len(state.deadlines) == 1
+    time.sleep(0.2)
+    assert state.expire_peers(0.1) == True and state.names() == []
+
+
+# A node that saw membership version v is sent what changed since, with each peer as it is now. A node whose version
+# fell out of the change history (or is from the future) gets None, and is sent the full lists instead.
+def test_membership_since(state):
+    state.touch('a', ['bin1'])
+    version = state.membership_version()
+    assert state.membership_since(version) == (version, {'joined': {}, 'left': [], 'servers_added': [], 'servers_removed': []})
+    for name in ['b', 'c']:
+        state.touch(name, [])
+    state.add_servers(['relay:1', 'relay:2'])
+    state.remove_server('relay:2')
+    time.sleep(0.2)
+    state.touch('a', ['bin1', 'batch'])
+    state.touch('b', [])
+    state.expire_peers(0.1)
+    current, delta = state.membership_since(version)
+    assert current == state.membership_version() and current > version
+    assert delta == {'joined': {'a': ['bin1', 'batch'], 'b': []}, 'left': ['c'], 'servers_added': ['relay:1'], 'servers_removed': ['relay:2']}
+    assert state.membership_since(current + 1) == (current, None)
+    for n in range(MEMBERSHIP_HISTORY):
+        state.touch('a', [str(n)])
+    assert state.membership_since(version)[1] == None
+    assert state.membership_since(state.membership_version() - 1)[1] == {'joined': {'a': [str(MEMBERSHIP_HISTORY - 1)]}, 'left': [], 'servers_added': [], 'servers_removed': []}
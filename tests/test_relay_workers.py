@@ -0,0 +1,29 @@
+import peerbase
+from conftest import KEY, start_relay, stop_relay, wait_for
+
+PORT = 27400
+
+
+def echo(node, args, kwargs):
+    return [node.name, *args]
+
+
+# Peers attached to a relay with several workers reach each other whichever worker serves their pings and sends.
+# Each node keeps its own connections, which the workers accept in turn, so packets cross between workers.
+def test_peers_on_different_workers(tmp_path):
+    relay = start_relay(PORT, ['--workers', '2', '--state-backend', 'sqlite', '--timeout', '1.5',
+                               '--state-db', str(tmp_path / 'relay_state.db'), '--saveloc', str(tmp_path / 'relay.json')], tmp_path)
+    try:
+        address = f'{peerbase.ip()}:{PORT}'
+        names = ['w1', 'w2', 'w3', 'w4']
+        nodes = [peerbase.Node(n, 'workers', KEY, ports=[27402 + 2 * i, 27401], servers=address, use_local=False, registered_commands={'echo': echo})
+                 for i, n in enumerate(names)]
+        for node in nodes:
+            node.start_multithreaded()
+        wait_for(lambda: all(len(set(names).difference([n.name], n.remote_peers.keys())) == 0 for n in nodes), timeout=15)
+        for node in nodes:
+            others = [n for n in names if n != node.name]
+            assert node.command('echo', [1], target=others, raise_errors=True) == {n: [n, 1] for n in others}
+        assert relay.poll() == None
+    finally:
+        stop_relay(relay)
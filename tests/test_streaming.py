@@ -0,0 +1,53 @@
+import io
+import time
+import peerbase
+from peerbase import stream
+from conftest import start_relay, stop_relay
+
+KEY = peerbase.key_generate().decode('utf-8')
+
+
+def size(node, args, kwargs):
+    return sum(len(chunk) for chunk in args[0])
+
+
+# A streamed argument sent in the very first request between two nodes, before the target knows the sender speaks the
+# binary format, must still be read: the target's pulls carry bytes that legacy JSON cannot.
+def test_first_call_streams_argument():
+    a = peerbase.Node('a', 'streaming', KEY, ports=[27102, 27101])
+    b = peerbase.Node('b', 'streaming', KEY, ports=[27104, 27101], registered_commands={'size': size})
+    a.start_multithreaded()
+    b.start_multithreaded()
+    deadline = time.time() + 5
+    while not 'b' in a.peers.keys() and time.time() < deadline:
+        time.sleep(0.05)
+    assert not 'b' in a.peer_capabilities.keys()
+    assert a.command('size', [io.BytesIO(b'x' * 1000000)], target='b', raise_errors=True) == 1000000
+    assert a.command('size', [io.BytesIO(b'x' * 1000000)], target='b', raise_errors=True) == 1000000
+
+
+def test_legacy_response_falls_back_to_binary_for_bytes():
+    node = peerbase.Node('c', 'streaming', KEY, ports=[27106, 27105])
+    body, headers = node.local_response(b'\x00\x01', False)
+    assert headers['Content-Type'] == peerbase.wire.CONTENT_TYPE
+    assert node.unpack_message(body)['response'] == b'\x00\x01'
+    assert node.unpack_message(node.pack_message({'response': b'\x02'}))['response'] == b'\x02'
+
+
+# Streams nobody reads are dropped by the node's periodic loops, without waiting for another stream to be offered
+def test_unread_streams_expire(tmp_path):
+    relay = start_relay(27100, [], tmp_path)
+    try:
+        relay_address = f'{peerbase.ip()}:27100'
+        local = peerbase.Node('d', 'streaming', KEY, ports=[27108, 27107], peer_ttl=0.4, advertise_interval=0.1, stream_timeout=0.3)
+        remote = peerbase.Node('e', 'streaming', KEY, ports=[27110, 27109], servers=relay_address, use_local=False, long_poll=0, stream_timeout=0.3)
+        local.start_multithreaded()
+        remote.start_multithreaded()
+        for node in [local, remote]:
+            assert stream.is_placeholder(node.offer_stream(io.BytesIO(b'x')))
+        deadline = time.time() + 5
+        while (local.streams or remote.streams) and time.time() < deadline:
+            time.sleep(0.05)
+        assert local.streams == {} and remote.streams == {}
+    finally:
+        stop_relay(relay)
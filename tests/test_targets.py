@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, wait_for
+
+calls = {}
+calls_lock = threading.Lock()
+
+
+def count(node, args, kwargs):
+    with calls_lock:
+        calls[node.name] = calls.get(node.name, 0) + 1
+    return args
+
+
+COMMANDS = {'count': count}
+
+
+# A peer on the LAN that is also attached to a relay is one target of '*', so it runs the command once
+def test_star_lists_each_peer_once(relay_address):
+    a = peerbase.Node('a', 'targets', KEY, ports=[27302, 27301], servers=relay_address)
+    b = peerbase.Node('b', 'targets', KEY, ports=[27304, 27301], servers=relay_address, registered_commands=COMMANDS)
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'b' in a.peers.keys() and 'b' in a.remote_peers.keys())
+    assert a.resolve_targets('*') == ['b']
+    assert a.command('count', [1], target='*') == [1]
+    assert list(a.command_iter('count', [1], target='*')) == [('b', [1])]
+    assert calls['b'] == 2
+
+    async def main():
+        x = AsyncNode('x', 'targets', KEY, ports=[27306, 27301], servers=relay_address)
+        await x.start()
+        try:
+            while not ('b' in x.peers.keys() and 'b' in x.remote_peers.keys()):
+                await asyncio.sleep(0.05)
+            assert [r async for r in x.command_iter('count', [2], target='*') if r[0] == 'b'] == [('b', [2])]
+        finally:
+            await x.stop()
+
+    asyncio.run(asyncio.wait_for(main(), 15))
+    assert calls['b'] == 3
+
+
+# With first=k, a failing target only raises once k answers are out of reach
+def test_first_tolerates_failures():
+    a = peerbase.Node('c', 'targets2', KEY, ports=[27312, 27311])
+    b = peerbase.Node('d', 'targets2', KEY, ports=[27314, 27311], registered_commands=COMMANDS)
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'd' in a.peers.keys())
+    assert a.command('count', [1], target=['missing', 'd'], first=1, raise_errors=True) == {'d': [1]}
+    try:
+        a.command('count', [1], target=['missing', 'd'], first=2, raise_errors=True)
+        assert False, 'first=2 cannot be met'
+    except TimeoutError as e:
+        assert 'answered' in str(e) and 'quorum' not in str(e) and 'agreed' not in str(e)
+
+
+# A LAN peer that refuses the connection counts as a failed target, like one that times out
+def test_unreachable_target():
+    a = peerbase.Node('e', 'targets3', KEY, ports=[27322, 27321])
+    b = peerbase.Node('f', 'targets3', KEY, ports=[27324, 27321], registered_commands=COMMANDS)
+    a.start_multithreaded()
+    b.start_multithreaded()
+    wait_for(lambda: 'f' in a.peers.keys())
+    a.peers['dead'] = ('127.0.0.1', 27329)  # Nothing listens there
+    a.peer_seen['dead'] = a.peer_seen['f']
+    assert a.command('count', [1], target=['dead', 'f'], first=1) == {'f': [1]}
+    assert a.command('count', [1], target=['dead', 'f'], quorum=1) == {'f': [1]}
+    assert a.command('count', [1], target=['dead', 'f']) == {'dead': None, 'f': [1]}
+    try:
+        a.command('count', [1], target='dead', raise_errors=True)
+        assert False, 'dead cannot be reached'
+    except ConnectionError:
+        pass
+
+    async def main():
+        x = AsyncNode('g', 'targets3', KEY, ports=[27326, 27321])
+        await x.start()
+        try:
+            while not 'f' in x.peers.keys():
+                await asyncio.sleep(0.05)
+            x.peers['dead'] = ('127.0.0.1', 27329)
+            x.peer_seen['dead'] = x.peer_seen['f']
+            assert await x.command('count', [2], target=['dead', 'f'], first=1) == {'f': [2]}
+            assert await x.command('count', [2], target=['dead', 'f']) == {'dead': None, 'f': [2]}
+        finally:
+            await x.stop()
+
+    asyncio.run(asyncio.wait_for(main(), 15))
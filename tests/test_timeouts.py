@@ -0,0 +1,97 @@
+import asyncio
+import http.server
+import threading
+import time
+import requests
+import peerbase
+from peerbase.aio import AsyncNode
+from conftest import KEY, wait_for
+
+
+def echo(node, args, kwargs):
+    return args
+
+
+# timeout=None means no deadline, over both the LAN and the relay
+def test_no_timeout(relay_address):
+    a = peerbase.Node('a', 'timeouts', KEY, ports=[27202, 27201])
+    b = peerbase.Node('b', 'timeouts', KEY, ports=[27204, 27201], registered_commands={'echo': echo})
+    c = peerbase.Node('c', 'timeouts', KEY, ports=[27206, 27201], servers=relay_address, use_local=False)
+    d = peerbase.Node('d', 'timeouts', KEY, ports=[27208, 27201], servers=relay_address, use_local=False, registered_commands={'echo': echo}, hedge=True)
+    for node in [a, b, c, d]:
+        node.start_multithreaded()
+    wait_for(lambda: 'b' in a.peers.keys() and 'd' in c.remote_peers.keys())
+    assert a.command('echo', [1], target='b', timeout=None, raise_errors=True) == [1]
+    assert c.command('echo', [2], target='d', timeout=None, raise_errors=True) == [2]
+    assert dict(c.command_iter('echo', [3], target=['d'], timeout=None, raise_errors=True)) == {'d': [3]}
+
+
+def test_no_timeout_async(relay_address):
+    d = peerbase.Node('e', 'timeouts', KEY, ports=[27210, 27201], servers=relay_address, use_local=False, registered_commands={'echo': echo})
+    d.start_multithreaded()
+
+    async def main():
+        x = AsyncNode('x', 'timeouts', KEY, ports=[27212, 27201], servers=relay_address, registered_commands={'echo': echo})
+        y = AsyncNode('y', 'timeouts', KEY, ports=[27214, 27201], registered_commands={'echo': echo})
+        await x.start()
+        await y.start()
+        try:
+            while not ('e' in x.remote_peers.keys() and 'y' in x.peers.keys()):
+                await asyncio.sleep(0.05)
+            assert await x.command('echo', [1], target='e', timeout=None, raise_errors=True) == [1]
+            assert await x.command('echo', [2], target='y', timeout=None, raise_errors=True) == [2]
+        finally:
+            await x.stop()
+            await y.stop()
+
+    asyncio.run(asyncio.wait_for(main(), 15))
+
+
+class SlowBusyRelay(http.server.BaseHTTPRequestHandler):  # Takes a while to refuse every packet with a full mailbox
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(0.9)
+        self.send_response(429)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Retries of a relay that applies backpressure share the caller's timeout rather than each getting all of it
+def test_backpressure_retries_share_timeout():
+    server = http.server.ThreadingHTTPServer((peerbase.ip(), 27220), SlowBusyRelay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        node = peerbase.Node('f', 'timeouts', KEY, ports=[27222, 27221])
+        packet = {'target': 'g', 'data': b'x', 'packet_id': 'pid', 'originator': 'f', 'r_type': 'request', 'remote_addr': f'{peerbase.ip()}:27220'}
+        start = time.time()
+        try:
+            node.relay_deliver(f'{peerbase.ip()}:27220', packet, 2)
+        except requests.Timeout:
+            pass
+        assert time.time() - start < 2.4
+    finally:
+        server.shutdown()
+
+
+# A relayed request is run once however many hedged copies arrive at the same time, and old packet ids are forgotten
+def test_first_delivery():
+    node = peerbase.Node('g', 'timeouts', KEY, ports=[27224, 27223])
+    barrier = threading.Barrier(8)
+    firsts = []
+
+    def deliver():
+        barrier.wait()
+        firsts.append(node.first_delivery('p'))
+
+    threads = [threading.Thread(target=deliver) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert sorted(firsts) == [False] * 7 + [True]
+    for i in range(1025):
+        node.handled_packets[f'old{i}'] = (time.time() - peerbase.DEDUP_WINDOW - 1, object())
+    assert node.first_delivery('q') and not node.first_delivery('q')
+    assert set(node.handled_packets.keys()) == {'p', 'q'}
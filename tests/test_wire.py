@@ -0,0 +1,47 @@
+import json
+import pytest
+import peerbase
+from peerbase import wire
+from conftest import KEY
+
+VALUES = [None, True, False, 0, -1, 2 ** 63 - 1, 2 ** 70, -2 ** 70, 1.5, '', 'text ü', b'', b'\x00\xff',
+          [1, 'a', None], (1, 2), {'a': 1, 'b': [1, 2]}, {'data': b'raw', 'nested': [{'k': b'v'}, 'x']}, [b'a', [b'b', {'c': b'd'}]]]
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_round_trip(value):
+    expected = list(value) if type(value) == tuple else value
+    assert wire.loads(wire.dumps(value)) == expected
+    assert wire.unpack(wire.pack(value)) == expected
+
+
+def test_legacy_json_and_errors():
+    assert wire.loads(json.dumps({'a': [1, 2]}).encode('utf-8')) == {'a': [1, 2]}
+    with pytest.raises(ValueError):
+        wire.loads(wire.dumps([1, 2])[:-1])  # Truncated
+    with pytest.raises(ValueError):
+        wire.loads(wire.HEADER + wire.pack(1) + b'x')  # Trailing bytes
+    with pytest.raises(ValueError):
+        wire.loads(wire.MAGIC + bytes([wire.VERSION + 1]) + wire.pack(1))  # From a newer version
+    with pytest.raises(TypeError):
+        wire.dumps(object())
+
+
+def test_legacy_transport():
+    raw = bytes(range(0x80, 0x100)) + bytes(range(0x80))  # Ciphertext starts with a Fernet or AEAD byte, at least 0x80
+    assert wire.from_legacy(wire.to_legacy(raw)) == raw
+    assert wire.to_raw(wire.to_text(raw)) == raw
+    assert wire.to_raw(raw) == raw
+
+
+# A message packed in either format unpacks to the same message, whether it arrives as raw bytes or as legacy text
+@pytest.mark.parametrize('binary', [False, True])
+def test_message_round_trip(binary):
+    a = peerbase.Node('a', 'wire', KEY)
+    b = peerbase.Node('b', 'wire', KEY)
+    a.peer_capabilities['b'] = set(b.capabilities)
+    message = {'command': 'echo', 'args': ['x', 1.5, None], 'kwargs': {'n': 1}}
+    for peer in ['b', None]:  # AEAD and Fernet
+        assert b.unpack_message(a.pack_message(message, binary=binary, peer=peer)) == message
+        assert b.unpack_message(wire.to_text(a.pack_message(message, binary=binary, peer=peer))) == message
+    assert b.unpack_message(a.pack_message(dict(message, args=[b'\x00']), binary=binary, peer='b'))['args'] == [b'\x00']  # Bytes force the binary format